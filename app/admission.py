@@ -0,0 +1,194 @@
+import asyncio
+import heapq
+import itertools
+import math
+import time
+from typing import Optional
+
+
+class AdmissionRejected(Exception):
+    """并发已满且等待队列已满或排队超时"""
+
+    def __init__(self, reason: str, retry_after: int):
+        self.reason = reason
+        self.retry_after = retry_after
+        super().__init__(reason)
+
+    def to_openai_error(self) -> dict[str, dict[str, str]]:
+        return {
+            "error": {
+                "message": self.reason,
+                "type": "rate_limit_error",
+                "code": "server_busy"
+            }
+        }
+
+
+class AdmissionTicket:
+    """一个已准入请求占用的并发名额，release 可重复调用"""
+
+    __slots__ = ('_controller', '_released', 'admitted_at', 'wait_seconds')
+
+    def __init__(self, controller: Optional['AdmissionController'], wait_seconds: float):
+        self._controller = controller
+        self._released = False
+        self.admitted_at = time.monotonic()
+        self.wait_seconds = wait_seconds
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        if self._controller is not None:
+            self._controller._release(time.monotonic() - self.admitted_at)
+
+
+class AdmissionController:
+    """
+    全局并发准入控制
+
+    同时处理的请求数达到上限后，新请求进入有界队列等待，
+    队列已满或等待超时则立即拒绝，并根据平均处理时长估算 Retry-After。
+
+    队列按调用方加权公平排队(WFQ)：每个等待者的虚拟完成时间为
+    max(当前虚拟时间, 同一调用方上一个等待者的完成时间) + 1 / 权重，名额空出时交给完成时间最小的等待者。
+    单个调用方时退化为 FIFO；大批量调用方排满队列时，其他调用方的新请求仍能插到前面。
+    """
+
+    def __init__(self, max_in_flight: int, max_queue: int, queue_timeout: float):
+        """
+        Args:
+            max_in_flight: 最大并发请求数，0 表示不限制
+            max_queue: 最大排队数
+            queue_timeout: 排队超时秒数
+        """
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+
+        self._in_flight = 0
+        # (虚拟完成时间, 序号, future)，放弃排队的 future 被取消后在出队时跳过
+        self._waiters: list[tuple[float, int, asyncio.Future]] = []
+        self._waiting = 0
+        self._seq = itertools.count()
+        self._virtual_time = 0.0
+        self._last_finish: dict[str, float] = {}
+        # 请求处理时长的指数移动平均，用于估算 Retry-After
+        self._avg_service_seconds = 1.0
+
+        # 统计
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.queued = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    @property
+    def in_flight(self) -> int:
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        return self._waiting
+
+    def _retry_after(self) -> int:
+        if self.max_in_flight <= 0:
+            return 1
+        rounds = (self._waiting + 1) / self.max_in_flight
+        return max(1, math.ceil(self._avg_service_seconds * rounds))
+
+    def _admit(self, wait_seconds: float) -> AdmissionTicket:
+        self.admitted += 1
+        self.total_wait_seconds += wait_seconds
+        self.max_wait_seconds = max(self.max_wait_seconds, wait_seconds)
+        return AdmissionTicket(self, wait_seconds)
+
+    async def acquire(self, caller: str = '', weight: float = 1.0) -> AdmissionTicket:
+        """
+        申请一个并发名额
+
+        Args:
+            caller: 调用方标识(如 API key 名称)，用于公平排队
+            weight: 调用方权重，权重越大排队时分到的名额越多
+
+        Raises:
+            AdmissionRejected: 队列已满或排队超时
+        """
+        if self.max_in_flight <= 0:
+            self._in_flight += 1
+            return self._admit(0.0)
+
+        if self._in_flight < self.max_in_flight and not self._waiting:
+            self._in_flight += 1
+            return self._admit(0.0)
+
+        if self._waiting >= self.max_queue:
+            self.rejected += 1
+            raise AdmissionRejected(f"服务繁忙: 并发 {self._in_flight}, 排队 {self._waiting}",
+                                    self._retry_after())
+
+        fut = asyncio.get_running_loop().create_future()
+        finish = max(self._virtual_time, self._last_finish.get(caller, 0.0)) + 1 / max(weight, 1e-6)
+        self._last_finish[caller] = finish
+        heapq.heappush(self._waiters, (finish, next(self._seq), fut))
+        self._waiting += 1
+        self.queued += 1
+        started_at = time.monotonic()
+        try:
+            await asyncio.wait({fut}, timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            self._abandon(fut)
+            raise
+
+        if not fut.done():
+            self._abandon(fut)
+            self.timed_out += 1
+            raise AdmissionRejected(f"服务繁忙: 排队超过 {self.queue_timeout} 秒", self._retry_after())
+
+        # 名额已由释放方直接转交，_in_flight 不变
+        return self._admit(time.monotonic() - started_at)
+
+    def _abandon(self, fut: asyncio.Future):
+        """等待方放弃排队；若名额恰好已经转交过来则归还"""
+        if fut.done() and not fut.cancelled():
+            self._release(None)
+            return
+        if not fut.done():
+            fut.cancel()
+            self._waiting -= 1
+            if not self._waiting:
+                # 剩下的都是已放弃的等待者
+                self._waiters.clear()
+                self._last_finish.clear()
+
+    def _release(self, service_seconds: Optional[float]):
+        if service_seconds is not None:
+            self._avg_service_seconds = self._avg_service_seconds * 0.9 + service_seconds * 0.1
+        # 有等待者时直接把名额转交给虚拟完成时间最小的等待者
+        while self._waiters:
+            finish, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                self._waiting -= 1
+                self._virtual_time = finish
+                if not self._waiting:
+                    # 队列排空后各调用方重新从同一起点排队
+                    self._last_finish.clear()
+                fut.set_result(None)
+                return
+        self._in_flight -= 1
+
+    def stats(self) -> dict[str, float]:
+        return {
+            'in_flight': self._in_flight,
+            'queue_depth': self._waiting,
+            'max_in_flight': self.max_in_flight,
+            'max_queue': self.max_queue,
+            'admitted': self.admitted,
+            'queued': self.queued,
+            'rejected': self.rejected,
+            'timed_out': self.timed_out,
+            'avg_wait_seconds': self.total_wait_seconds / self.admitted if self.admitted else 0.0,
+            'max_wait_seconds': self.max_wait_seconds,
+            'avg_service_seconds': self._avg_service_seconds,
+        }
@@ -0,0 +1,228 @@
+import hashlib
+import json
+import math
+import os
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Optional, Union
+
+from loguru import logger
+
+from app.admission import AdmissionRejected
+from app.metrics import KEY_REQUESTS, KEY_TOKENS
+from app.models import Usage, ToolCall
+
+
+class TokenBucket:
+    """令牌桶: 每秒补充 rate 个令牌，最多积累 capacity 个"""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated_at')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self) -> float:
+        """取一个令牌，成功返回 0，否则返回需要等待的秒数"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class ApiKey:
+    """
+    一个 API key 的限额与用量
+
+    限额:
+        rps             每秒请求数(令牌桶补充速率)，0 表示不限制
+        burst           令牌桶容量，默认与 rps 相同(至少 1)
+        max_concurrent  同时进行的请求(流)数，0 表示不限制
+        weight          并发已满排队时的权重
+    """
+
+    def __init__(self, name: str, rps: float = 0, burst: float = 0, max_concurrent: int = 0, weight: float = 1.0):
+        self.name = name
+        self.in_flight = 0
+        self.requests = 0
+        self.rejected = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.bucket: Optional[TokenBucket] = None
+        self.configure(rps, burst, max_concurrent, weight)
+
+    def configure(self, rps: float = 0, burst: float = 0, max_concurrent: int = 0, weight: float = 1.0):
+        """更新限额，保留用量统计与进行中的请求数"""
+        self.rps = rps
+        self.burst = burst or max(rps, 1)
+        self.max_concurrent = max_concurrent
+        self.weight = weight
+        if rps <= 0:
+            self.bucket = None
+        elif self.bucket is None:
+            self.bucket = TokenBucket(rps, self.burst)
+        else:
+            self.bucket.rate = rps
+            self.bucket.capacity = self.burst
+
+    def acquire(self) -> 'KeyLease':
+        """
+        检查限额并占用一个并发名额
+
+        Raises:
+            AdmissionRejected: 超过每秒请求数或并发数限制
+        """
+        if self.max_concurrent and self.in_flight >= self.max_concurrent:
+            self._reject('concurrency')
+            raise AdmissionRejected(f"API key {self.name} 并发请求数已达上限 {self.max_concurrent}", 1)
+        if self.bucket is not None:
+            wait = self.bucket.take()
+            if wait > 0:
+                self._reject('rate')
+                raise AdmissionRejected(f"API key {self.name} 请求过于频繁(每秒 {self.rps} 次)", math.ceil(wait))
+        self.requests += 1
+        self.in_flight += 1
+        KEY_REQUESTS.inc(self.name, 'admitted')
+        return KeyLease(self)
+
+    def _reject(self, reason: str):
+        self.rejected += 1
+        KEY_REQUESTS.inc(self.name, reason)
+
+    def record_usage(self, usage: Usage):
+        self.prompt_tokens += usage.prompt_tokens or 0
+        self.completion_tokens += usage.completion_tokens or 0
+        KEY_TOKENS.inc(self.name, 'prompt', amount=usage.prompt_tokens or 0)
+        KEY_TOKENS.inc(self.name, 'completion', amount=usage.completion_tokens or 0)
+
+    async def track_usage(self, generator: AsyncIterator[Union[str, Usage, ToolCall]]) \
+            -> AsyncIterator[Union[str, Usage, ToolCall]]:
+        """透传输出，把其中的 Usage 计入该 key 的用量"""
+        async with aclosing(generator):
+            async for chunk in generator:
+                if isinstance(chunk, Usage):
+                    self.record_usage(chunk)
+                yield chunk
+
+    def stats(self) -> dict:
+        return {
+            'in_flight': self.in_flight,
+            'requests': self.requests,
+            'rejected': self.rejected,
+            'prompt_tokens': self.prompt_tokens,
+            'completion_tokens': self.completion_tokens,
+        }
+
+
+class KeyLease:
+    """一个请求占用的 key 并发名额，release 可重复调用"""
+
+    __slots__ = ('key', '_released')
+
+    def __init__(self, key: ApiKey):
+        self.key = key
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.key.in_flight -= 1
+
+
+class ApiKeyRegistry:
+    """
+    API key 列表: API_KEY 始终有效且不限额，其余 key 从 JSON 文件读取，文件修改后自动重新加载
+
+    文件格式(key 为请求时使用的 Bearer Token，name 用于统计与日志，不能重复，未填写时取 token 哈希的前 8 位；
+    其余字段见 ApiKey):
+        {
+            "sk-batch": {"name": "batch", "rps": 2, "max_concurrent": 4, "weight": 1},
+            "sk-ui": {"name": "ui", "rps": 10, "burst": 20, "weight": 4}
+        }
+    """
+
+    def __init__(self, default_key: str, path: str = '', reload_interval: float = 1.0):
+        """
+        Args:
+            default_key: 不限额的默认 key(API_KEY)
+            path: key 文件路径，为空时只使用默认 key
+            reload_interval: 检查文件是否修改的最小间隔(秒)
+        """
+        self.default_key = default_key
+        self.path = path
+        self.reload_interval = reload_interval
+        self.keys: dict[str, ApiKey] = {default_key: ApiKey('default')}
+        self._mtime = None
+        self._checked_at = 0.0
+        self.reloads = 0
+        self._maybe_reload()
+
+    def _maybe_reload(self):
+        if not self.path:
+            return
+        now = time.monotonic()
+        if now - self._checked_at < self.reload_interval:
+            return
+        self._checked_at = now
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError as e:
+            if self._mtime is not None:
+                logger.warning(f"读取 API key 文件失败，继续使用当前配置: {e}")
+            return
+        if mtime == self._mtime:
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+            self._load(entries)
+        except (OSError, ValueError, TypeError, AttributeError) as e:
+            logger.warning(f"API key 文件无效，继续使用当前配置: {e}")
+            return
+        finally:
+            self._mtime = mtime
+        self.reloads += 1
+        logger.info(f"已加载 {len(self.keys)} 个 API key")
+
+    def _load(self, entries: dict):
+        """先校验整个文件，全部有效才替换当前配置，任何一项无效时抛出异常、保持原配置不变"""
+        parsed = {}
+        names = {'default'}
+        for token, options in entries.items():
+            options = dict(options)
+            # name 会出现在日志与指标标签中，默认值不能泄露 token 本身
+            name = str(options.pop('name', None) or f"key-{hashlib.sha256(token.encode('utf-8')).hexdigest()[:8]}")
+            if name in names:
+                raise ValueError(f"API key 名称重复: {name}")
+            names.add(name)
+            # 构造一次以校验字段
+            parsed[token] = (name, options, ApiKey(name, **options))
+
+        keys = {self.default_key: self.keys.get(self.default_key) or ApiKey('default')}
+        for token, (name, options, key) in parsed.items():
+            existing = self.keys.get(token)
+            if existing is not None:
+                # 保留进行中的请求数与用量
+                existing.name = name
+                existing.configure(**options)
+                key = existing
+            keys[token] = key
+        self.keys = keys
+
+    def authenticate(self, token: str) -> Optional[ApiKey]:
+        self._maybe_reload()
+        return self.keys.get(token)
+
+    def find(self, name: str) -> Optional[ApiKey]:
+        """按名称查找 key(批处理记录的是所属 key 的名称而不是 token)"""
+        self._maybe_reload()
+        return next((key for key in self.keys.values() if key.name == name), None)
+
+    def stats(self) -> dict:
+        return {key.name: key.stats() for key in self.keys.values()}
@@ -0,0 +1,582 @@
+import asyncio
+import copy
+import email.policy
+import json
+import os
+import re
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from email.parser import BytesParser
+from typing import IO, Awaitable, Callable, Optional
+
+from loguru import logger
+from pydantic import ValidationError
+
+from app.models import ChatCompletionRequest
+
+try:
+    import fcntl
+except ImportError:  # Windows 没有 flock，只支持单个工作进程
+    fcntl = None
+
+ENDPOINT = '/v1/chat/completions'
+# 完成时限，超过后不再发起剩余请求
+COMPLETION_WINDOWS = {'24h': 24 * 3600}
+# 仍需调度器继续执行的状态，重启后自动恢复
+ACTIVE_STATUSES = frozenset({'validating', 'in_progress', 'finalizing', 'cancelling'})
+# 状态元数据最多每隔该秒数写一次磁盘(状态变化时立即写)
+SAVE_INTERVAL = 1.0
+# 多个工作进程共用数据目录时，只有持有该锁文件的进程执行批处理
+LOCK_FILE = '.scheduler.lock'
+# 巡检间隔(秒): 未持有锁的进程尝试接管，持有锁的进程加载其他进程创建的批处理与取消请求
+WATCH_INTERVAL = 1.0
+_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+
+class BatchError(Exception):
+    """批处理接口的请求错误，由 main 转换为对应状态码的 HTTP 响应"""
+
+    def __init__(self, message: str, status_code: int = 400):
+        self.message = message
+        self.status_code = status_code
+
+    def __str__(self) -> str:
+        return self.message
+
+
+def parse_multipart(content_type: str, body: bytes) -> dict[str, tuple[Optional[str], bytes]]:
+    """
+    解析 multipart/form-data 请求体(不依赖 python-multipart)
+
+    Returns:
+        {字段名: (文件名, 内容)}，普通字段的文件名为 None
+    """
+    if not content_type.lower().startswith('multipart/form-data'):
+        raise BatchError('请求体必须是 multipart/form-data')
+    header = b'Content-Type: ' + content_type.encode('latin-1') + b'\r\n\r\n'
+    message = BytesParser(policy=email.policy.HTTP).parsebytes(header + body)
+    if not message.is_multipart():
+        raise BatchError('无法解析 multipart 请求体')
+    fields = {}
+    for part in message.iter_parts():
+        name = part.get_param('name', header='content-disposition')
+        if name:
+            fields[name] = (part.get_filename(), part.get_payload(decode=True) or b'')
+    return fields
+
+
+def _new_id(prefix: str) -> str:
+    return f'{prefix}{uuid.uuid4().hex[:24]}'
+
+
+def _write_json(path: str, data: dict):
+    """先写临时文件再替换，进程中途退出也不会留下半个文件"""
+    tmp = f'{path}.tmp'
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _open_results(output_path: str, error_path: str) -> tuple[IO[str], IO[str]]:
+    output = open(output_path, 'a', encoding='utf-8')
+    try:
+        return output, open(error_path, 'a', encoding='utf-8')
+    except OSError:
+        output.close()
+        raise
+
+
+def _close_results(output: IO[str], error: IO[str]):
+    output.close()
+    error.close()
+
+
+def _append_line(target: IO[str], line: dict):
+    target.write(json.dumps(line, ensure_ascii=False) + '\n')
+    target.flush()
+
+
+def _touch(path: str):
+    open(path, 'w').close()
+
+
+def _recover_lines(path: str) -> set[str]:
+    """读取结果文件中已完成请求的 custom_id，截掉中途退出时写了一半的末行"""
+    if not os.path.exists(path):
+        return set()
+    with open(path, 'rb') as f:
+        data = f.read()
+    end = data.rfind(b'\n') + 1
+    if end < len(data):
+        with open(path, 'r+b') as f:
+            f.truncate(end)
+    done = set()
+    for line in data[:end].splitlines():
+        try:
+            done.add(json.loads(line)['custom_id'])
+        except (ValueError, KeyError, TypeError):
+            continue
+    return done
+
+
+class FileStore:
+    """上传与输出文件: {id}.jsonl 为内容，{id}.json 为文件对象(含所属 key)"""
+
+    def __init__(self, directory: str, writer: Optional[ThreadPoolExecutor] = None):
+        """
+        Args:
+            directory: 保存文件的目录
+            writer: 执行写入的线程池，为空时使用默认线程池
+        """
+        self.directory = directory
+        self.writer = writer
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, file_id: str) -> str:
+        if not _ID_PATTERN.match(file_id):
+            raise BatchError(f'文件不存在: {file_id}', 404)
+        return os.path.join(self.directory, f'{file_id}.jsonl')
+
+    async def create(self, content: bytes, filename: str, purpose: str, owner: str) -> dict:
+        return await self._write(self._create, content, filename, purpose, owner)
+
+    async def register(self, file_id: str, filename: str, purpose: str, owner: str) -> dict:
+        """为已写入内容的文件(如批处理输出)创建文件对象"""
+        return await self._write(self._register, file_id, filename, purpose, owner)
+
+    async def _write(self, func, *args):
+        """文件写入在线程中执行，不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(self.writer, func, *args)
+
+    def _create(self, content: bytes, filename: str, purpose: str, owner: str) -> dict:
+        file_id = _new_id('file-')
+        with open(self.path(file_id), 'wb') as f:
+            f.write(content)
+        return self._register(file_id, filename, purpose, owner)
+
+    def _register(self, file_id: str, filename: str, purpose: str, owner: str) -> dict:
+        info = {
+            'id': file_id,
+            'object': 'file',
+            'bytes': os.path.getsize(self.path(file_id)),
+            'created_at': int(time.time()),
+            'filename': filename,
+            'purpose': purpose,
+        }
+        _write_json(os.path.join(self.directory, f'{file_id}.json'), {'file': info, 'owner': owner})
+        return info
+
+    def get(self, file_id: str, owner: str) -> dict:
+        meta_path = os.path.join(self.directory, f'{file_id}.json') if _ID_PATTERN.match(file_id) else ''
+        try:
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            raise BatchError(f'文件不存在: {file_id}', 404)
+        if meta['owner'] != owner:
+            raise BatchError(f'文件不存在: {file_id}', 404)
+        return meta['file']
+
+
+class Batch:
+    """一个批处理任务: info 为对外返回的 batch 对象，其余为内部状态"""
+
+    def __init__(self, info: dict, owner: str, output_file_id: str, error_file_id: str):
+        self.info = info
+        self.owner = owner
+        self.output_file_id = output_file_id
+        self.error_file_id = error_file_id
+        self.saved_at = 0.0
+
+    @property
+    def id(self) -> str:
+        return self.info['id']
+
+    @property
+    def status(self) -> str:
+        return self.info['status']
+
+    def transition(self, status: str):
+        self.info['status'] = status
+        self.info[f'{status}_at'] = int(time.time())
+
+    def dumps(self) -> dict:
+        return {'batch': self.info, 'owner': self.owner, 'output_file_id': self.output_file_id,
+                'error_file_id': self.error_file_id}
+
+    @classmethod
+    def loads(cls, data: dict) -> 'Batch':
+        return cls(data['batch'], data['owner'], data['output_file_id'], data['error_file_id'])
+
+
+class BatchScheduler:
+    """
+    批处理调度器
+
+    每个批处理由一个后台任务按输入顺序发起请求，所有批处理共用 concurrency 个并发名额。
+    每完成一个请求立即追加到输出(或错误)文件，重启后读取这些文件跳过已完成的请求，从中断处继续。
+
+    多个工作进程共用数据目录时，由持有锁文件的一个进程执行全部批处理；其他进程创建的批处理与取消请求
+    写入目录，由该进程在巡检时接手。查询时不在本进程内存中的批处理从磁盘读取，任一进程都能回答。
+    """
+
+    def __init__(self, directory: str, concurrency: int,
+                 run: Callable[[ChatCompletionRequest, str], Awaitable[tuple[int, dict]]],
+                 paused: Callable[[], bool] = lambda: False):
+        """
+        Args:
+            directory: 保存文件与批处理状态的目录
+            concurrency: 同时执行的请求数上限
+            run: 执行一个请求，参数为请求与所属 key 名称，返回 (状态码, 响应体)
+            paused: 返回 True 时暂停发起新请求(如服务正在关闭)
+        """
+        self.directory = directory
+        # 所有文件写入都交给同一个线程按提交顺序执行，同一批处理的状态与结果不会乱序或同时写入
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='batch-writer')
+        self.files = FileStore(os.path.join(directory, 'files'), self._writer)
+        self.batch_dir = os.path.join(directory, 'batches')
+        os.makedirs(self.batch_dir, exist_ok=True)
+        self.concurrency = concurrency
+        self.run = run
+        self.paused = paused
+        self._batches: dict[str, Batch] = {}
+        self._runners: dict[str, asyncio.Task] = {}
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._lock_file = None
+        self._watcher: Optional[asyncio.Task] = None
+        self.is_owner = False
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+
+    async def start(self):
+        """获取锁的进程加载已有的批处理并继续执行未结束的，其余进程定期尝试接管"""
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._lock_file = await asyncio.to_thread(open, os.path.join(self.directory, LOCK_FILE), 'a')
+        await self._try_own()
+        self._watcher = asyncio.create_task(self._watch())
+
+    async def close(self):
+        """停止调度并释放锁，进行中的请求在重启(或其他进程接管)后重新执行"""
+        if self._watcher is not None:
+            self._watcher.cancel()
+            await asyncio.gather(self._watcher, return_exceptions=True)
+        runners = list(self._runners.values())
+        for runner in runners:
+            runner.cancel()
+        await asyncio.gather(*runners, return_exceptions=True)
+        for batch in self._batches.values():
+            await self._save(batch)
+        await asyncio.to_thread(self._writer.shutdown)
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
+        self.is_owner = False
+
+    async def _try_own(self):
+        if fcntl is not None:
+            try:
+                fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return
+        self.is_owner = True
+        logger.info(f"本进程负责执行 {self.directory} 中的批处理")
+        await self._scan()
+
+    async def _watch(self):
+        while True:
+            await asyncio.sleep(WATCH_INTERVAL)
+            try:
+                if self.is_owner:
+                    await self._scan()
+                else:
+                    await self._try_own()
+            except Exception as e:
+                logger.exception(f"批处理巡检出错: {e}")
+
+    async def _scan(self):
+        """加载尚未接手的批处理(继续执行未结束的)，并处理其他进程写入的取消请求"""
+        names = sorted(os.listdir(self.batch_dir))
+        for name in names:
+            batch_id, ext = os.path.splitext(name)
+            if ext != '.json' or batch_id in self._batches:
+                continue
+            batch = self._read(batch_id)
+            if batch is None:
+                continue
+            self._batches[batch.id] = batch
+            if batch.status in ACTIVE_STATUSES:
+                logger.info(f"执行批处理 {batch.id}: {batch.info['request_counts']}")
+                self._spawn(batch)
+        for name in names:
+            batch_id, ext = os.path.splitext(name)
+            if ext != '.cancel':
+                continue
+            batch = self._batches.get(batch_id)
+            if batch is not None:
+                await self._cancel(batch)
+            await self._write(os.remove, os.path.join(self.batch_dir, name))
+
+    def _read(self, batch_id: str) -> Optional[Batch]:
+        try:
+            with open(os.path.join(self.batch_dir, f'{batch_id}.json'), 'r', encoding='utf-8') as f:
+                return Batch.loads(json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logger.warning(f"跳过无法读取的批处理状态 {batch_id}: {e}")
+            return None
+
+    def _lookup(self, batch_id: str, owner: str) -> Batch:
+        """本进程执行的批处理取内存中的状态，其余从磁盘读取"""
+        batch = self._batches.get(batch_id)
+        if batch is None and _ID_PATTERN.match(batch_id):
+            batch = self._read(batch_id)
+        if batch is None or batch.owner != owner:
+            raise BatchError(f'批处理不存在: {batch_id}', 404)
+        return batch
+
+    def _spawn(self, batch: Batch):
+        runner = asyncio.create_task(self._run(batch))
+        self._runners[batch.id] = runner
+        runner.add_done_callback(lambda _: self._runners.pop(batch.id, None))
+
+    async def _write(self, func, *args):
+        """在写入线程中执行文件操作，不阻塞事件循环"""
+        return await asyncio.get_running_loop().run_in_executor(self._writer, func, *args)
+
+    async def _save(self, batch: Batch, force: bool = True):
+        now = time.monotonic()
+        if not force and now - batch.saved_at < SAVE_INTERVAL:
+            return
+        batch.saved_at = now
+        # 写入期间事件循环仍会更新状态，交给写入线程的是一份副本
+        await self._write(_write_json, os.path.join(self.batch_dir, f'{batch.id}.json'), copy.deepcopy(batch.dumps()))
+
+    async def create(self, input_file_id: str, endpoint: str, completion_window: str, metadata: Optional[dict],
+               owner: str) -> dict:
+        if endpoint != ENDPOINT:
+            raise BatchError(f'不支持的 endpoint: {endpoint}，仅支持 {ENDPOINT}')
+        if completion_window not in COMPLETION_WINDOWS:
+            raise BatchError(f'不支持的 completion_window: {completion_window}')
+        input_file = self.files.get(input_file_id, owner)
+        if input_file['purpose'] != 'batch':
+            raise BatchError(f'文件 {input_file_id} 的 purpose 不是 batch')
+        now = int(time.time())
+        info = {
+            'id': _new_id('batch_'),
+            'object': 'batch',
+            'endpoint': endpoint,
+            'errors': None,
+            'input_file_id': input_file_id,
+            'completion_window': completion_window,
+            'status': 'validating',
+            'output_file_id': None,
+            'error_file_id': None,
+            'created_at': now,
+            'in_progress_at': None,
+            'expires_at': now + COMPLETION_WINDOWS[completion_window],
+            'finalizing_at': None,
+            'completed_at': None,
+            'failed_at': None,
+            'expired_at': None,
+            'cancelling_at': None,
+            'cancelled_at': None,
+            'request_counts': {'total': 0, 'completed': 0, 'failed': 0},
+            'metadata': metadata,
+        }
+        batch = Batch(info, owner, _new_id('file-'), _new_id('file-'))
+        await self._save(batch)
+        if self.is_owner:
+            self._batches[batch.id] = batch
+            self._spawn(batch)
+        return info
+
+    def get(self, batch_id: str, owner: str) -> dict:
+        return self._lookup(batch_id, owner).info
+
+    def list_batches(self, owner: str, limit: int = 20, after: Optional[str] = None) -> dict:
+        """按创建时间倒序分页"""
+        batches = dict(self._batches)
+        for name in os.listdir(self.batch_dir):
+            batch_id, ext = os.path.splitext(name)
+            if ext == '.json' and batch_id not in batches:
+                batch = self._read(batch_id)
+                if batch is not None:
+                    batches[batch_id] = batch
+        batches = sorted((b for b in batches.values() if b.owner == owner),
+                         key=lambda b: b.info['created_at'], reverse=True)
+        ids = [b.id for b in batches]
+        start = ids.index(after) + 1 if after in ids else 0
+        page = [b.info for b in batches[start:start + limit]]
+        return {
+            'object': 'list',
+            'data': page,
+            'first_id': page[0]['id'] if page else None,
+            'last_id': page[-1]['id'] if page else None,
+            'has_more': start + limit < len(batches),
+        }
+
+    async def cancel(self, batch_id: str, owner: str) -> dict:
+        batch = self._lookup(batch_id, owner)
+        if batch.id in self._batches:
+            await self._cancel(batch)
+        elif batch.status in ('validating', 'in_progress'):
+            # 由执行批处理的进程在巡检时取消，返回的是预期状态
+            await self._write(_touch, os.path.join(self.batch_dir, f'{batch.id}.cancel'))
+            batch.transition('cancelling')
+        return batch.info
+
+    async def _cancel(self, batch: Batch):
+        if batch.status in ('validating', 'in_progress'):
+            # 不再发起新请求，进行中的请求结束后变为 cancelled
+            batch.transition('cancelling')
+            await self._save(batch)
+
+    def _parse_input(self, batch: Batch) -> tuple[list[tuple[str, ChatCompletionRequest]], list[dict]]:
+        """解析输入文件，返回 (请求列表, 校验错误)"""
+        requests, errors, seen = [], [], set()
+        with open(self.files.path(batch.info['input_file_id']), 'r', encoding='utf-8') as f:
+            for number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    item = json.loads(line)
+                    custom_id = item['custom_id']
+                    if not isinstance(custom_id, str):
+                        raise ValueError('custom_id 必须是字符串')
+                    if custom_id in seen:
+                        raise ValueError(f'custom_id 重复: {custom_id}')
+                    if item.get('method', 'POST') != 'POST' or item.get('url') != batch.info['endpoint']:
+                        raise ValueError(f"method 必须为 POST，url 必须为 {batch.info['endpoint']}")
+                    request = ChatCompletionRequest.model_validate(item['body'])
+                except (ValueError, KeyError, TypeError, ValidationError) as e:
+                    errors.append({'code': 'invalid_request', 'message': str(e), 'param': None, 'line': number})
+                    continue
+                seen.add(custom_id)
+                # 批处理只返回完整响应
+                requests.append((custom_id, request.model_copy(update={'stream': False})))
+        return requests, errors
+
+    async def _run(self, batch: Batch):
+        try:
+            requests, errors = await asyncio.to_thread(self._parse_input, batch)
+            if batch.status == 'validating':
+                if errors or not requests:
+                    batch.info['errors'] = {'object': 'list',
+                                            'data': errors or [{'code': 'empty_file', 'message': '输入文件为空',
+                                                                'param': None, 'line': None}]}
+                    batch.transition('failed')
+                    await self._save(batch)
+                    return
+                batch.info['request_counts']['total'] = len(requests)
+                batch.transition('in_progress')
+                await self._save(batch)
+
+            output_path = self.files.path(batch.output_file_id)
+            error_path = self.files.path(batch.error_file_id)
+            succeeded = await self._write(_recover_lines, output_path)
+            failed = await self._write(_recover_lines, error_path)
+            batch.info['request_counts'].update(completed=len(succeeded), failed=len(failed))
+            done = succeeded | failed
+
+            output, error = await self._write(_open_results, output_path, error_path)
+            tasks: set[asyncio.Task] = set()
+            try:
+                for custom_id, request in requests:
+                    if custom_id in done:
+                        continue
+                    while self.paused() and batch.status == 'in_progress':
+                        await asyncio.sleep(1)
+                    if batch.status != 'in_progress':
+                        break
+                    if time.time() > batch.info['expires_at']:
+                        batch.transition('expired')
+                        break
+                    await self._slots.acquire()
+                    task = asyncio.create_task(self._execute(batch, custom_id, request, output, error))
+                    tasks.add(task)
+                    task.add_done_callback(tasks.discard)
+                if tasks:
+                    await asyncio.wait(set(tasks))
+            finally:
+                # 先结束进行中的请求再关闭结果文件(已提交的写入会在关闭前完成)
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await self._write(_close_results, output, error)
+
+            if batch.status == 'in_progress':
+                batch.transition('finalizing')
+                await self._save(batch)
+            await self._finalize(batch)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception(f"批处理 {batch.id} 执行出错: {e}")
+            batch.info['errors'] = {'object': 'list',
+                                    'data': [{'code': 'internal_error', 'message': str(e), 'param': None,
+                                              'line': None}]}
+            batch.transition('failed')
+            await self._save(batch)
+
+    async def _execute(self, batch: Batch, custom_id: str, request: ChatCompletionRequest, output: IO[str],
+                       error: IO[str]):
+        self.in_flight += 1
+        try:
+            try:
+                status_code, body = await self.run(request, batch.owner)
+            except Exception as e:
+                logger.exception(f"批处理请求 {custom_id} 出错: {e}")
+                status_code, body = 500, {'error': {'message': str(e), 'type': 'internal_error',
+                                                    'code': 'internal_error'}}
+            line = {
+                'id': _new_id('batch_req_'),
+                'custom_id': custom_id,
+                'response': {'status_code': status_code, 'request_id': body.get('id') or _new_id('req_'),
+                             'body': body},
+                'error': None,
+            }
+            counts = batch.info['request_counts']
+            if status_code == 200:
+                target = output
+                counts['completed'] += 1
+                self.completed += 1
+            else:
+                target = error
+                counts['failed'] += 1
+                self.failed += 1
+            await self._write(_append_line, target, line)
+            await self._save(batch, force=False)
+        finally:
+            self.in_flight -= 1
+            self._slots.release()
+
+    async def _finalize(self, batch: Batch):
+        """登记输出文件并进入最终状态"""
+        counts = batch.info['request_counts']
+        if counts['completed']:
+            output = await self.files.register(batch.output_file_id, f'{batch.id}_output.jsonl', 'batch_output',
+                                               batch.owner)
+            batch.info['output_file_id'] = output['id']
+        if counts['failed']:
+            error = await self.files.register(batch.error_file_id, f'{batch.id}_error.jsonl', 'batch_output',
+                                              batch.owner)
+            batch.info['error_file_id'] = error['id']
+        if batch.status == 'finalizing':
+            batch.transition('completed')
+        elif batch.status == 'cancelling':
+            batch.transition('cancelled')
+        await self._save(batch)
+        logger.info(f"批处理 {batch.id} {batch.status}: {counts}")
+
+    def stats(self) -> dict:
+        return {
+            'owner': self.is_owner,
+            'batches': len(self._batches),
+            'running': len(self._runners),
+            'in_flight': self.in_flight,
+            'completed': self.completed,
+            'failed': self.failed,
+        }
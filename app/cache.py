@@ -0,0 +1,78 @@
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class LRUCache:
+    """
+    按条目数与占用大小限制的 LRU 缓存
+
+    超出任一限制时从最久未使用的条目开始淘汰，并记录命中/未命中次数。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int = 0, sizeof: Optional[Callable[[Any], int]] = None):
+        """
+        Args:
+            max_entries: 最大条目数，0 表示禁用缓存
+            max_bytes: 最大占用大小，0 表示不限制
+            sizeof: 计算条目占用大小的函数，未提供时按 1 计
+        """
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self._data: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[0]
+
+    def set(self, key: Hashable, value: Any):
+        if self.max_entries <= 0:
+            return
+        size = self.sizeof(value) if self.sizeof else 1
+        if self.max_bytes and size > self.max_bytes:
+            # 单个条目超过上限，不缓存
+            return
+        old = self._data.pop(key, None)
+        if old is not None:
+            self._bytes -= old[1]
+        self._data[key] = (value, size)
+        self._bytes += size
+        while len(self._data) > self.max_entries or (self.max_bytes and self._bytes > self.max_bytes):
+            _, (_, evicted_size) = self._data.popitem(last=False)
+            self._bytes -= evicted_size
+            self.evictions += 1
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        item = self._data.pop(key, None)
+        if item is None:
+            return default
+        self._bytes -= item[1]
+        return item[0]
+
+    def clear(self):
+        self._data.clear()
+        self._bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self._data
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'entries': len(self._data),
+            'bytes': self._bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
@@ -0,0 +1,206 @@
+import math
+import time
+from collections import deque
+from contextlib import asynccontextmanager, AsyncExitStack
+from typing import AsyncContextManager, AsyncIterator, Optional, TypeVar
+
+from curl_cffi.requests.exceptions import RequestException
+from loguru import logger
+
+from app.errors import CursorWebError
+
+T = TypeVar('T')
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+# /metrics 中的状态编码
+STATE_CODES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+# 请求本身有误导致的上游错误，不代表上游故障
+REQUEST_ERROR_STATUS_CODES = frozenset({400, 401, 404, 413, 422})
+
+
+def is_upstream_failure(error: BaseException) -> bool:
+    """网络错误、5xx、Cloudflare 拦截、429 与非事件流响应计为上游故障"""
+    if isinstance(error, CursorWebError):
+        return error.status_code not in REQUEST_ERROR_STATUS_CODES
+    return isinstance(error, RequestException)
+
+
+class CircuitOpenError(Exception):
+    """熔断器打开，直接拒绝请求而不访问上游"""
+
+    def __init__(self, message: str, retry_after: int):
+        self.message = message
+        self.retry_after = retry_after
+
+    def __str__(self) -> str:
+        return self.message
+
+    def to_openai_error(self) -> dict[str, dict[str, str]]:
+        return {
+            "error": {
+                "message": self.message,
+                "type": "upstream_unavailable",
+                "code": "circuit_open",
+            }
+        }
+
+
+class CircuitBreaker:
+    """
+    上游熔断器
+
+    closed: 正常放行，按秒分桶统计最近 window 秒内的成功/失败，调用数达到 min_calls 且失败率达到阈值时打开
+    open: 直接拒绝，返回最近一次失败的错误信息，open_seconds 秒后进入 half_open
+    half_open: 最多同时放行 probes 个探测请求，连续 probes 次成功则关闭，任一失败则重新打开
+    """
+
+    def __init__(self, window: float, min_calls: int, failure_rate: float, open_seconds: float, probes: int):
+        """
+        Args:
+            window: 统计失败率的时间窗口(秒)
+            min_calls: 窗口内调用数少于该值时不打开
+            failure_rate: 打开的失败率阈值
+            open_seconds: 打开后持续拒绝的秒数
+            probes: 半开状态下的探测请求数
+        """
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.open_seconds = open_seconds
+        self.probes = probes
+        self.state = CLOSED
+        # [秒, 成功数, 失败数]
+        self._buckets: deque[list] = deque()
+        self._opened_at = 0.0
+        self._probing = 0
+        self._probe_successes = 0
+        self._last_error = ''
+        self.opened = 0
+        self.rejected = 0
+
+    def _record(self, failed: bool):
+        now = int(time.monotonic())
+        if not self._buckets or self._buckets[-1][0] != now:
+            self._buckets.append([now, 0, 0])
+        self._buckets[-1][2 if failed else 1] += 1
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            self._buckets.popleft()
+
+    def _counts(self) -> tuple[int, int]:
+        now = int(time.monotonic())
+        successes = failures = 0
+        for second, s, f in self._buckets:
+            if second > now - self.window:
+                successes += s
+                failures += f
+        return successes, failures
+
+    def _transition(self, state: str):
+        if state == self.state:
+            return
+        logger.warning(f"上游熔断器: {self.state} -> {state}")
+        self.state = state
+        if state == OPEN:
+            self.opened += 1
+            self._opened_at = time.monotonic()
+        elif state == CLOSED:
+            self._buckets.clear()
+        self._probing = 0
+        self._probe_successes = 0
+
+    def retry_after(self) -> int:
+        return max(math.ceil(self._opened_at + self.open_seconds - time.monotonic()), 1)
+
+    @property
+    def rejecting(self) -> bool:
+        """是否处于打开且尚未到探测时间，用于在准入之前快速拒绝(不占用探测名额)"""
+        return self.state == OPEN and time.monotonic() - self._opened_at < self.open_seconds
+
+    def rejection(self) -> CircuitOpenError:
+        self.rejected += 1
+        return CircuitOpenError(f"上游连续出错，暂停请求 {self.retry_after()} 秒: {self._last_error}",
+                                self.retry_after())
+
+    def acquire(self):
+        """访问上游前调用，拒绝时抛出 CircuitOpenError；放行后必须调用 record_success / record_failure 之一"""
+        if self.state == OPEN:
+            if self.rejecting:
+                raise self.rejection()
+            self._transition(HALF_OPEN)
+        if self.state == HALF_OPEN:
+            if self._probing >= self.probes:
+                raise self.rejection()
+            self._probing += 1
+
+    def record_success(self):
+        if self.state == HALF_OPEN:
+            self._probing -= 1
+            self._probe_successes += 1
+            if self._probe_successes >= self.probes:
+                self._transition(CLOSED)
+            return
+        self._record(False)
+
+    def record_failure(self, error: Optional[BaseException] = None):
+        if error is not None:
+            self._last_error = str(error)
+        if self.state == HALF_OPEN:
+            self._transition(OPEN)
+            return
+        if self.state == OPEN:
+            return
+        self._record(True)
+        successes, failures = self._counts()
+        calls = successes + failures
+        if calls >= self.min_calls and failures / calls >= self.failure_rate:
+            self._transition(OPEN)
+
+    @asynccontextmanager
+    async def guard(self, upstream: AsyncContextManager[T]) -> AsyncIterator[T]:
+        """
+        包装打开上游的上下文管理器: 进入时出错计为失败；读取事件流的过程中出现上游故障(如 200 响应中的
+        error 事件、读取超时)同样计为失败，否则在事件流读完(或被下游提前关闭)时计为成功
+        """
+        self.acquire()
+        async with AsyncExitStack() as stack:
+            try:
+                value = await stack.enter_async_context(upstream)
+            except Exception as e:
+                if is_upstream_failure(e):
+                    self.record_failure(e)
+                else:
+                    self.release()
+                raise
+            except BaseException:
+                self.release()
+                raise
+            try:
+                yield value
+            except Exception as e:
+                if is_upstream_failure(e):
+                    self.record_failure(e)
+                else:
+                    self.record_success()
+                raise
+            except BaseException:
+                self.record_success()
+                raise
+            self.record_success()
+
+    def release(self):
+        """放行后未能得出结果(如请求被取消)时归还探测名额"""
+        if self.state == HALF_OPEN and self._probing > 0:
+            self._probing -= 1
+
+    def stats(self) -> dict:
+        successes, failures = self._counts()
+        return {
+            'state': self.state,
+            'state_code': STATE_CODES[self.state],
+            'window_successes': successes,
+            'window_failures': failures,
+            'opened': self.opened,
+            'rejected': self.rejected,
+        }
@@ -10,10 +10,14 @@ FP = json.loads(decode_base64url_safe(os.environ.get("FP",
                                                      "eyJVTk1BU0tFRF9WRU5ET1JfV0VCR0wiOiJHb29nbGUgSW5jLiAoSW50ZWwpIiwiVU5NQVNLRURfUkVOREVSRVJfV0VCR0wiOiJBTkdMRSAoSW50ZWwsIEludGVsKFIpIFVIRCBHcmFwaGljcyAoMHgwMDAwOUJBNCkgRGlyZWN0M0QxMSB2c181XzAgcHNfNV8wLCBEM0QxMS0yNi4yMC4xMDAuNzk4NSkiLCJ1c2VyQWdlbnQiOiJNb3ppbGxhLzUuMCAoV2luZG93cyBOVCAxMC4wOyBXaW42NDsgeDY0KSBBcHBsZVdlYktpdC81MzcuMzYgKEtIVE1MLCBsaWtlIEdlY2tvKSBDaHJvbWUvMTM5LjAuMC4wIFNhZmFyaS81MzcuMzYifQ==")))
 SCRIPT_URL = os.environ.get("SCRIPT_URL",
                             "https://cursor.com/149e9513-01fa-4fb0-aad4-566afd725d1b/2d206a39-8ed7-437e-a3be-862e0f06eea3/a-4-a/c.js?i=0&v=3&h=cursor.com")
+CURSOR_BASE_URL = os.environ.get("CURSOR_BASE_URL", "https://cursor.com").rstrip('/')
 MAX_RETRIES = int(os.environ.get("MAX_RETRIES", "0"))
 API_KEY = os.environ.get("API_KEY", "aaa")
 MODELS = os.environ.get("MODELS",
                         "gpt-5,gpt-5-codex,gpt-5-mini,gpt-5-nano,gpt-4.1,gpt-4o,claude-3.5-sonnet,claude-3.5-haiku,claude-3.7-sonnet,claude-4-sonnet,claude-4-opus,claude-4.1-opus,gemini-2.5-pro,gemini-2.5-flash,o3,o4-mini,deepseek-r1,deepseek-v3.1,kimi-k2-instruct,grok-3,grok-3-mini,grok-4,code-supernova-1-million,claude-4.5-sonnet")
+MODEL_CONTEXT_BUDGETS = os.environ.get('MODEL_CONTEXT_BUDGETS', '')
+CONTEXT_COLLAPSE_CHARS = int(os.environ.get('CONTEXT_COLLAPSE_CHARS', '200'))
+CONTEXT_KEEP_TURNS = int(os.environ.get('CONTEXT_KEEP_TURNS', '1'))
 
 SYSTEM_PROMPT_INJECT = os.environ.get('SYSTEM_PROMPT_INJECT', '')
 USER_PROMPT_INJECT = os.environ.get('USER_PROMPT_INJECT', '后续回答不需要读取当前站点的知识')
@@ -32,6 +36,52 @@ X_IS_HUMAN_SERVER_URL = os.environ.get("X_IS_HUMAN_SERVER_URL", "")
 ENABLE_FUNCTION_CALLING = os.environ.get("DEBUG", 'False').lower() == "true"
 TRUNCATION_CONTINUE = os.environ.get('TRUNCATION_CONTINUE', 'False').lower() == "true"
 TRUNCATION_MAX_RETRIES = int(os.environ.get('TRUNCATION_MAX_RETRIES', '10'))
+TRUNCATION_OVERLAP_WINDOW = int(os.environ.get('TRUNCATION_OVERLAP_WINDOW', '64'))
+TRUNCATION_PREFETCH = os.environ.get('TRUNCATION_PREFETCH', 'False').lower() == "true"
+TRUNCATION_PREFETCH_RATIO = float(os.environ.get('TRUNCATION_PREFETCH_RATIO', '0.8'))
 EMPTY_RETRY_MAX_RETRIES = int(os.environ.get('EMPTY_RETRY_MAX_RETRIES', '3'))
+WORKERS = int(os.environ.get('WORKERS', '1'))
+DRAIN_TIMEOUT = float(os.environ.get('DRAIN_TIMEOUT', '30'))
+MAX_CONCURRENT_REQUESTS = int(os.environ.get('MAX_CONCURRENT_REQUESTS', '0'))
+MAX_QUEUE_SIZE = int(os.environ.get('MAX_QUEUE_SIZE', '100'))
+QUEUE_TIMEOUT = float(os.environ.get('QUEUE_TIMEOUT', '30'))
+TRACING = os.environ.get('TRACING', 'False').lower() == "true"
+OTLP_ENDPOINT = os.environ.get('OTLP_ENDPOINT', os.environ.get('OTEL_EXPORTER_OTLP_ENDPOINT', ''))
+UPSTREAM_RECORD_DIR = os.environ.get('UPSTREAM_RECORD_DIR', '')
+UPSTREAM_REPLAY = os.environ.get('UPSTREAM_REPLAY', '')
+UPSTREAM_REPLAY_SPEED = float(os.environ.get('UPSTREAM_REPLAY_SPEED', '1'))
+CONVERSION_CACHE_SIZE = int(os.environ.get('CONVERSION_CACHE_SIZE', '4096'))
+CONVERSION_CACHE_MAX_BYTES = int(os.environ.get('CONVERSION_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+SESSION_POOL_SIZE = int(os.environ.get('SESSION_POOL_SIZE', '10'))
+SESSION_POOL_IDLE_TIMEOUT = float(os.environ.get('SESSION_POOL_IDLE_TIMEOUT', '60'))
+SESSION_POOL_MAX_LIFETIME = float(os.environ.get('SESSION_POOL_MAX_LIFETIME', '600'))
+STREAM_COALESCE = os.environ.get('STREAM_COALESCE', 'False').lower() == "true"
+STREAM_COALESCE_WINDOW_MS = int(os.environ.get('STREAM_COALESCE_WINDOW_MS', '30'))
+STREAM_COALESCE_MAX_CHARS = int(os.environ.get('STREAM_COALESCE_MAX_CHARS', '256'))
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'False').lower() == "true"
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', '1024'))
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '3600'))
+RESPONSE_CACHE_DB = os.environ.get('RESPONSE_CACHE_DB', '')
+RESPONSE_CACHE_DB_SIZE = int(os.environ.get('RESPONSE_CACHE_DB_SIZE', '100000'))
+SINGLE_FLIGHT = os.environ.get('SINGLE_FLIGHT', 'False').lower() == "true"
+HEDGE = os.environ.get('HEDGE', 'False').lower() == "true"
+HEDGE_PERCENTILE = float(os.environ.get('HEDGE_PERCENTILE', '0.95'))
+HEDGE_MIN_DELAY = float(os.environ.get('HEDGE_MIN_DELAY', '1'))
+HEDGE_MAX_DELAY = float(os.environ.get('HEDGE_MAX_DELAY', '10'))
+HEDGE_MAX_RATE = float(os.environ.get('HEDGE_MAX_RATE', '0.1'))
+RETRY_BASE_DELAY = float(os.environ.get('RETRY_BASE_DELAY', '0.5'))
+RETRY_MAX_DELAY = float(os.environ.get('RETRY_MAX_DELAY', '8'))
+RETRY_BUDGET = int(os.environ.get('RETRY_BUDGET', '5'))
+RETRY_DEADLINE = float(os.environ.get('RETRY_DEADLINE', '60'))
+CIRCUIT_BREAKER = os.environ.get('CIRCUIT_BREAKER', 'False').lower() == "true"
+CIRCUIT_WINDOW = float(os.environ.get('CIRCUIT_WINDOW', '30'))
+CIRCUIT_MIN_CALLS = int(os.environ.get('CIRCUIT_MIN_CALLS', '10'))
+CIRCUIT_FAILURE_RATE = float(os.environ.get('CIRCUIT_FAILURE_RATE', '0.5'))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('CIRCUIT_OPEN_SECONDS', '30'))
+CIRCUIT_HALF_OPEN_PROBES = int(os.environ.get('CIRCUIT_HALF_OPEN_PROBES', '3'))
+API_KEYS_FILE = os.environ.get('API_KEYS_FILE', '')
+BATCH_DIR = os.environ.get('BATCH_DIR', '')
+BATCH_CONCURRENCY = int(os.environ.get('BATCH_CONCURRENCY', '4'))
 logger.info(
-    f"环境变量配置: {FP} {SCRIPT_URL} {MAX_RETRIES} {API_KEY} {MODELS} {SYSTEM_PROMPT_INJECT} {TIMEOUT} {DEBUG} {PROXY} {X_IS_HUMAN_SERVER_URL} {ENABLE_FUNCTION_CALLING} {TRUNCATION_CONTINUE} {TRUNCATION_MAX_RETRIES} {EMPTY_RETRY_MAX_RETRIES}")
+    f"环境变量配置: {FP} {SCRIPT_URL} {CURSOR_BASE_URL} {MAX_RETRIES} {API_KEY} {MODELS} {MODEL_CONTEXT_BUDGETS} {CONTEXT_COLLAPSE_CHARS} {CONTEXT_KEEP_TURNS} {SYSTEM_PROMPT_INJECT} {TIMEOUT} {DEBUG} {PROXY} {X_IS_HUMAN_SERVER_URL} {ENABLE_FUNCTION_CALLING} {TRUNCATION_CONTINUE} {TRUNCATION_MAX_RETRIES} {TRUNCATION_OVERLAP_WINDOW} {TRUNCATION_PREFETCH} {TRUNCATION_PREFETCH_RATIO} {EMPTY_RETRY_MAX_RETRIES} {WORKERS} {DRAIN_TIMEOUT} {MAX_CONCURRENT_REQUESTS} {MAX_QUEUE_SIZE} {QUEUE_TIMEOUT} {TRACING} {OTLP_ENDPOINT} {UPSTREAM_RECORD_DIR} {UPSTREAM_REPLAY} {UPSTREAM_REPLAY_SPEED} {CONVERSION_CACHE_SIZE} {CONVERSION_CACHE_MAX_BYTES} {SESSION_POOL_SIZE} {SESSION_POOL_IDLE_TIMEOUT} {SESSION_POOL_MAX_LIFETIME} {STREAM_COALESCE} {STREAM_COALESCE_WINDOW_MS} {STREAM_COALESCE_MAX_CHARS} {RESPONSE_CACHE} {RESPONSE_CACHE_SIZE} {RESPONSE_CACHE_MAX_BYTES} {RESPONSE_CACHE_TTL} {RESPONSE_CACHE_DB} {RESPONSE_CACHE_DB_SIZE} {SINGLE_FLIGHT} {HEDGE} {HEDGE_PERCENTILE} {HEDGE_MIN_DELAY} {HEDGE_MAX_DELAY} {HEDGE_MAX_RATE} {RETRY_BASE_DELAY} {RETRY_MAX_DELAY} {RETRY_BUDGET} {RETRY_DEADLINE} {CIRCUIT_BREAKER} {CIRCUIT_WINDOW} {CIRCUIT_MIN_CALLS} {CIRCUIT_FAILURE_RATE} {CIRCUIT_OPEN_SECONDS} {CIRCUIT_HALF_OPEN_PROBES} {API_KEYS_FILE} {BATCH_DIR} {BATCH_CONCURRENCY}")
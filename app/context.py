@@ -0,0 +1,150 @@
+from typing import Optional
+
+from loguru import logger
+
+from app.metrics import CONTEXT_TRIMMED_TOKENS
+from app.models import Message
+from app.tokens import message_tokens
+
+
+def parse_budgets(spec: str) -> dict[str, int]:
+    """
+    解析 "模型:token 数" 逗号分隔的配置，* 为其余模型的默认值
+
+    例: "gpt-4o:120000,claude-4-sonnet:190000,*:60000"
+    """
+    budgets = {}
+    for item in spec.split(','):
+        model, _, tokens = item.strip().rpartition(':')
+        if model and tokens:
+            budgets[model.strip()] = int(tokens)
+    return budgets
+
+
+def _text(message: dict) -> str:
+    return message['parts'][0]['text']
+
+
+def _turns(messages: list[Message], start: int, end: int) -> list[tuple[int, int]]:
+    """
+    把 [start, end) 内的消息按轮次分组，每轮从一条普通 user 消息开始
+    工具结果与截断续写的提示不开启新一轮，续写时被续写的问题、已输出的部分回复与续写提示同属最后一轮
+    """
+    turns = []
+    turn_start = start
+    for i in range(start + 1, end):
+        m = messages[i]
+        if m.role == 'user' and not m.tool_call_id and not m.is_continuation:
+            turns.append((turn_start, i))
+            turn_start = i
+    if turn_start < end:
+        turns.append((turn_start, end))
+    return turns
+
+
+class ContextBudget:
+    """
+    按模型限制发送给上游的上下文 token 数
+
+    超出预算时依次:
+        1. 折叠较早的工具结果，只保留开头 collapse_chars 个字符
+        2. 按轮次丢弃最早的对话(一轮从一条 user 消息开始，到下一条 user 消息之前)
+    system 消息与最后 keep_turns 轮对话始终保留；全部处理后仍超出时原样发送剩余部分。
+    """
+
+    def __init__(self, budgets: dict[str, int], collapse_chars: int = 200, keep_turns: int = 1):
+        """
+        Args:
+            budgets: 模型 -> 上下文 token 预算，* 为默认值，0 或未配置表示不限制
+            collapse_chars: 折叠后的工具结果保留的字符数
+            keep_turns: 始终保留的最近对话轮数，至少为 1(当前问题所在的一轮)
+        """
+        self.budgets = budgets
+        self.collapse_chars = collapse_chars
+        self.keep_turns = max(keep_turns, 1)
+        self.requests = 0
+        self.trimmed = 0
+        self.tokens_before = 0
+        self.tokens_saved = 0
+        self.collapsed_messages = 0
+        self.dropped_messages = 0
+
+    def budget(self, model: str) -> int:
+        return self.budgets.get(model, self.budgets.get('*', 0))
+
+    def trim(self, model: str, messages: list[Message], converted: list[dict]) -> tuple[list[dict], int]:
+        """
+        Args:
+            model: 请求的模型
+            messages: 转换前的消息，用于识别角色与工具结果
+            converted: 与 messages 一一对应的 cursor 消息(可能被转换缓存共享，不能修改)
+
+        Returns:
+            (裁剪后的 cursor 消息, 节省的估算 token 数)
+        """
+        budget = self.budget(model)
+        if budget <= 0:
+            return converted, 0
+        self.requests += 1
+        tokens = [message_tokens(m) for m in converted]
+        total = before = sum(tokens)
+        self.tokens_before += before
+        if total <= budget:
+            return converted, 0
+
+        # 开头连续的 system 消息不参与裁剪
+        head = 0
+        while head < len(messages) and messages[head].role == 'system':
+            head += 1
+        turns = _turns(messages, head, len(messages))
+        if len(turns) >= self.keep_turns:
+            protected = turns[-self.keep_turns][0]
+        else:
+            protected = head
+        result: list[Optional[dict]] = list(converted)
+
+        collapsed = 0
+        for i in range(head, protected):
+            if total <= budget:
+                break
+            m = messages[i]
+            text = _text(result[i])
+            if (m.tool_call_id or m.role == 'tool') and len(text) > self.collapse_chars:
+                omitted = len(text) - self.collapse_chars
+                result[i] = {**result[i], 'parts': [{'type': 'text',
+                                                     'text': f'{text[:self.collapse_chars]}...(已省略 {omitted} 字符)'}]}
+                new_tokens = message_tokens(result[i])
+                total -= tokens[i] - new_tokens
+                tokens[i] = new_tokens
+                collapsed += 1
+
+        dropped = 0
+        for start, end in turns:
+            if total <= budget or start >= protected:
+                break
+            for i in range(start, end):
+                total -= tokens[i]
+                result[i] = None
+                dropped += 1
+
+        trimmed = [m for m in result if m is not None]
+        saved = before - total
+        self.trimmed += 1
+        self.tokens_saved += saved
+        self.collapsed_messages += collapsed
+        self.dropped_messages += dropped
+        CONTEXT_TRIMMED_TOKENS.inc(model, amount=saved)
+        logger.info(f"上下文约 {before} token 超出 {model} 的预算 {budget}，折叠 {collapsed} 条工具结果、"
+                    f"丢弃 {dropped} 条较早消息，节省约 {saved} token" +
+                    ("" if total <= budget else f"，仍超出预算(约 {total} token)"))
+        return trimmed, saved
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'trimmed': self.trimmed,
+            'tokens_before': self.tokens_before,
+            'tokens_saved': self.tokens_saved,
+            'collapsed_messages': self.collapsed_messages,
+            'dropped_messages': self.dropped_messages,
+        }
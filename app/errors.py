@@ -2,12 +2,17 @@ import inspect
 
 from loguru import logger
 
+from app.metrics import UPSTREAM_ERRORS, current_model
+from app.tracing import current_request_id
+
 
 class CursorWebError(Exception):
     def __init__(self, status_code: int, message: str, response_status_code: int = 500):
         self.status_code = status_code
         self.message = message
         self.response_status_code = response_status_code
+        self.request_id = current_request_id()
+        UPSTREAM_ERRORS.inc(current_model(), status_code)
         # 获取调用者信息
         frame = inspect.currentframe()
         try:
@@ -26,10 +31,11 @@ class CursorWebError(Exception):
         return f"CursorWebError: {self.status_code}, {self.message}"
 
     def to_openai_error(self) -> dict[str, dict[str, str]]:
-        return {
-            "error": {
-                "message": self.__str__(),
-                "type": "cursorweb_error",
-                "code": "cursorweb_error"
-            }
+        error = {
+            "message": self.__str__(),
+            "type": "cursorweb_error",
+            "code": "cursorweb_error"
         }
+        if self.request_id:
+            error["request_id"] = self.request_id
+        return {"error": error}
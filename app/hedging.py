@@ -0,0 +1,167 @@
+import asyncio
+import time
+from collections import deque
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable
+
+from loguru import logger
+
+from app.metrics import HEDGED_REQUESTS, current_model
+from app.models import ToolCall
+from app.tracing import span
+from app.utils import _anext
+
+
+async def _discard(task: asyncio.Task, generator: AsyncIterator[Any]):
+    """取消落败的一方并关闭其生成器(上游连接随之关闭)"""
+    task.cancel()
+    await asyncio.wait({task})
+    if not task.cancelled():
+        task.exception()
+    await generator.aclose()
+
+
+class HedgePolicy:
+    """
+    对冲请求：首个输出迟迟不到时并行发起第二次上游请求，先产出内容的一方胜出，另一方被取消
+
+    等待阈值取最近若干次首个输出耗时的分位数(限制在 [min_delay, max_delay] 内)，样本不足时用 max_delay。
+    对冲比例由预算限制：每个请求积累 max_rate 个预算，每次对冲消耗 1 个，避免上游故障时放大负载。
+    """
+
+    MIN_SAMPLES = 20
+    MAX_BUDGET = 10.0
+
+    def __init__(self, percentile: float, min_delay: float, max_delay: float, max_rate: float, window: int = 1000):
+        """
+        Args:
+            percentile: 取首个输出耗时的该分位数作为等待阈值
+            min_delay: 阈值下限(秒)
+            max_delay: 阈值上限(秒)，样本不足时使用
+            max_rate: 对冲请求占全部请求的最大比例
+            window: 保留的耗时样本数
+        """
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_rate = max_rate
+        self._samples: deque[float] = deque(maxlen=window)
+        self._budget = 1.0
+        self._discarding: set[asyncio.Task] = set()
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+
+    def delay(self) -> float:
+        if len(self._samples) < self.MIN_SAMPLES:
+            return self.max_delay
+        samples = sorted(self._samples)
+        value = samples[min(int(len(samples) * self.percentile), len(samples) - 1)]
+        return min(max(value, self.min_delay), self.max_delay)
+
+    def _try_hedge(self) -> bool:
+        if self._budget < 1:
+            self.budget_exhausted += 1
+            return False
+        self._budget -= 1
+        return True
+
+    async def run(self, attempt: Callable[[bool], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        Args:
+            attempt: 创建一次上游请求的生成器，参数表示是否为对冲请求
+        """
+        self.requests += 1
+        self._budget = min(self._budget + self.max_rate, self.MAX_BUDGET)
+        started_at = time.perf_counter()
+        generator = attempt(False)
+        first = asyncio.create_task(_anext(generator))
+        buffered = []
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.delay())
+            if not done and self._try_hedge():
+                buffered, first, generator = await self._race(first, generator, attempt, started_at)
+            else:
+                await asyncio.wait({first})
+                self._samples.append(time.perf_counter() - started_at)
+        except BaseException:
+            await _discard(first, generator)
+            raise
+
+        async with aclosing(generator):
+            for item in buffered:
+                yield item
+            try:
+                item = first.result()
+            except StopAsyncIteration:
+                return
+            yield item
+            async for item in generator:
+                yield item
+
+    async def _race(self, primary: asyncio.Task, primary_generator: AsyncIterator[Any],
+                    attempt: Callable[[bool], AsyncIterator[Any]], started_at: float):
+        """
+        主请求与对冲请求竞速，先产出内容(文本或工具调用)的一方胜出
+        usage 等非内容输出暂存后继续读取该方；一方没有内容就结束或出错时，另一方仍在进行则继续等待
+
+        Returns:
+            (胜出方暂存的输出, 胜出方的当前读取任务, 胜出方的生成器)
+        """
+        self.hedged += 1
+        logger.info(f"首个输出超过 {self.delay():.2f} 秒，发起对冲请求")
+        hedge_generator = attempt(True)
+        hedge = asyncio.create_task(_anext(hedge_generator))
+        # 生成器 -> 当前读取任务
+        current = {primary_generator: primary, hedge_generator: hedge}
+        buffered = {primary_generator: [], hedge_generator: []}
+        ended = []
+        pending = {primary, hedge}
+        winner = None
+        try:
+            with span('hedge'):
+                while winner is None and pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        generator = next(g for g, t in current.items() if t is task)
+                        if task.exception() is not None:
+                            # 没有内容就结束(StopAsyncIteration)或出错
+                            ended.append(generator)
+                        elif isinstance(task.result(), (str, ToolCall)):
+                            winner = generator
+                            break
+                        else:
+                            buffered[generator].append(task.result())
+                            current[generator] = asyncio.create_task(_anext(generator))
+                            pending.add(current[generator])
+                if winner is None:
+                    # 双方都没有产出内容: 优先正常结束的一方，其次主请求
+                    winner = min(ended, key=lambda g: (not isinstance(current[g].exception(), StopAsyncIteration),
+                                                       g is not primary_generator))
+        except BaseException:
+            for generator, task in current.items():
+                await _discard(task, generator)
+            raise
+
+        for generator, task in current.items():
+            if generator is not winner:
+                # curl 要等到下一个数据块才能中止传输，落败方在后台清理，不拖慢胜出方的输出
+                cleanup = asyncio.create_task(_discard(task, generator))
+                self._discarding.add(cleanup)
+                cleanup.add_done_callback(self._discarding.discard)
+        # 对冲胜出时主请求的真实耗时未知，记录已等待的时间(下限)，使分位数仍能反映长尾
+        self._samples.append(time.perf_counter() - started_at)
+        if winner is hedge_generator:
+            self.hedge_wins += 1
+        HEDGED_REQUESTS.inc(current_model(), 'hedge' if winner is hedge_generator else 'primary')
+        return buffered[winner], current[winner], winner
+
+    def stats(self) -> dict:
+        return {
+            'requests': self.requests,
+            'hedged': self.hedged,
+            'hedge_wins': self.hedge_wins,
+            'budget_exhausted': self.budget_exhausted,
+            'delay_seconds': self.delay(),
+        }
@@ -0,0 +1,78 @@
+import asyncio
+import signal
+import threading
+import time
+from typing import Callable, Optional
+
+from loguru import logger
+
+
+class GracefulShutdown:
+    """
+    SIGTERM 平滑退出
+
+    uvicorn 收到 SIGTERM 后会立即设置退出标志，sse_starlette 随之中断所有进行中的流式响应。
+    这里在应用启动后接管 SIGTERM：先进入排空状态(就绪探针返回 503、新请求被拒绝)，
+    等进行中的请求全部结束或超时后，再交给 uvicorn 原来的处理函数退出。再次收到 SIGTERM 时立即退出。
+    """
+
+    def __init__(self, in_flight: Callable[[], int], timeout: float):
+        """
+        Args:
+            in_flight: 返回进行中请求数的函数
+            timeout: 最长排空秒数
+        """
+        self.in_flight = in_flight
+        self.timeout = timeout
+        self.started = False
+        self.draining = False
+        self._original_handler = None
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def ready(self) -> bool:
+        return self.started and not self.draining
+
+    def install(self):
+        """在 lifespan 启动阶段调用，此时 uvicorn 已经注册了自己的信号处理函数"""
+        self.started = True
+        if threading.current_thread() is not threading.main_thread():
+            return
+        loop = asyncio.get_running_loop()
+        original = signal.getsignal(signal.SIGTERM)
+        if not callable(original):
+            return
+        self._original_handler = original
+
+        def handle_sigterm(sig, frame):
+            if self.draining:
+                original(sig, frame)
+                return
+            self.draining = True
+            loop.call_soon_threadsafe(self._start_drain, sig)
+
+        signal.signal(signal.SIGTERM, handle_sigterm)
+
+    def uninstall(self):
+        if self._original_handler is not None:
+            signal.signal(signal.SIGTERM, self._original_handler)
+            self._original_handler = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def _start_drain(self, sig: int):
+        self._task = asyncio.create_task(self._drain(sig))
+
+    async def _drain(self, sig: int):
+        started_at = time.monotonic()
+        logger.info(f"收到 SIGTERM，等待 {self.in_flight()} 个进行中的请求结束(最长 {self.timeout} 秒)")
+        while self.in_flight() > 0 and time.monotonic() - started_at < self.timeout:
+            await asyncio.sleep(0.1)
+        remaining = self.in_flight()
+        if remaining:
+            logger.warning(f"排空超时，仍有 {remaining} 个请求进行中，强制退出")
+        else:
+            logger.info(f"请求已全部结束，用时 {time.monotonic() - started_at:.1f} 秒，退出")
+        if self._original_handler is not None:
+            self._original_handler(sig, None)
@@ -0,0 +1,218 @@
+import time
+from contextvars import ContextVar
+from typing import Iterable, Optional
+
+# 延迟类直方图的默认分桶(秒)
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+# 增量间隔的分桶(秒)
+GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = '') -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+# 允许出现在 model 标签中的模型(MODELS)，其余由客户端任意填写的模型名记为 other，避免标签数无限增长；为空时不限制
+known_models: frozenset[str] = frozenset()
+
+
+def set_known_models(models: Iterable[str]):
+    global known_models
+    known_models = frozenset(models)
+
+
+def model_label(model: Optional[str]) -> str:
+    if not model:
+        return ''
+    return 'other' if known_models and model not in known_models else model
+
+
+def _key(labelnames: tuple[str, ...], labelvalues: tuple) -> tuple[str, ...]:
+    key = tuple(str(v) for v in labelvalues)
+    if labelnames and labelnames[0] == 'model' and key:
+        key = (model_label(key[0]),) + key[1:]
+    return key
+
+
+def _format(value: float) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """按标签累计的计数器"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ('model',)):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, *labelvalues: str, amount: float = 1):
+        key = _key(self.labelnames, labelvalues)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def collect(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} counter'
+        for key, value in self._values.items():
+            yield f'{self.name}{_labels(self.labelnames, key)} {_format(value)}'
+
+
+class Histogram:
+    """按标签分组的累计直方图"""
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ('model',),
+                 buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+        # 标签 -> [各分桶计数, 总和, 总数]
+        self._values: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str):
+        key = _key(self.labelnames, labelvalues)
+        series = self._values.get(key)
+        if series is None:
+            series = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+        counts = series[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        series[1] += value
+        series[2] += 1
+
+    def collect(self) -> Iterable[str]:
+        yield f'# HELP {self.name} {self.documentation}'
+        yield f'# TYPE {self.name} histogram'
+        for key, (counts, total, count) in self._values.items():
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = f'le="{_format(bound)}"'
+                yield f'{self.name}_bucket{_labels(self.labelnames, key, le)} {cumulative}'
+            yield f'{self.name}_sum{_labels(self.labelnames, key)} {_format(total)}'
+            yield f'{self.name}_count{_labels(self.labelnames, key)} {count}'
+
+
+def collect_gauges(prefix: str, stats: dict) -> Iterable[str]:
+    """把运行时统计字典(可嵌套)展开为 gauge，忽略非数值项"""
+    for key, value in stats.items():
+        name = f'{prefix}_{key}'
+        if isinstance(value, dict):
+            yield from collect_gauges(name, value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f'# TYPE {name} gauge'
+            yield f'{name} {_format(value)}'
+
+
+# 各阶段耗时
+STAGE_SECONDS = Histogram('cursorweb_stage_seconds', '聊天请求各阶段耗时(秒)', ('model', 'stage'))
+# 接收请求到首个增量
+FIRST_DELTA_SECONDS = Histogram('cursorweb_time_to_first_delta_seconds', '接收请求到首个增量的耗时(秒)')
+# 相邻增量间隔
+INTER_DELTA_SECONDS = Histogram('cursorweb_inter_delta_seconds', '相邻增量之间的间隔(秒)', buckets=GAP_BUCKETS)
+# 请求总耗时(流式响应到流结束)
+REQUEST_SECONDS = Histogram('cursorweb_request_duration_seconds', '聊天请求总耗时(秒)')
+
+EMPTY_RETRIES = Counter('cursorweb_empty_retries_total', '空回复重试次数')
+TRUNCATION_CONTINUATIONS = Counter('cursorweb_truncation_continuations_total', '截断续写次数')
+ERROR_RETRIES = Counter('cursorweb_error_retries_total', 'error_wrapper 出错重试次数')
+ABORTED_STREAMS = Counter('cursorweb_aborted_streams_total', '客户端断开而中止的流式响应数')
+FAILED_STREAMS = Counter('cursorweb_failed_streams_total', '首个输出之后出错而中断的流式响应数(按异常类型)',
+                         ('model', 'error'))
+HEDGED_REQUESTS = Counter('cursorweb_hedged_requests_total', '发起对冲的请求数(按胜出方)', ('model', 'winner'))
+RETRY_GIVE_UPS = Counter('cursorweb_retry_give_ups_total', '放弃重试次数(按原因: fatal/budget/deadline)',
+                         ('model', 'reason'))
+UPSTREAM_ERRORS = Counter('cursorweb_upstream_errors_total', 'CursorWebError 次数(按上游状态码)',
+                          ('model', 'status_code'))
+CONTEXT_TRIMMED_TOKENS = Counter('cursorweb_context_trimmed_tokens_total', '上下文超出预算裁剪掉的估算 token 数')
+KEY_REQUESTS = Counter('cursorweb_api_key_requests_total', '各 API key 的请求数(按结果: admitted/rate/concurrency)',
+                       ('key', 'outcome'))
+KEY_TOKENS = Counter('cursorweb_api_key_tokens_total', '各 API key 的 token 用量(按类型: prompt/completion)',
+                     ('key', 'type'))
+
+REGISTRY = (STAGE_SECONDS, FIRST_DELTA_SECONDS, INTER_DELTA_SECONDS, REQUEST_SECONDS,
+            EMPTY_RETRIES, TRUNCATION_CONTINUATIONS, ERROR_RETRIES, ABORTED_STREAMS, FAILED_STREAMS,
+            HEDGED_REQUESTS, RETRY_GIVE_UPS, UPSTREAM_ERRORS, CONTEXT_TRIMMED_TOKENS, KEY_REQUESTS, KEY_TOKENS)
+
+
+class RequestTimer:
+    """单个请求的计时上下文，由中间件创建，经 contextvar 在各处取用"""
+
+    __slots__ = ('received_at', 'model', 'first_delta_at')
+
+    def __init__(self):
+        self.received_at = time.perf_counter()
+        self.model: Optional[str] = None
+        self.first_delta_at: Optional[float] = None
+
+    def stage(self, stage: str, started_at: float):
+        """记录从 started_at 到现在的阶段耗时"""
+        STAGE_SECONDS.observe(time.perf_counter() - started_at, self.model or '', stage)
+
+    def delta(self):
+        """记录首个增量的到达时间，只记一次"""
+        if self.first_delta_at is None:
+            self.first_delta_at = time.perf_counter()
+            FIRST_DELTA_SECONDS.observe(self.first_delta_at - self.received_at, self.model or '')
+
+
+current_request: ContextVar[Optional[RequestTimer]] = ContextVar('current_request', default=None)
+
+
+def current_model() -> str:
+    timer = current_request.get()
+    return (timer.model if timer else None) or ''
+
+
+def observe_stage(stage: str, started_at: float):
+    """记录当前请求的阶段耗时，请求上下文之外(如后台预热)按空模型记录"""
+    timer = current_request.get()
+    if timer is not None:
+        timer.stage(stage, started_at)
+    else:
+        STAGE_SECONDS.observe(time.perf_counter() - started_at, '', stage)
+
+
+class MetricsMiddleware:
+    """
+    纯 ASGI 中间件: 记录请求到达时间并统计聊天请求总耗时
+    不包装响应体，流式响应不受影响；总耗时在响应(含流)发送完毕后记录
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+        timer = RequestTimer()
+        token = current_request.set(timer)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_request.reset(token)
+            if timer.model is not None:
+                REQUEST_SECONDS.observe(time.perf_counter() - timer.received_at, timer.model)
+
+
+def render(*gauge_sections: tuple[str, dict]) -> str:
+    """输出 Prometheus 文本格式"""
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.collect())
+    for prefix, stats in gauge_sections:
+        lines.extend(collect_gauges(prefix, stats))
+    return '\n'.join(lines) + '\n'
@@ -1,6 +1,6 @@
 from typing import List, Dict, Any, Literal, Optional
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, Field, PrivateAttr
 
 
 class OpenAIToolCallFunction(BaseModel):
@@ -34,6 +34,18 @@ class Message(BaseModel):
     tool_calls: list[dict[str, Any]] | None = Field(
         None, description="工具调用信息（当role为assistant时）"
     )
+    _continuation: bool = PrivateAttr(False)
+
+    @classmethod
+    def continuation(cls, role: str, content: str) -> 'Message':
+        """截断续写追加的消息(已输出的部分回复与续写提示)，裁剪上下文时与被续写的问题算作同一轮"""
+        message = cls(role=role, content=content, tool_calls=None, tool_call_id=None)
+        message._continuation = True
+        return message
+
+    @property
+    def is_continuation(self) -> bool:
+        return self._continuation
 
 
 class OpenAIToolFunction(BaseModel):
@@ -58,6 +70,8 @@ class ChatCompletionRequest(BaseModel):
     stream: Optional[bool] = False
     model: Optional[str] = "gpt-4o"
     tools: list[OpenAITool] | None = Field(None, description="可用工具定义")
+    # 由 get_tool_set 填充，同一请求(及其截断续写)的各次上游调用共用
+    _tool_set: Any = PrivateAttr(None)
 
 
 class Model(BaseModel):
@@ -83,6 +97,10 @@ class Usage(BaseModel):
     prompt_tokens: int
     completion_tokens: int
     total_tokens: int
+    cached_tokens: int = 0
+    reasoning_tokens: int = 0
+    # 上游未返回 usage，由本地估算
+    estimated: bool = False
 
 
 class ChatCompletionResponse(BaseModel):
@@ -0,0 +1,169 @@
+import asyncio
+import gzip
+import io
+import itertools
+import json
+import os
+import time
+import uuid
+from typing import AsyncIterator, Iterator, Optional
+
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:  # zstandard 为可选依赖，未安装时使用 gzip 压缩
+    zstandard = None
+
+FORMAT_VERSION = 1
+RECORDING_SUFFIXES = ('.ndjson', '.ndjson.gz', '.ndjson.zst')
+
+
+class Recording:
+    """
+    一次上游会话：元数据与带时间的原始字节块
+
+    文件为 NDJSON：首行是元数据，之后每行一个原始字节块及其相对流开始的时间，
+        {"v": 1, "model": "...", "started_at": 1700000000.0}
+        {"t": 0.512, "d": "data: {...}\\n\\n"}
+    字节块按 UTF-8 解码(被截断的多字节字符以 surrogateescape 保留)，回放时逐字节还原。
+    """
+
+    __slots__ = ('meta', 'chunks')
+
+    def __init__(self, meta: dict, chunks: list[tuple[float, bytes]]):
+        self.meta = meta
+        self.chunks = chunks
+
+    @property
+    def duration(self) -> float:
+        return self.chunks[-1][0] if self.chunks else 0.0
+
+    @property
+    def size(self) -> int:
+        return sum(len(chunk) for _, chunk in self.chunks)
+
+    def dumps(self) -> bytes:
+        lines = [json.dumps({'v': FORMAT_VERSION, **self.meta}, separators=(',', ':'))]
+        for t, chunk in self.chunks:
+            data = chunk.decode('utf-8', 'surrogateescape')
+            lines.append(json.dumps({'t': round(t, 6), 'd': data}, separators=(',', ':')))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    @classmethod
+    def loads(cls, raw: bytes) -> 'Recording':
+        lines = raw.decode('utf-8').splitlines()
+        if not lines:
+            raise ValueError('空的录制文件')
+        meta = json.loads(lines[0])
+        if meta.pop('v', None) != FORMAT_VERSION:
+            raise ValueError('不支持的录制文件版本')
+        chunks = []
+        for line in lines[1:]:
+            if line:
+                item = json.loads(line)
+                chunks.append((item['t'], item['d'].encode('utf-8', 'surrogateescape')))
+        return cls(meta, chunks)
+
+
+def compress(raw: bytes) -> tuple[bytes, str]:
+    if zstandard is not None:
+        return zstandard.ZstdCompressor(level=10).compress(raw), '.ndjson.zst'
+    return gzip.compress(raw, compresslevel=6), '.ndjson.gz'
+
+
+def decompress(raw: bytes, path: str) -> bytes:
+    if path.endswith('.zst'):
+        if zstandard is None:
+            raise RuntimeError(f'读取 {path} 需要安装 zstandard')
+        return zstandard.ZstdDecompressor().stream_reader(io.BytesIO(raw)).read()
+    if path.endswith('.gz'):
+        return gzip.decompress(raw)
+    return raw
+
+
+def save_recording(recording: Recording, directory: str) -> str:
+    os.makedirs(directory, exist_ok=True)
+    raw, suffix = compress(recording.dumps())
+    name = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}{suffix}"
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(raw)
+    return path
+
+
+def load_recording(path: str) -> Recording:
+    with open(path, 'rb') as f:
+        return Recording.loads(decompress(f.read(), path))
+
+
+def list_recordings(path: str) -> list[str]:
+    """path 可以是单个录制文件或包含录制文件的目录"""
+    if os.path.isdir(path):
+        return sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith(RECORDING_SUFFIXES))
+    return [path]
+
+
+def load_recordings(path: str) -> list[Recording]:
+    return [load_recording(p) for p in list_recordings(path)]
+
+
+class Recorder:
+    """把上游字节流原样透传并记录，流结束或被关闭后在线程中压缩写盘"""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.saved = 0
+
+    async def record(self, chunks: AsyncIterator[bytes], meta: dict) -> AsyncIterator[bytes]:
+        recorded: list[tuple[float, bytes]] = []
+        started_at = time.perf_counter()
+        meta = {**meta, 'started_at': time.time()}
+        try:
+            async for chunk in chunks:
+                recorded.append((time.perf_counter() - started_at, chunk))
+                yield chunk
+        finally:
+            # 收到 finish 或工具调用后会提前关闭上游，此时不能再 yield，交给线程池写盘
+            if recorded:
+                asyncio.get_running_loop().run_in_executor(None, self._save, Recording(meta, recorded))
+
+    def _save(self, recording: Recording):
+        try:
+            path = save_recording(recording, self.directory)
+        except OSError as e:
+            logger.warning(f"录制上游事件流失败: {e}")
+            return
+        self.saved += 1
+        logger.debug(f"已录制上游事件流: {path} ({len(recording.chunks)} 块, {recording.size} 字节)")
+
+
+class Replayer:
+    """
+    按录制的时间间隔回放上游字节流，代替网络请求
+
+    speed 为回放速度倍数，0 表示不等待、尽快输出；多个录制文件按顺序轮流使用。
+    """
+
+    def __init__(self, path: str, speed: float = 1.0):
+        self.recordings = load_recordings(path)
+        if not self.recordings:
+            raise ValueError(f'{path} 中没有录制文件')
+        self.speed = speed
+        self._cycle: Iterator[Recording] = itertools.cycle(self.recordings)
+        self.replayed = 0
+
+    def next_recording(self) -> Recording:
+        return next(self._cycle)
+
+    async def chunks(self, recording: Optional[Recording] = None) -> AsyncIterator[bytes]:
+        recording = recording or self.next_recording()
+        self.replayed += 1
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        for t, chunk in recording.chunks:
+            if self.speed > 0:
+                delay = started_at + t / self.speed - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield chunk
@@ -0,0 +1,230 @@
+import asyncio
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from contextlib import aclosing
+from typing import AsyncIterator, Optional, Union
+
+from loguru import logger
+
+from app.cache import LRUCache
+from app.models import ChatCompletionRequest, Usage, ToolCall
+
+
+def cache_key(request: ChatCompletionRequest) -> str:
+    """请求的规范化哈希：只取模型、消息与工具，字段按键排序，与是否流式无关"""
+    canonical = json.dumps(request.model_dump(mode='json', include={'model', 'messages', 'tools'}),
+                           sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class CacheControl:
+    """
+    请求头 Cache-Control 中与响应缓存相关的指令
+        no-cache    不读取缓存，重新请求上游并更新缓存
+        no-store    既不读取也不写入缓存
+        max-age=N   只接受 N 秒内写入的缓存
+    """
+
+    __slots__ = ('lookup', 'store', 'max_age')
+
+    def __init__(self, header: Optional[str] = None):
+        self.lookup = True
+        self.store = True
+        self.max_age: Optional[float] = None
+        for directive in (header or '').lower().split(','):
+            name, _, value = directive.strip().partition('=')
+            if name == 'no-cache':
+                self.lookup = False
+            elif name == 'no-store':
+                self.lookup = self.store = False
+            elif name == 'max-age':
+                try:
+                    self.max_age = max(float(value.strip('"')), 0.0)
+                except ValueError:
+                    pass
+
+
+class CachedResponse:
+    """缓存的完整回复：正文、工具调用与 usage，可按流式或非流式重新输出"""
+
+    __slots__ = ('content', 'tool_calls', 'usage', 'created_at')
+
+    def __init__(self, content: str, tool_calls: list[ToolCall], usage: Optional[Usage],
+                 created_at: Optional[float] = None):
+        self.content = content
+        self.tool_calls = tool_calls
+        self.usage = usage
+        self.created_at = time.time() if created_at is None else created_at
+
+    @property
+    def size(self) -> int:
+        return len(self.content) + sum(len(c.toolInput) + len(c.toolName) + len(c.toolId) for c in self.tool_calls)
+
+    def age(self) -> float:
+        return time.time() - self.created_at
+
+    async def chunks(self) -> AsyncIterator[Union[str, ToolCall, Usage]]:
+        """与上游生成器相同的输出，交给 stream_chat_completion / non_stream_chat_completion"""
+        if self.content:
+            yield self.content
+        for tool_call in self.tool_calls:
+            yield tool_call
+        if self.usage is not None:
+            yield self.usage
+
+    def dumps(self) -> str:
+        return json.dumps({
+            'content': self.content,
+            'tool_calls': [c.model_dump() for c in self.tool_calls],
+            'usage': self.usage.model_dump() if self.usage else None,
+        }, ensure_ascii=False, separators=(',', ':'))
+
+    @classmethod
+    def loads(cls, raw: str, created_at: float) -> 'CachedResponse':
+        data = json.loads(raw)
+        return cls(data['content'], [ToolCall(**c) for c in data['tool_calls']],
+                   Usage(**data['usage']) if data['usage'] else None, created_at)
+
+
+class SqliteStore:
+    """
+    磁盘缓存层，多个工作进程共享同一个文件
+    读写都在线程池中进行，连接由锁保护
+    """
+
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path: str, max_entries: int):
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses '
+                           '(key TEXT PRIMARY KEY, created_at REAL NOT NULL, data TEXT NOT NULL)')
+
+    def get(self, key: str) -> Optional[tuple[float, str]]:
+        with self._lock:
+            return self._conn.execute('SELECT created_at, data FROM responses WHERE key = ?', (key,)).fetchone()
+
+    def set(self, key: str, created_at: float, data: str, ttl: float):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, created_at, data) VALUES (?, ?, ?)',
+                               (key, created_at, data))
+            self._writes += 1
+            if self._writes % self.PRUNE_INTERVAL == 0:
+                self._prune(ttl)
+
+    def _prune(self, ttl: float):
+        if ttl > 0:
+            self._conn.execute('DELETE FROM responses WHERE created_at < ?', (time.time() - ttl,))
+        if self.max_entries > 0:
+            self._conn.execute('DELETE FROM responses WHERE key NOT IN '
+                               '(SELECT key FROM responses ORDER BY created_at DESC LIMIT ?)', (self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """
+    完整回复缓存：内存 LRU(条目数/大小/TTL 限制) + 可选的 sqlite 磁盘层
+
+    内存未命中时查磁盘，磁盘命中后回填内存。只缓存正常结束的回复，客户端断开或出错的不缓存。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float, db_path: str = '', db_max_entries: int = 0):
+        """
+        Args:
+            max_entries: 内存层最大条目数
+            max_bytes: 内存层占用上限(按文本长度估算)，0 表示不限制
+            ttl: 缓存有效秒数，0 表示不过期
+            db_path: sqlite 文件路径，为空时不启用磁盘层
+            db_max_entries: 磁盘层最大条目数，0 表示不限制
+        """
+        self.ttl = ttl
+        self.memory = LRUCache(max_entries, max_bytes, sizeof=lambda entry: entry.size)
+        self.db = SqliteStore(db_path, db_max_entries) if db_path else None
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _fresh(self, entry: CachedResponse, max_age: Optional[float]) -> bool:
+        age = entry.age()
+        if self.ttl > 0 and age > self.ttl:
+            return False
+        return max_age is None or age <= max_age
+
+    async def get(self, key: str, max_age: Optional[float] = None) -> Optional[CachedResponse]:
+        entry = self.memory.get(key)
+        if entry is not None and not self._fresh(entry, max_age):
+            if self.ttl > 0 and entry.age() > self.ttl:
+                self.memory.pop(key)
+            entry = None
+        if entry is None and self.db is not None:
+            try:
+                row = await asyncio.get_running_loop().run_in_executor(None, self.db.get, key)
+            except sqlite3.Error as e:
+                logger.warning(f"读取响应缓存失败: {e}")
+                row = None
+            if row is not None:
+                candidate = CachedResponse.loads(row[1], row[0])
+                if self._fresh(candidate, max_age):
+                    entry = candidate
+                    self.disk_hits += 1
+                    self.memory.set(key, entry)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry
+
+    def set(self, key: str, entry: CachedResponse):
+        self.memory.set(key, entry)
+        self.stores += 1
+        if self.db is not None:
+            asyncio.get_running_loop().run_in_executor(None, self._save, key, entry)
+
+    def _save(self, key: str, entry: CachedResponse):
+        try:
+            self.db.set(key, entry.created_at, entry.dumps(), self.ttl)
+        except sqlite3.Error as e:
+            logger.warning(f"写入响应缓存失败: {e}")
+
+    async def store(self, key: str, generator: AsyncIterator[Union[str, ToolCall, Usage]]) \
+            -> AsyncIterator[Union[str, ToolCall, Usage]]:
+        """透传上游输出，正常结束后写入缓存"""
+        content: list[str] = []
+        tool_calls: list[ToolCall] = []
+        usage = None
+        async with aclosing(generator):
+            async for chunk in generator:
+                if isinstance(chunk, Usage):
+                    usage = chunk
+                elif isinstance(chunk, ToolCall):
+                    tool_calls.append(chunk)
+                else:
+                    content.append(chunk)
+                yield chunk
+        if content or tool_calls:
+            self.set(key, CachedResponse(''.join(content), tool_calls, usage))
+
+    def close(self):
+        if self.db is not None:
+            self.db.close()
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'memory': self.memory.stats(),
+        }
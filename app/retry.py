@@ -0,0 +1,106 @@
+import asyncio
+import random
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from curl_cffi.requests.exceptions import RequestException
+from loguru import logger
+
+from app.errors import CursorWebError
+from app.metrics import RETRY_GIVE_UPS, current_model
+
+# 重试也无济于事的上游状态码: 请求本身有误、鉴权失败或被 Cloudflare 拦截(立即重试同样会被拦)
+FATAL_STATUS_CODES = frozenset({400, 401, 403, 404, 413, 422})
+# 上游以 error 事件返回、重试也无法通过的校验错误
+FATAL_MESSAGES = ('The content field in the Message object at',)
+
+
+def is_retryable(error: Optional[BaseException]) -> bool:
+    """错误分类: None 表示空回复，可重试；上游 4xx 与请求内容校验错误不重试；其余上游错误与网络错误可重试"""
+    if error is None:
+        return True
+    if isinstance(error, CursorWebError):
+        if error.status_code in FATAL_STATUS_CODES:
+            return False
+        return not any(message in error.message for message in FATAL_MESSAGES)
+    return isinstance(error, RequestException)
+
+
+class RetryPolicy:
+    """
+    重试策略: 指数退避 + 完全抖动，每个请求共享一份重试预算与截止时间
+
+    出错重试(error_wrapper)与空回复重试(empty_retry_wrapper)都从同一份预算中扣除，
+    各自的最大重试次数仍然有效，先达到的限制生效。
+    """
+
+    def __init__(self, base_delay: float, max_delay: float, budget: int, deadline: float):
+        """
+        Args:
+            base_delay: 首次重试前的退避上限(秒)，之后每次翻倍
+            max_delay: 单次退避上限(秒)
+            budget: 每个请求最多重试的总次数
+            deadline: 从请求开始计算，超过该秒数后不再重试，0 表示不限制
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.budget = budget
+        self.deadline = deadline
+
+    def start(self) -> 'RetryState':
+        return RetryState(self)
+
+
+class RetryState:
+    """单个请求的重试状态"""
+
+    __slots__ = ('policy', 'remaining', 'deadline', 'retries')
+
+    def __init__(self, policy: RetryPolicy):
+        self.policy = policy
+        self.remaining = policy.budget
+        self.deadline = time.monotonic() + policy.deadline if policy.deadline > 0 else None
+        self.retries = 0
+
+    def delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.policy.max_delay, self.policy.base_delay * 2 ** attempt))
+
+    async def backoff(self, error: Optional[BaseException], attempt: int) -> bool:
+        """
+        判断能否重试，能则等待退避时间后返回 True
+
+        Args:
+            error: 本次失败的错误，None 表示空回复
+            attempt: 本层已失败的次数(从 0 开始)，决定退避时间
+        """
+        if not is_retryable(error):
+            reason = 'fatal'
+        elif self.remaining <= 0:
+            reason = 'budget'
+        else:
+            delay = self.delay(attempt)
+            if self.deadline is not None and time.monotonic() + delay > self.deadline:
+                reason = 'deadline'
+            else:
+                self.remaining -= 1
+                self.retries += 1
+                if delay > 0:
+                    logger.debug(f"{delay:.2f} 秒后重试")
+                    await asyncio.sleep(delay)
+                return True
+        RETRY_GIVE_UPS.inc(current_model(), reason)
+        logger.warning(f"不再重试({reason}): {error if error is not None else '空回复'}")
+        return False
+
+
+# 进程默认策略，请求处理时由 main 按配置创建并放入 current_retry
+DEFAULT_POLICY = RetryPolicy(base_delay=0.5, max_delay=8.0, budget=5, deadline=60.0)
+
+current_retry: ContextVar[Optional[RetryState]] = ContextVar('current_retry', default=None)
+
+
+def current_retry_state() -> RetryState:
+    """当前请求的重试状态，请求上下文之外(如基准脚本)每次返回默认策略的新状态"""
+    state = current_retry.get()
+    return state if state is not None else DEFAULT_POLICY.start()
@@ -0,0 +1,57 @@
+import json
+from typing import Any, Optional
+
+try:
+    import orjson
+except ImportError:  # orjson 为可选依赖，未安装时使用标准库
+    orjson = None
+
+# 复用编码器实例，避免 json.dumps 每次带参数调用时重新构造
+_json_encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+
+JSON_BACKEND = 'orjson' if orjson else 'json'
+
+
+def dumps(obj: Any) -> str:
+    """序列化为紧凑JSON字符串，非ASCII字符原样输出"""
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj).decode('utf-8')
+        except TypeError:
+            # orjson 不支持的对象(如含代理字符的字符串)回退到标准库
+            pass
+    return _json_encoder.encode(obj)
+
+
+class ChunkTemplate:
+    """
+    chat.completion.chunk 模板
+
+    同一个流中 id/object/created/model 不变，只在创建时编码一次，
+    之后每个 token 只需序列化 delta 并拼接到固定前后缀中。
+    """
+
+    __slots__ = ('_head', '_choice_prefix')
+
+    def __init__(self, chat_id: str, created: int, model: Optional[str]):
+        head = dumps({
+            "id": chat_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+        })
+        # 去掉结尾的 }，便于继续追加字段
+        self._head = head[:-1]
+        self._choice_prefix = self._head + ',"choices":[{"index":0,"delta":'
+
+    def content(self, text: str) -> str:
+        """文本增量"""
+        return self._choice_prefix + '{"content":' + dumps(text) + '},"finish_reason":null}]}'
+
+    def delta(self, delta: dict[str, Any], finish_reason: Optional[str] = None) -> str:
+        """任意 delta 与结束原因"""
+        return self._choice_prefix + dumps(delta) + ',"finish_reason":' + dumps(finish_reason) + '}]}'
+
+    def extend(self, **fields: Any) -> str:
+        """在固定头部之后追加任意顶层字段，如 choices 与 usage"""
+        return self._head + ',' + dumps(fields)[1:]
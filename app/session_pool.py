@@ -0,0 +1,163 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+from curl_cffi import AsyncSession
+from loguru import logger
+
+
+class _PooledSession:
+    """池中的会话及其元数据"""
+
+    __slots__ = ('session', 'created_at', 'last_used_at', 'uses')
+
+    def __init__(self, session: AsyncSession):
+        self.session = session
+        self.created_at = time.monotonic()
+        self.last_used_at = self.created_at
+        self.uses = 0
+
+
+class SessionPool:
+    """
+    应用生命周期内复用的 AsyncSession 池
+
+    每个聊天请求独占借出一个会话，用完归还，归还的会话保留已建立的 TCP/TLS 连接，
+    下次借出时即可省去握手。空闲超时或使用中出错的会话会被关闭淘汰，提前结束(被关闭或取消)的会话照常归还。
+    """
+
+    def __init__(self, size: int, idle_timeout: float, max_lifetime: float, **session_kwargs):
+        """
+        Args:
+            size: 最多保留的空闲会话数，并发超过该值时临时创建会话，用完即关闭
+            idle_timeout: 空闲超过该秒数的会话会被淘汰
+            max_lifetime: 会话最长存活秒数，超过后不再复用，0 表示不限制
+            session_kwargs: 创建 AsyncSession 的参数
+        """
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.session_kwargs = session_kwargs
+
+        self._idle: list[_PooledSession] = []
+        self._in_use = 0
+        self._closed = False
+        self._evict_task: Optional[asyncio.Task] = None
+
+        # 统计
+        self.created = 0
+        self.reused = 0
+        self.evicted = 0
+        self.discarded = 0
+
+    async def start(self):
+        """启动后台空闲淘汰任务"""
+        if self.idle_timeout > 0:
+            self._evict_task = asyncio.create_task(self._evict_loop())
+
+    async def close(self):
+        """关闭池及其中所有空闲会话"""
+        self._closed = True
+        if self._evict_task:
+            self._evict_task.cancel()
+            self._evict_task = None
+        idle, self._idle = self._idle, []
+        for pooled in idle:
+            await self._close_session(pooled)
+
+    def _is_healthy(self, pooled: _PooledSession, now: float) -> bool:
+        """健康检查：会话未关闭、未空闲超时、未超过最长存活时间"""
+        if pooled.session._closed:
+            return False
+        if self.idle_timeout > 0 and now - pooled.last_used_at > self.idle_timeout:
+            return False
+        if self.max_lifetime > 0 and now - pooled.created_at > self.max_lifetime:
+            return False
+        return True
+
+    async def _close_session(self, pooled: _PooledSession):
+        try:
+            await pooled.session.close()
+        except Exception as e:
+            logger.warning(f"关闭会话失败: {e}")
+
+    async def acquire(self) -> _PooledSession:
+        """借出一个会话，优先复用最近归还的健康会话"""
+        now = time.monotonic()
+        while self._idle:
+            pooled = self._idle.pop()
+            if self._is_healthy(pooled, now):
+                self.reused += 1
+                break
+            self.evicted += 1
+            await self._close_session(pooled)
+        else:
+            pooled = _PooledSession(AsyncSession(**self.session_kwargs))
+            self.created += 1
+
+        pooled.uses += 1
+        self._in_use += 1
+        return pooled
+
+    async def release(self, pooled: _PooledSession, discard: bool = False):
+        """
+        归还会话
+
+        Args:
+            pooled: 借出的会话
+            discard: 使用中出现异常时为 True，直接关闭不再复用
+        """
+        self._in_use -= 1
+        pooled.last_used_at = time.monotonic()
+        if discard or self._closed or len(self._idle) >= self.size \
+                or not self._is_healthy(pooled, pooled.last_used_at):
+            if discard:
+                self.discarded += 1
+            await self._close_session(pooled)
+            return
+        # 清掉上一次请求留下的 cookie，保持与新建会话一致的行为
+        pooled.session.cookies.clear()
+        self._idle.append(pooled)
+
+    @asynccontextmanager
+    async def session(self) -> AsyncIterator[AsyncSession]:
+        """借出会话的上下文管理器，出错退出时淘汰该会话"""
+        pooled = await self.acquire()
+        discard = False
+        try:
+            yield pooled.session
+        except (GeneratorExit, asyncio.CancelledError):
+            # 提前结束(截断续写、客户端断开、对冲落败、合并取消)不是会话的问题，照常归还
+            raise
+        except BaseException:
+            discard = True
+            raise
+        finally:
+            await self.release(pooled, discard=discard)
+
+    async def _evict_loop(self):
+        interval = max(self.idle_timeout / 2, 1)
+        while True:
+            await asyncio.sleep(interval)
+            now = time.monotonic()
+            # 先同步拆分再关闭，避免关闭过程中与借出/归还交错
+            expired = [p for p in self._idle if not self._is_healthy(p, now)]
+            if not expired:
+                continue
+            self._idle = [p for p in self._idle if p not in expired]
+            self.evicted += len(expired)
+            for pooled in expired:
+                await self._close_session(pooled)
+
+    def stats(self) -> dict[str, int]:
+        """池统计信息"""
+        return {
+            'in_use': self._in_use,
+            'idle': len(self._idle),
+            'size': self.size,
+            'created': self.created,
+            'handshakes_saved': self.reused,
+            'evicted': self.evicted,
+            'discarded': self.discarded,
+        }
@@ -0,0 +1,102 @@
+import asyncio
+from contextlib import aclosing
+from typing import Any, AsyncIterator, Callable, Hashable, Optional
+
+
+class Flight:
+    """
+    一次共享的上游请求：后台任务读取生成器并缓冲全部输出，各订阅者从头按序读取
+
+    晚加入的订阅者先拿到已缓冲的前缀再跟上实时输出；所有订阅者都离开时取消后台任务，上游随之关闭。
+    """
+
+    def __init__(self, generator: AsyncIterator[Any]):
+        self.items: list[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self._updated = asyncio.Event()
+        self.task = asyncio.create_task(self._run(generator))
+
+    async def _run(self, generator: AsyncIterator[Any]):
+        try:
+            async with aclosing(generator):
+                async for item in generator:
+                    self.items.append(item)
+                    self._notify()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # 错误交给每个订阅者各自抛出
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+
+    def _notify(self):
+        self._updated.set()
+        self._updated = asyncio.Event()
+
+    def subscribe(self) -> AsyncIterator[Any]:
+        # 加入时即计数，避免先到的订阅者离开时取消尚未开始读取的后来者
+        self.subscribers += 1
+        return self._subscriber()
+
+    async def _subscriber(self) -> AsyncIterator[Any]:
+        index = 0
+        try:
+            while True:
+                if index < len(self.items):
+                    item = self.items[index]
+                    index += 1
+                    yield item
+                    continue
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._updated.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done:
+                self.task.cancel()
+
+
+class SingleFlight:
+    """
+    合并相同的进行中请求：同一键的并发请求共享一个上游生成器，输出广播给所有订阅者
+
+    请求结束(完成、出错或全部订阅者离开)后立即移除，之后的相同请求重新发起。
+    """
+
+    def __init__(self):
+        self._flights: dict[Hashable, Flight] = {}
+        self.flights = 0
+        self.coalesced = 0
+
+    def join(self, key: Hashable, factory: Callable[[], AsyncIterator[Any]]) -> AsyncIterator[Any]:
+        """
+        Args:
+            key: 请求的规范化哈希
+            factory: 没有进行中的相同请求时调用，创建上游生成器
+        """
+        flight = self._flights.get(key)
+        if flight is None or flight.done:
+            flight = Flight(factory())
+            self._flights[key] = flight
+            flight.task.add_done_callback(lambda _: self._remove(key, flight))
+            self.flights += 1
+        else:
+            self.coalesced += 1
+        return flight.subscribe()
+
+    def _remove(self, key: Hashable, flight: Flight):
+        if self._flights.get(key) is flight:
+            del self._flights[key]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            'active': len(self._flights),
+            'flights': self.flights,
+            'coalesced': self.coalesced,
+        }
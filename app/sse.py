@@ -0,0 +1,118 @@
+import json
+from typing import AsyncIterator, Optional
+
+# 需要解析JSON的事件类型，其余类型只有携带delta字段时才解析
+WANTED_EVENT_TYPES = frozenset((b'finish', b'error', b'tool-input-error'))
+
+_TYPE_MARKER = b'"type":"'
+_DELTA_MARKER = b'"delta"'
+_DELTA_VALUE_MARKER = b'"delta":"'
+
+
+class SSEDecoder:
+    """
+    增量式SSE解码器，直接处理上游返回的原始字节块
+
+    - 事件可以被任意切分在多个字节块中
+    - 同一事件的多行 data: 字段按规范以换行拼接
+    - 只保留 data 字段，event/id/retry 与注释行忽略
+    """
+
+    __slots__ = ('_buffer', '_data')
+
+    def __init__(self):
+        self._buffer = b''
+        self._data: list[bytes] = []
+
+    def feed(self, chunk: bytes) -> list[bytes]:
+        """
+        输入一个字节块，返回其中已完整的事件数据
+
+        Args:
+            chunk: 上游返回的原始字节块
+
+        Returns:
+            已完整接收的事件 data 列表(字节串)
+        """
+        if self._buffer:
+            chunk = self._buffer + chunk
+        lines = chunk.split(b'\n')
+        # 最后一段可能是不完整的行，留到下一次
+        self._buffer = lines.pop()
+
+        events = []
+        data = self._data
+        for line in lines:
+            if line.endswith(b'\r'):
+                line = line[:-1]
+            if not line:
+                # 空行：分发事件
+                if data:
+                    events.append(data[0] if len(data) == 1 else b'\n'.join(data))
+                    data = self._data = []
+                continue
+            if line.startswith(b'data:'):
+                value = line[5:]
+                if value.startswith(b' '):
+                    value = value[1:]
+                data.append(value)
+        return events
+
+    def flush(self) -> list[bytes]:
+        """流结束时调用，返回缓冲中尚未以空行结束的事件"""
+        events = self.feed(b'\n\n') if self._buffer or self._data else []
+        self._buffer = b''
+        return events
+
+
+def peek_event_type(data: bytes) -> Optional[bytes]:
+    """不解析JSON，直接从事件数据中取出 type 字段的值"""
+    start = data.find(_TYPE_MARKER)
+    if start < 0:
+        return None
+    start += len(_TYPE_MARKER)
+    end = data.find(b'"', start)
+    if end < 0:
+        return None
+    return data[start:end]
+
+
+def decode_event(data: bytes) -> Optional[dict]:
+    """
+    解析事件数据，跳过不关心的事件类型
+
+    Returns:
+        事件字典，不关心的事件或非JSON数据返回 None；
+        走快速路径的 delta 事件只包含 type 与 delta 字段
+    """
+    start = data.find(_DELTA_VALUE_MARKER)
+    if start >= 0:
+        # 快速路径：delta 为最后一个字段且不含转义时，其字节就是原文，无需解析整个JSON
+        if data.endswith(b'"}'):
+            value = data[start + len(_DELTA_VALUE_MARKER):-2]
+            if b'\\' not in value and b'"' not in value:
+                event_type = peek_event_type(data)
+                try:
+                    return {'type': event_type and event_type.decode('utf-8'), 'delta': value.decode('utf-8')}
+                except UnicodeDecodeError:
+                    return None
+    elif _DELTA_MARKER not in data and peek_event_type(data) not in WANTED_EVENT_TYPES:
+        return None
+    try:
+        # json.loads 处理 bytes 时会先做编码探测，直接解码为 str 更快
+        event_data = json.loads(data.decode('utf-8'))
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        return None
+    if not isinstance(event_data, dict):
+        return None
+    return event_data
+
+
+async def aiter_sse_data(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """将上游字节流解码为事件 data 流"""
+    decoder = SSEDecoder()
+    async for chunk in chunks:
+        for data in decoder.feed(chunk):
+            yield data
+    for data in decoder.flush():
+        yield data
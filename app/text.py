@@ -0,0 +1,200 @@
+import time
+from typing import Optional
+
+
+class TextAccumulator:
+    """
+    追加式文本累加器
+
+    追加只记录片段，取值时一次性拼接，整体为 O(n)；
+    片段数达到阈值时把最近的片段合并成一个块，限制大量小字符串对象带来的内存开销。
+    """
+
+    __slots__ = ('_blocks', '_parts', '_length', '_compact_parts')
+
+    def __init__(self, text: str = '', compact_parts: int = 256):
+        self._blocks: list[str] = []
+        self._parts: list[str] = []
+        self._length = 0
+        self._compact_parts = compact_parts
+        if text:
+            self.append(text)
+
+    def append(self, text: str):
+        self._parts.append(text)
+        self._length += len(text)
+        if len(self._parts) >= self._compact_parts:
+            # 只合并最近的片段，每个字符最多被合并常数次
+            self._blocks.append(''.join(self._parts))
+            self._parts = []
+
+    def tail(self, n: int) -> str:
+        """返回末尾 n 个字符，只访问所需的片段"""
+        if n <= 0:
+            return ''
+        collected = []
+        remaining = n
+        for pieces in (self._parts, self._blocks):
+            for piece in reversed(pieces):
+                if len(piece) >= remaining:
+                    collected.append(piece[-remaining:])
+                    return ''.join(reversed(collected))
+                collected.append(piece)
+                remaining -= len(piece)
+        return ''.join(reversed(collected))
+
+    def getvalue(self) -> str:
+        """返回完整文本，结果会被缓存为单个块"""
+        if self._parts or len(self._blocks) > 1:
+            self._blocks = [''.join(self._blocks) + ''.join(self._parts)]
+            self._parts = []
+        return self._blocks[0] if self._blocks else ''
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        return self._length > 0
+
+    def __str__(self) -> str:
+        return self.getvalue()
+
+
+def _prefix_function(pattern: str) -> list[int]:
+    """KMP 前缀函数: pi[i] 为 pattern[:i+1] 最长的相等真前后缀长度"""
+    pi = [0] * len(pattern)
+    k = 0
+    for i in range(1, len(pattern)):
+        while k and pattern[i] != pattern[k]:
+            k = pi[k - 1]
+        if pattern[i] == pattern[k]:
+            k += 1
+        pi[i] = k
+    return pi
+
+
+def longest_overlap(tail: str, head: str) -> int:
+    """
+    求 tail 的后缀与 head 的前缀最长的重叠长度
+
+    以 head 为模式串用 KMP 扫描 tail，扫描结束时的匹配长度即为所求，O(len(tail) + len(head))
+    """
+    if not tail or not head:
+        return 0
+    tail = tail[-len(head):]
+    pi = _prefix_function(head)
+    k = 0
+    for c in tail:
+        while k and (k == len(head) or head[k] != c):
+            k = pi[k - 1]
+        if k < len(head) and head[k] == c:
+            k += 1
+    return k
+
+
+class OverlapMatcher:
+    """
+    续写流的重叠匹配器
+
+    续写时模型会先重复已输出内容的末尾，匹配器暂存续写流开头，
+    一旦更长的重叠已不可能(暂存内容不再是 tail 某个后缀的前缀)或暂存达到窗口大小，
+    就计算 tail 后缀与暂存内容前缀的最长重叠并丢弃重复部分，之后直接透传。
+
+    - strip_fence: 截断发生在代码块内时，丢弃续写开头重复的 ```lang 行(单独的 ``` 之后不是重复内容时视为结束标记保留)
+    - min_overlap: 短于该长度的重叠视为巧合，不做去重
+    - anchor: 未找到前后缀重叠时，若已暂存的内容中出现 tail 末尾 anchor 个字符，丢弃其及之前的内容
+      (不会为此额外暂存，逐字到达的续写流中前言会原样输出)
+    """
+
+    def __init__(self, tail: str, window: int = 64, strip_fence: bool = False, min_overlap: int = 3,
+                 anchor: int = 10):
+        self.tail = tail[-window:] if window > 0 else ''
+        self.window = window
+        self.strip_fence = strip_fence
+        self.min_overlap = min_overlap
+        self.anchor = anchor
+        self.settled = not self.tail
+        self.overlap = 0
+        self.held_chars = 0
+        self.started_at: Optional[float] = None
+        self.settled_at: Optional[float] = None
+        self._head = ''
+
+    @property
+    def holdback_seconds(self) -> float:
+        """从收到第一段续写到开始输出之间暂存的时间"""
+        if self.started_at is None or self.settled_at is None:
+            return 0.0
+        return self.settled_at - self.started_at
+
+    def feed(self, chunk: str) -> str:
+        """输入续写流的一段，返回可以输出的内容"""
+        if self.settled:
+            return chunk
+        if self.started_at is None:
+            self.started_at = time.perf_counter()
+        self._head += chunk
+        self.held_chars = len(self._head)
+
+        if len(self._head) < self.window and self._need_more():
+            return ''
+        return self._settle()
+
+    def finish(self) -> str:
+        """续写流结束，返回仍暂存的内容"""
+        if self.settled:
+            return ''
+        return self._settle(final=True)
+
+    def _need_more(self) -> bool:
+        head = self._head
+        if self.strip_fence:
+            if head.startswith('```'):
+                newline = head.find('\n')
+                if newline < 0:
+                    return True
+                head = head[newline + 1:]
+            elif '```'.startswith(head):
+                return True
+        # head 出现在 tail 中且不在末尾结束，说明还可能匹配到更长的重叠
+        return not head or self.tail.find(head, 0, len(self.tail) - 1) >= 0
+
+    def _settle(self, final: bool = False) -> str:
+        head = self._head
+        if self.strip_fence and head.startswith('```'):
+            newline = head.find('\n')
+            fence = head[3:newline] if newline >= 0 else head[3:]
+            overlap, rest = self._dedupe(head[newline + 1:] if newline >= 0 else '', final)
+            if fence.strip() or overlap:
+                # 带语言标记，或之后的内容重复了已输出的代码: 模型重新打开了代码块，丢弃这一行
+                self.overlap, head = overlap, rest
+            else:
+                # 单独一行 ``` 且之后是新内容: 这是代码块的结束标记，原样保留
+                self.overlap = 0
+        else:
+            self.overlap, head = self._dedupe(head, final)
+
+        self.settled = True
+        self.settled_at = time.perf_counter()
+        self._head = ''
+        return head
+
+    def _dedupe(self, head: str, final: bool) -> tuple[int, str]:
+        """返回 (重叠长度, 去掉开头重复部分后的 head)"""
+        if final and len(head) >= self.min_overlap and head in self.tail:
+            # 续写流在重复内容尚未结束时就已结束，全部视为重复
+            return len(head), ''
+        overlap = longest_overlap(self.tail, head)
+        if overlap >= self.min_overlap:
+            return overlap, head[overlap:]
+        if self.anchor:
+            anchor = self.tail[-self.anchor:]
+            pos = head.find(anchor)
+            if pos >= 0:
+                return len(anchor), head[pos + len(anchor):]
+        return 0, head
+
+
+def in_code_block(text: str) -> bool:
+    """文本末尾是否处于未闭合的 ``` 代码块中"""
+    return text.count('```') % 2 == 1
@@ -0,0 +1,77 @@
+from app.cache import LRUCache
+from app.models import Usage
+
+# 每条消息的角色与分隔符等固定开销
+MESSAGE_OVERHEAD = 4
+
+# 上游是否返回 usage 的统计(进程级累计)
+token_stats = {"reported": 0, "estimated": 0}
+
+# 按消息文本缓存估算结果；同一请求内(如截断续写各段)文本是同一个字符串对象，其哈希已缓存，查找不需要重新扫描文本
+message_token_cache = LRUCache(4096, 64 * 1024 * 1024, sizeof=lambda item: item[1])
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    近似 token 数: ASCII 字符按 4 个一个 token，其余(中日韩等)字符按 1 个一个 token
+
+    非 ASCII 字符数由 UTF-8 编码长度推算(常见的多字节字符为 3 字节)，只需一次编码，不逐字符遍历
+    """
+    wide = (len(text.encode('utf-8')) - len(text)) // 2
+    return (len(text) - wide + 3) // 4 + wide
+
+
+def message_tokens(message: dict) -> int:
+    """一条 cursor 消息的估算 token 数(含固定开销)，按文本缓存"""
+    text = message['parts'][0]['text']
+    item = message_token_cache.get(text)
+    if item is None:
+        item = (estimate_tokens(text) + MESSAGE_OVERHEAD, len(text))
+        message_token_cache.set(text, item)
+    return item[0]
+
+
+class TokenCounter:
+    """累计流式输出的估算 token 数，逐个增量累加字符数，不保留文本"""
+
+    __slots__ = ('chars', 'wide')
+
+    def __init__(self):
+        self.chars = 0
+        self.wide = 0
+
+    def add(self, text: str):
+        self.chars += len(text)
+        self.wide += (len(text.encode('utf-8')) - len(text)) // 2
+
+    @property
+    def tokens(self) -> int:
+        return (self.chars - self.wide + 3) // 4 + self.wide
+
+
+def estimate_usage(messages: list[dict], completion: TokenCounter) -> Usage:
+    """上游未返回 usage 时，按发送的消息与收到的输出估算"""
+    token_stats["estimated"] += 1
+    prompt_tokens = sum(message_tokens(m) for m in messages)
+    return Usage(prompt_tokens=prompt_tokens, completion_tokens=completion.tokens,
+                 total_tokens=prompt_tokens + completion.tokens, estimated=True)
+
+
+def usage_dict(usage: Usage) -> dict:
+    """OpenAI 格式的 usage，含 prompt_tokens_details / completion_tokens_details"""
+    return {
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens,
+        "total_tokens": usage.total_tokens,
+        "prompt_tokens_details": {
+            "cached_tokens": usage.cached_tokens,
+            "text_tokens": usage.prompt_tokens,
+            "audio_tokens": 0,
+            "image_tokens": 0
+        },
+        "completion_tokens_details": {
+            "text_tokens": usage.completion_tokens - usage.reasoning_tokens,
+            "audio_tokens": 0,
+            "reasoning_tokens": usage.reasoning_tokens
+        },
+    }
@@ -0,0 +1,284 @@
+import asyncio
+import json
+import os
+import re
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Optional
+
+from curl_cffi import AsyncSession
+from loguru import logger
+
+SERVICE_NAME = 'cursorweb2api'
+REQUEST_ID_HEADER = b'x-request-id'
+_VALID_REQUEST_ID = re.compile(r'^[A-Za-z0-9._:-]{1,128}$')
+
+
+class Span:
+    """一段计时区间，属于某个请求的 trace"""
+
+    __slots__ = ('name', 'span_id', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name: str, attributes: dict[str, Any]):
+        self.name = name
+        self.span_id = os.urandom(8).hex()
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.attributes = attributes
+        self.error: Optional[str] = None
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def end(self):
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+
+
+class Trace:
+    """
+    单个请求的 trace
+
+    各层包装器打开的 span 平铺记录在同一个列表里，都挂在根 span(请求本身)下，
+    不维护嵌套关系：异步生成器在调用方的上下文中运行，用 contextvar 维护父子关系会串层。
+    """
+
+    __slots__ = ('request_id', 'trace_id', 'root', 'spans')
+
+    def __init__(self, request_id: str, method: str, path: str):
+        self.request_id = request_id
+        self.trace_id = request_id if re.fullmatch(r'[0-9a-f]{32}', request_id) else uuid.uuid4().hex
+        self.root = Span(f'{method} {path}', {'http.method': method, 'http.target': path})
+        self.spans: list[Span] = []
+
+    def to_dict(self) -> dict[str, Any]:
+        """日志输出格式，时间为相对请求开始的毫秒数"""
+        base = self.root.start_ns
+        end = self.root.end_ns or time.time_ns()
+        return {
+            'request_id': self.request_id,
+            'trace_id': self.trace_id,
+            'name': self.root.name,
+            'duration_ms': round((end - base) / 1e6, 3),
+            'attributes': self.root.attributes,
+            'spans': [{
+                'name': span.name,
+                'start_ms': round((span.start_ns - base) / 1e6, 3),
+                'duration_ms': round(((span.end_ns or end) - span.start_ns) / 1e6, 3),
+                **({'attributes': span.attributes} if span.attributes else {}),
+                **({'error': span.error} if span.error else {}),
+                **({'unfinished': True} if span.end_ns is None else {}),
+            } for span in self.spans],
+        }
+
+
+current_trace: ContextVar[Optional[Trace]] = ContextVar('current_trace', default=None)
+# 未启用导出时不创建 trace，只记录请求 id
+_current_request_id: ContextVar[Optional[str]] = ContextVar('current_request_id', default=None)
+
+
+def current_request_id() -> Optional[str]:
+    return _current_request_id.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    在当前 trace 中记录一个 span，没有 trace 时不做任何事
+    可以包住异步生成器的整个函数体，span 覆盖到生成器结束或被关闭为止
+    """
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    s = Span(name, attributes)
+    trace.spans.append(s)
+    try:
+        yield s
+    except GeneratorExit:
+        s.set(closed=True)
+        raise
+    except BaseException as e:
+        s.error = str(e) or type(e).__name__
+        raise
+    finally:
+        s.end()
+
+
+def record_span(name: str, start_ns: int, **attributes):
+    """记录一个已经结束的 span，用于无法用 with 包住的区间(如 async with 的进入阶段)"""
+    trace = current_trace.get()
+    if trace is None:
+        return
+    s = Span(name, attributes)
+    s.start_ns = start_ns
+    s.end()
+    trace.spans.append(s)
+
+
+def _otlp_value(value: Any) -> dict[str, Any]:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+
+def _otlp_attributes(attributes: dict[str, Any]) -> list[dict[str, Any]]:
+    return [{'key': key, 'value': _otlp_value(value)} for key, value in attributes.items()]
+
+
+def _otlp_span(trace: Trace, span: Span, parent_id: Optional[str], kind: int) -> dict[str, Any]:
+    end_ns = span.end_ns or trace.root.end_ns or time.time_ns()
+    data = {
+        'traceId': trace.trace_id,
+        'spanId': span.span_id,
+        'name': span.name,
+        'kind': kind,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(end_ns),
+        'attributes': _otlp_attributes(span.attributes),
+        'status': {'code': 2, 'message': span.error} if span.error else {'code': 0},
+    }
+    if parent_id:
+        data['parentSpanId'] = parent_id
+    return data
+
+
+class TraceExporter:
+    """
+    trace 导出器
+
+    配置了 otlp_endpoint 时按 OTLP/HTTP JSON 批量发送到 {otlp_endpoint}/v1/traces，
+    否则每个请求输出一行 JSON 日志。
+    """
+
+    def __init__(self, otlp_endpoint: str = '', flush_interval: float = 2.0, max_batch: int = 512):
+        self.otlp_url = otlp_endpoint.rstrip('/') + '/v1/traces' if otlp_endpoint else ''
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+        self._pending: list[Trace] = []
+        self._task: Optional[asyncio.Task] = None
+        self._session: Optional[AsyncSession] = None
+        self.exported = 0
+        self.dropped = 0
+
+    def export(self, trace: Trace):
+        if not self.otlp_url:
+            logger.info(f"trace {json.dumps(trace.to_dict(), ensure_ascii=False, default=str)}")
+            return
+        if len(self._pending) >= self.max_batch * 4:
+            # 导出端跟不上时丢弃，不让 trace 堆积占用内存
+            self.dropped += 1
+            return
+        self._pending.append(trace)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def _flush_loop(self):
+        while self._pending:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            await self._send(batch)
+
+    async def _send(self, batch: list[Trace]):
+        spans = []
+        for trace in batch:
+            spans.append(_otlp_span(trace, trace.root, None, 2))
+            spans.extend(_otlp_span(trace, s, trace.root.span_id, 1) for s in trace.spans)
+        payload = {'resourceSpans': [{
+            'resource': {'attributes': _otlp_attributes({'service.name': SERVICE_NAME})},
+            'scopeSpans': [{'scope': {'name': SERVICE_NAME}, 'spans': spans}],
+        }]}
+        if self._session is None:
+            self._session = AsyncSession(timeout=10)
+        try:
+            response = await self._session.post(self.otlp_url, json=payload)
+            if response.status_code >= 400:
+                logger.warning(f"trace 导出失败: {response.status_code} {response.text[:200]}")
+                self.dropped += len(batch)
+                return
+            self.exported += len(batch)
+        except Exception as e:
+            logger.warning(f"trace 导出失败: {e}")
+            self.dropped += len(batch)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class TracingMiddleware:
+    """
+    纯 ASGI 中间件: 为每个请求创建 trace 并在响应头中返回 X-Request-Id
+    请求自带合法的 X-Request-Id 时沿用；响应(含流)发送完毕后导出 trace。
+    没有 exporter 时不创建 trace(各层的 span 不做任何事)，只返回 X-Request-Id
+    """
+
+    def __init__(self, app, exporter: Optional[TraceExporter] = None, paths: tuple[str, ...] = ('/v1/',)):
+        self.app = app
+        self.exporter = exporter
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith(self.paths):
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope['headers']:
+            if name == REQUEST_ID_HEADER:
+                value = value.decode('latin-1')
+                if _VALID_REQUEST_ID.match(value):
+                    request_id = value
+                break
+        request_id = request_id or uuid.uuid4().hex
+        header = (REQUEST_ID_HEADER, request_id.encode('latin-1'))
+        id_token = _current_request_id.set(request_id)
+        if self.exporter is None:
+            async def send_with_request_id(message):
+                if message['type'] == 'http.response.start':
+                    message['headers'] = [*message.get('headers', []), header]
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_request_id)
+            finally:
+                _current_request_id.reset(id_token)
+            return
+
+        trace = Trace(request_id, scope['method'], scope['path'])
+
+        async def send_with_trace(message):
+            if message['type'] == 'http.response.start':
+                message['headers'] = [*message.get('headers', []), header]
+                trace.root.set(**{'http.status_code': message['status']})
+            await send(message)
+
+        token = current_trace.set(trace)
+        try:
+            await self.app(scope, receive, send_with_trace)
+        except BaseException as e:
+            trace.root.error = str(e) or type(e).__name__
+            raise
+        finally:
+            current_trace.reset(token)
+            _current_request_id.reset(id_token)
+            trace.root.end()
+            # 没有任何 span 的请求(如模型列表)只返回 X-Request-Id，不导出
+            if trace.spans or trace.root.error:
+                self.exporter.export(trace)
@@ -5,15 +5,30 @@ import random
 import string
 import time
 import uuid
+from contextlib import aclosing
 from functools import wraps
-from typing import Union, Callable, Any, AsyncGenerator, Dict
+from typing import Union, Callable, Any, AsyncGenerator, Dict, Optional, Awaitable
 
 from curl_cffi.requests.exceptions import RequestException
+from loguru import logger
 from sse_starlette import EventSourceResponse
+from starlette.background import BackgroundTask, BackgroundTasks
 from starlette.responses import JSONResponse
 
+from app.circuit import CircuitOpenError
 from app.errors import CursorWebError
-from app.models import ChatCompletionRequest, Usage, ToolCall, Message
+from app.metrics import EMPTY_RETRIES, TRUNCATION_CONTINUATIONS, ERROR_RETRIES, ABORTED_STREAMS, FAILED_STREAMS, \
+    current_model
+from app.models import ChatCompletionRequest, Usage, ToolCall, Message, OpenAITool
+from app.retry import current_retry_state
+from app.serializer import ChunkTemplate
+from app.text import TextAccumulator, OverlapMatcher, in_code_block
+from app.tokens import usage_dict
+from app.tracing import span
+
+
+# 流式响应统计(进程级累计): 正常结束与客户端断开中止的数量
+stream_stats = {"completed": 0, "aborted": 0, "failed": 0}
 
 
 async def safe_stream_wrapper(
@@ -27,59 +42,95 @@ async def safe_stream_wrapper(
     generator = generator_func(*args, **kwargs)
 
     # 尝试获取第一个值
-    first_item = await generator.__anext__()
+    with span('safe_stream_wrapper.first_item'):
+        first_item = await generator.__anext__()
+
+    model = current_model()
 
     # 如果成功获取第一个值，创建新的生成器包装原生成器
     async def wrapped_generator():
-        # 先yield第一个值
-        yield first_item
-        # 然后yield剩余的值
-        async for item in generator:
-            yield item
-
-    # 创建流响应
+        outcome = None
+        try:
+            # 先yield第一个值
+            yield first_item
+            # 然后yield剩余的值
+            async for item in generator:
+                yield item
+            outcome = "completed"
+        except (GeneratorExit, asyncio.CancelledError):
+            # 客户端断开: sse_starlette 取消发送任务，或后台任务关闭响应体
+            outcome = "aborted"
+            raise
+        except Exception as e:
+            outcome = "failed"
+            FAILED_STREAMS.inc(model, type(e).__name__)
+            logger.error(f"流式响应中途出错: {e!r}")
+            raise
+        finally:
+            # 逐层关闭内层生成器，客户端断开时上游连接随之关闭，不再发起后续重试/续写
+            await generator.aclose()
+            if outcome is not None:
+                stream_stats[outcome] += 1
+            if outcome == "aborted":
+                ABORTED_STREAMS.inc(model)
+                logger.info("客户端断开，已中止流式响应")
+
+    stream = wrapped_generator()
+    # 客户端断开时 sse_starlette 只取消发送任务，不会关闭响应体，由后台任务负责关闭
     return EventSourceResponse(
-        wrapped_generator(),
+        stream,
         media_type="text/event-stream",
         headers={
             "Cache-Control": "no-cache",
             "Connection": "keep-alive",
             "X-Accel-Buffering": "no",
         },
+        background=BackgroundTasks([BackgroundTask(stream.aclose)]),
     )
 
 
 async def error_wrapper(func: Callable, *args, **kwargs) -> Any:
+    """
+    出错重试包装器: 每次尝试都重新调用 func(生成器等资源需在 func 内创建，不能跨尝试复用)，
+    可重试的错误按当前请求的重试策略退避后重试，否则返回错误响应
+    """
     from .config import MAX_RETRIES
+    retry = current_retry_state()
     for attempt in range(MAX_RETRIES + 1):  # 包含初始尝试，所以是 MAX_RETRIES + 1
         try:
-            return await func(*args, **kwargs)
+            with span('error_wrapper', attempt=attempt):
+                return await func(*args, **kwargs)
+        except CircuitOpenError as e:
+            # 熔断期间重试没有意义
+            return error_response(e)
         except (CursorWebError, RequestException) as e:
-
-            # 如果已经达到最大重试次数，返回错误响应
-            if attempt == MAX_RETRIES:
-                if isinstance(e, CursorWebError):
-                    return JSONResponse(
-                        e.to_openai_error(),
-                        status_code=e.response_status_code
-                    )
-                elif isinstance(e, RequestException):
-                    return JSONResponse(
-                        {
-                            'error': {
-                                'message': str(e),
-                                "type": "http_error",
-                                "code": "http_error"
-                            }
-                        },
-                        status_code=500
-                    )
-
-            if attempt < MAX_RETRIES:
+            if attempt < MAX_RETRIES and await retry.backoff(e, attempt):
+                ERROR_RETRIES.inc(current_model())
                 continue
+            return error_response(e)
     return None
 
 
+def error_response(e: Union[CursorWebError, RequestException, CircuitOpenError]) -> JSONResponse:
+    if isinstance(e, CircuitOpenError):
+        return JSONResponse(e.to_openai_error(), status_code=503, headers={"Retry-After": str(e.retry_after)})
+    if isinstance(e, CursorWebError):
+        return JSONResponse(
+            e.to_openai_error(),
+            status_code=e.response_status_code
+        )
+    return JSONResponse(
+        {
+            'error': {
+                'message': str(e),
+                "type": "http_error",
+                "code": "http_error"
+            }
+        },
+        status_code=500
+    )
+
+
 def decode_base64url_safe(data):
     """使用安全的base64url解码"""
     # 添加必要的填充
@@ -116,29 +167,48 @@ def normalize_tool_name(name: str) -> str:
     return name.replace('_', '-')
 
 
-def match_tool_name(tool_name: str, available_tools: list[str]) -> str:
+class ToolSet:
+    """一组工具定义预先渲染好的提示词与工具名索引"""
+
+    __slots__ = ('prompt', 'names', 'normalized_names')
+
+    def __init__(self, tools: list[OpenAITool]):
+        self.prompt = "你可用的工具: " + json.dumps([tool.model_dump_json() for tool in tools])
+        self.names = frozenset(tool.function.name for tool in tools)
+        # 标准化名称 -> 实际名称,同一标准化名称保留最先出现的工具
+        self.normalized_names: dict[str, str] = {}
+        for tool in tools:
+            self.normalized_names.setdefault(normalize_tool_name(tool.function.name), tool.function.name)
+
+
+def get_tool_set(request: ChatCompletionRequest) -> ToolSet:
+    """
+    取请求的 ToolSet，同一请求的各次上游调用(截断续写、空回复重试、对冲)只渲染一次
+    不跨请求缓存: 按内容计算缓存键需要序列化全部工具定义，比直接渲染还慢
+    """
+    tool_set = request._tool_set
+    if tool_set is None:
+        tool_set = request._tool_set = ToolSet(request.tools)
+    return tool_set
+
+
+def match_tool_name(tool_name: str, tool_set: ToolSet) -> str:
     """
     匹配工具名称，如果不在列表中则尝试标准化匹配
 
     Args:
         tool_name: 需要匹配的工具名
-        available_tools: 可用的工具名列表
+        tool_set: 可用工具集合
 
     Returns:
         匹配到的实际工具名，如果没有匹配返回原名称
     """
     # 直接匹配
-    if tool_name in available_tools:
+    if tool_name in tool_set.names:
         return tool_name
 
-    # 标准化后匹配
-    normalized_input = normalize_tool_name(tool_name)
-    for available_tool in available_tools:
-        if normalize_tool_name(available_tool) == normalized_input:
-            return available_tool
-
-    # 没有匹配，返回原名称
-    return tool_name
+    # 标准化后匹配，没有匹配返回原名称
+    return tool_set.normalized_names.get(normalize_tool_name(tool_name), tool_name)
 
 
 async def non_stream_chat_completion(
@@ -149,24 +219,26 @@ async def non_stream_chat_completion(
     非流式响应：接受外部异步生成器，收集所有输出返回完整响应
     """
     # 收集所有流式输出
-    full_content = ""
+    full_content = TextAccumulator()
     tool_calls = []
     usage = Usage(prompt_tokens=0, completion_tokens=0, total_tokens=0)
-    async for chunk in generator:
-        if isinstance(chunk, Usage):
-            usage = chunk
-            continue
-        if isinstance(chunk, ToolCall):
-            tool_calls.append({
-                "id": chunk.toolId,
-                "type": "function",
-                "function": {
-                    "name": chunk.toolName,
-                    "arguments": chunk.toolInput,
-                }
-            })
-            continue
-        full_content += chunk
+    async with aclosing(generator):
+        with span('non_stream_chat_completion'):
+            async for chunk in generator:
+                if isinstance(chunk, Usage):
+                    usage = chunk
+                    continue
+                if isinstance(chunk, ToolCall):
+                    tool_calls.append({
+                        "id": chunk.toolId,
+                        "type": "function",
+                        "function": {
+                            "name": chunk.toolName,
+                            "arguments": chunk.toolInput,
+                        }
+                    })
+                    continue
+                full_content.append(chunk)
 
     # 构造OpenAI格式的响应
     response = {
@@ -179,17 +251,13 @@ async def non_stream_chat_completion(
                 "index": 0,
                 "message": {
                     "role": "assistant",
-                    "content": full_content,
+                    "content": full_content.getvalue(),
                     "tool_calls": tool_calls
                 },
                 "finish_reason": "stop"
             }
         ],
-        "usage": {
-            "prompt_tokens": usage.prompt_tokens,
-            "completion_tokens": usage.completion_tokens,
-            "total_tokens": usage.total_tokens
-        }
+        "usage": usage_dict(usage)
     }
 
     return response
@@ -204,129 +272,173 @@ async def stream_chat_completion(
     """
     chat_id = f"chatcmpl-{uuid.uuid4().hex[:29]}"
     created_time = int(time.time())
+    template = ChunkTemplate(chat_id, created_time, request.model)
 
     is_send_init = False
 
-    # 发送初始流式响应头
-    initial_response = {
-        "id": chat_id,
-        "object": "chat.completion.chunk",
-        "created": created_time,
-        "model": request.model,
-        "choices": [
-            {
-                "index": 0,
-                "delta": {"role": "assistant", "content": ""},
-                "finish_reason": None
-            }
-        ]
-    }
-
     # 流式发送内容
     usage = None
     tool_call_idx = 0
-    async for chunk in generator:
-        if not is_send_init:
-            yield {
-                "data": json.dumps(initial_response, ensure_ascii=False)
-            }
-            is_send_init = True
-        if isinstance(chunk, Usage):
-            usage = chunk
-            continue
-
-        if isinstance(chunk, ToolCall):
-            data = {
-                "id": chat_id,
-                "object": "chat.completion.chunk",
-                "created": created_time,
-                "model": request.model,
-                "choices": [
-                    {
-                        "index": 0,
-                        "delta": {
-                            "tool_calls": [
-                                {
-                                    "index": tool_call_idx,
-                                    "id": chunk.toolId,
-                                    "type": "function",
-                                    "function": {
-                                        "name": chunk.toolName,
-                                        "arguments": chunk.toolInput,
-                                    },
-                                }
-                            ]
-                        },
-                        "finish_reason": None,
+    async with aclosing(generator):
+        with span('stream_chat_completion'):
+            async for chunk in generator:
+                if not is_send_init:
+                    # 发送初始流式响应头
+                    yield {
+                        "data": template.delta({"role": "assistant", "content": ""})
                     }
-                ],
-            }
-            tool_call_idx += 1
-            yield {'data': json.dumps(data, ensure_ascii=False)}
-            continue
+                    is_send_init = True
+                if isinstance(chunk, Usage):
+                    usage = chunk
+                    continue
+
+                if isinstance(chunk, ToolCall):
+                    data = template.delta({
+                        "tool_calls": [
+                            {
+                                "index": tool_call_idx,
+                                "id": chunk.toolId,
+                                "type": "function",
+                                "function": {
+                                    "name": chunk.toolName,
+                                    "arguments": chunk.toolInput,
+                                },
+                            }
+                        ]
+                    })
+                    tool_call_idx += 1
+                    yield {'data': data}
+                    continue
 
-        chunk_response = {
-            "id": chat_id,
-            "object": "chat.completion.chunk",
-            "created": created_time,
-            "model": request.model,
-            "choices": [
-                {
-                    "index": 0,
-                    "delta": {"content": chunk},
-                    "finish_reason": None
-                }
-            ]
-        }
-        yield {"data": json.dumps(chunk_response, ensure_ascii=False)}
+                yield {"data": template.content(chunk)}
 
     # 发送结束标记
-    final_response = {
-        "id": chat_id,
-        "object": "chat.completion.chunk",
-        "created": created_time,
-        "model": request.model,
-        "choices": [
-            {
-                "index": 0,
-                "delta": {},
-                "finish_reason": "stop"
-            }
-        ]
-    }
-    yield {"data": json.dumps(final_response, ensure_ascii=False)}
+    yield {"data": template.delta({}, finish_reason="stop")}
     if usage:
-        usage_data = {"id": chat_id, "object": "chat.completion.chunk",
-                      "created": created_time, "model": request.model,
-                      "choices": [],
-                      "usage": {"prompt_tokens": usage.prompt_tokens,
-                                "completion_tokens": usage.completion_tokens,
-                                "total_tokens": usage.total_tokens, "prompt_tokens_details": {
-                              "cached_tokens": 0,
-                              "text_tokens": 0,
-                              "audio_tokens": 0,
-                              "image_tokens": 0
-                          },
-                                "completion_tokens_details": {
-                                    "text_tokens": 0,
-                                    "audio_tokens": 0,
-                                    "reasoning_tokens": 0
-                                },
-                                "input_tokens": 0,
-                                "output_tokens": 0,
-                                "input_tokens_details": None}
-                      }
+        usage_data = template.extend(
+            choices=[],
+            usage={
+                **usage_dict(usage),
+                "input_tokens": usage.prompt_tokens,
+                "output_tokens": usage.completion_tokens,
+                "input_tokens_details": None
+            }
+        )
 
         yield {
-            "data": json.dumps(usage_data, ensure_ascii=False)
+            "data": usage_data
         }
     yield {"data": "[DONE]"}
 
 
+# 增量合并统计(进程级累计)
+coalesce_stats = {"responses": 0, "events_in": 0, "events_out": 0}
+
+
+async def _anext(iterator):
+    return await iterator.__anext__()
+
+
+async def coalesce_wrapper(
+        generator: AsyncGenerator[Union[str, Usage, ToolCall], None],
+        window: float,
+        max_chars: int
+) -> AsyncGenerator[Union[str, Usage, ToolCall], None]:
+    """
+    增量合并包装器:把时间窗口内的多个文本增量合并成一个,减少SSE事件与写入次数
+
+    首个文本增量立即输出以保证首字延迟;之后缓冲的文本在窗口到期或累计字符数达到阈值时输出;
+    遇到工具调用、usage以及流结束时先输出缓冲区
+
+    Args:
+        generator: 上游输出
+        window: 合并窗口(秒)
+        max_chars: 缓冲区字符数阈值
+
+    Yields:
+        str/Usage/ToolCall: 合并后的流式输出
+    """
+    loop = asyncio.get_running_loop()
+    iterator = generator.__aiter__()
+    buffer: list[str] = []
+    buffered_chars = 0
+    deadline = 0.0
+    pending = None
+    events_in = 0
+    events_out = 0
+    first_sent = False
+
+    try:
+        while True:
+            if pending is None and not buffer:
+                try:
+                    chunk = await iterator.__anext__()
+                except StopAsyncIteration:
+                    break
+            else:
+                if pending is None:
+                    pending = asyncio.create_task(_anext(iterator))
+                if buffer:
+                    done, _ = await asyncio.wait({pending}, timeout=max(deadline - loop.time(), 0))
+                    if not done:
+                        # 窗口到期,输出缓冲区后继续等待同一个读取任务
+                        events_out += 1
+                        yield "".join(buffer)
+                        buffer = []
+                        buffered_chars = 0
+                        continue
+                task, pending = pending, None
+                try:
+                    chunk = await task
+                except StopAsyncIteration:
+                    break
+
+            if isinstance(chunk, str):
+                events_in += 1
+                if not first_sent:
+                    first_sent = True
+                    events_out += 1
+                    yield chunk
+                    continue
+                if not buffer:
+                    deadline = loop.time() + window
+                buffer.append(chunk)
+                buffered_chars += len(chunk)
+                if buffered_chars >= max_chars:
+                    events_out += 1
+                    yield "".join(buffer)
+                    buffer = []
+                    buffered_chars = 0
+                continue
+
+            # 工具调用/usage 前先输出缓冲区
+            if buffer:
+                events_out += 1
+                yield "".join(buffer)
+                buffer = []
+                buffered_chars = 0
+            yield chunk
+
+        if buffer:
+            events_out += 1
+            yield "".join(buffer)
+    finally:
+        if pending is not None:
+            # 读取任务正在驱动上游生成器，先取消并等它结束，才能关闭生成器
+            pending.cancel()
+            await asyncio.wait({pending})
+        await generator.aclose()
+        coalesce_stats["responses"] += 1
+        coalesce_stats["events_in"] += events_in
+        coalesce_stats["events_out"] += events_out
+        logger.debug(f"增量合并: {events_in} 个增量合并为 {events_out} 个事件, 节省 {events_in - events_out} 个")
+
+
 async def empty_retry_wrapper(
         cursor_chat_func: Callable,
         request: ChatCompletionRequest,
-        max_retries: int = 3
+        max_retries: int = 3,
+        **kwargs
 ) -> AsyncGenerator[Union[str, Usage, ToolCall], None]:
     """
     空回复重试包装器:检测到空回复时自动重试
@@ -335,6 +447,7 @@ async def empty_retry_wrapper(
         cursor_chat_func: cursor_chat函数
         request: 聊天请求
         max_retries: 最大重试次数
+        kwargs: 只传给首次调用的额外参数(如预先准备好的请求头),重试时不再复用
 
     Yields:
         str/Usage/ToolCall: 流式输出
@@ -342,42 +455,87 @@ async def empty_retry_wrapper(
     Raises:
         CursorWebError: 重试后仍然空回复
     """
+    retry = current_retry_state()
     for retry_count in range(max_retries + 1):
-        generator = cursor_chat_func(request)
         has_content = False
+        usage = None
+
+        async with aclosing(cursor_chat_func(request, **(kwargs if retry_count == 0 else {}))) as generator:
+            with span('empty_retry_attempt', attempt=retry_count):
+                async for chunk in generator:
+                    if isinstance(chunk, ToolCall):
+                        # 工具调用算有内容,之后只会有 usage
+                        has_content = True
+                        if usage is not None:
+                            yield usage
+                            usage = None
+                        yield chunk
 
-        async for chunk in generator:
-            if isinstance(chunk, ToolCall):
-                # 工具调用算有内容
-                has_content = True
-                yield chunk
-                return
-
-            elif isinstance(chunk, Usage):
-                # Usage直接透传
-                yield chunk
+                    elif isinstance(chunk, Usage):
+                        # 确认有内容后再输出,空回复的 Usage 随该次尝试丢弃
+                        usage = chunk
 
-            else:
-                # 文本内容
-                has_content = True
-                yield chunk
+                    else:
+                        # 文本内容
+                        has_content = True
+                        yield chunk
 
         # 如果有内容,正常返回
         if has_content:
+            if usage is not None:
+                yield usage
             return
 
-        # 没有内容且还有重试次数,继续重试
-        if retry_count < max_retries:
+        # 没有内容且还有重试次数(及重试预算),退避后重试
+        if retry_count < max_retries and await retry.backoff(None, retry_count):
+            EMPTY_RETRIES.inc(request.model)
             continue
+        break
+
+    # 重试次数或预算用尽仍然空回复,抛出异常
+    raise CursorWebError(200, f"空回复重试{retry_count}次后仍然失败")
+
+
+# 上游单次回复的 completion token 上限,达到即视为截断
+TRUNCATION_TOKEN_LIMIT = 4096
 
-    # 达到最大重试次数仍然空回复,抛出异常
-    raise CursorWebError(200, f"空回复重试{max_retries}次后仍然失败")
+# 截断续写去重统计(进程级累计)
+overlap_stats = {"continuations": 0, "overlap_chars": 0, "held_chars": 0, "holdback_seconds": 0.0}
+# 截断续写衔接统计(进程级累计): 边界数、预先准备次数、截断确认到下一段首个输出的停顿
+continuation_stats = {"boundaries": 0, "prepared": 0, "stall_seconds": 0.0, "max_stall_seconds": 0.0}
+
+
+async def _await_prepared(task: Optional[asyncio.Task]) -> dict[str, Any]:
+    """取预先准备的结果,失败时退回常规路径"""
+    if task is None:
+        return {}
+    try:
+        return await task
+    except (CursorWebError, RequestException) as e:
+        logger.warning(f"预先准备续写请求失败,改为常规请求: {e}")
+        return {}
+    except Exception as e:
+        # 如 x-is-human 计算脚本执行失败(CalledProcessError),常规路径会重新计算并按原有方式处理错误
+        logger.exception(f"预先准备续写请求出错,改为常规请求: {e}")
+        return {}
+
+
+def _add_usage(a: Usage, b: Usage) -> Usage:
+    return Usage(prompt_tokens=a.prompt_tokens + b.prompt_tokens,
+                 completion_tokens=a.completion_tokens + b.completion_tokens,
+                 total_tokens=a.total_tokens + b.total_tokens,
+                 cached_tokens=a.cached_tokens + b.cached_tokens,
+                 reasoning_tokens=a.reasoning_tokens + b.reasoning_tokens,
+                 estimated=a.estimated or b.estimated)
 
 
 async def truncation_continue_wrapper(
         cursor_chat_func: Callable,
         request: ChatCompletionRequest,
-        max_retries: int = 10
+        max_retries: int = 10,
+        overlap_window: int = 64,
+        prepare_func: Optional[Callable[[ChatCompletionRequest], Awaitable[dict[str, Any]]]] = None,
+        prepare_ratio: float = 0.8
 ) -> AsyncGenerator[Union[str, Usage, ToolCall], None]:
     """
     截断继续包装器:实时流式输出,检测到截断时自动重试
@@ -386,92 +544,110 @@ async def truncation_continue_wrapper(
         cursor_chat_func: cursor_chat函数
         request: 聊天请求
         max_retries: 最大重试次数
+        overlap_window: 续写去重时比对的已输出内容末尾长度
+        prepare_func: 预先准备下一段请求的函数,返回值作为参数传给下一次 cursor_chat_func;
+            当前段估算的 token 数达到上限的 prepare_ratio 时在后台启动,截断确认后直接使用
+        prepare_ratio: 启动预先准备的 token 比例
 
     Yields:
         str/Usage/ToolCall: 流式输出
     """
-    full_content = ""  # 累积的完整内容
-    total_prompt_tokens = 0
-    total_completion_tokens = 0
-    total_tokens = 0
-    current_usage = None
-
-    for retry_count in range(max_retries + 1):
-        generator = cursor_chat_func(request)
-        current_content = ""  # 当前轮次的内容
-        is_truncated = False
-        buffer = ""  # 缓冲区,仅在重试时使用
-        buffer_yielded = False  # 标记是否已经处理并输出过缓冲区
-
-        async for chunk in generator:
-            if isinstance(chunk, Usage):
-                current_usage = chunk
-                # 累加token统计
-                total_prompt_tokens += chunk.prompt_tokens
-                total_completion_tokens += chunk.completion_tokens
-                total_tokens += chunk.total_tokens
-
-                # 检查是否截断
-                is_truncated = chunk.completion_tokens == 4096
-                break
-
-            elif isinstance(chunk, ToolCall):
-                # 工具调用直接返回
-                yield chunk
+    full_content = TextAccumulator()  # 累积的完整内容
+    # 各段 usage 累加，最终输出整个回复的用量
+    total_usage: Optional[Usage] = None
+    prepare_threshold = TRUNCATION_TOKEN_LIMIT * prepare_ratio
+    prepare_task: Optional[asyncio.Task] = None
+    truncated_at: Optional[float] = None  # 截断确认的时间,用于统计衔接停顿
+
+    try:
+        for retry_count in range(max_retries + 1):
+            prepared = await _await_prepared(prepare_task)
+            prepare_task = None
+            is_truncated = False
+            tool_called = False
+            # 本段的 token 估算: 增量个数与字符数/4 取较大者
+            segment_deltas = 0
+            segment_chars = 0
+            # 续写时先经过重叠匹配器,去掉模型重复输出的已有内容
+            matcher = None
+            if retry_count > 0:
+                matcher = OverlapMatcher(full_content.tail(overlap_window), overlap_window,
+                                         strip_fence=in_code_block(full_content.getvalue()))
+
+            async with aclosing(cursor_chat_func(request, **prepared)) as generator:
+                with span('truncation_segment', segment=retry_count, prepared=bool(prepared)):
+                    async for chunk in generator:
+                        if truncated_at is not None:
+                            stall = time.perf_counter() - truncated_at
+                            truncated_at = None
+                            continuation_stats["stall_seconds"] += stall
+                            continuation_stats["max_stall_seconds"] = max(continuation_stats["max_stall_seconds"], stall)
+                            logger.debug(f"截断续写衔接停顿 {stall * 1000:.0f}ms (预先准备: {bool(prepared)})")
+
+                        if isinstance(chunk, Usage):
+                            # 累加token统计
+                            total_usage = chunk if total_usage is None else _add_usage(total_usage, chunk)
+
+                            # 检查是否截断(本地估算的 usage 无法判断);未截断时继续读完本段,usage 之后可能还有工具调用
+                            is_truncated = (not tool_called and not chunk.estimated
+                                            and chunk.completion_tokens == TRUNCATION_TOKEN_LIMIT)
+                            if is_truncated:
+                                break
+
+                        elif isinstance(chunk, ToolCall):
+                            # 工具调用后不再续写,读完本段剩余的 usage 后结束
+                            if matcher is not None:
+                                held = matcher.finish()
+                                if held:
+                                    full_content.append(held)
+                                    yield held
+                            tool_called = True
+                            is_truncated = False
+                            yield chunk
+
+                        else:
+                            # 文本内容
+                            if prepare_func is not None and prepare_task is None and retry_count < max_retries:
+                                segment_deltas += 1
+                                segment_chars += len(chunk)
+                                if max(segment_deltas, segment_chars // 4) >= prepare_threshold:
+                                    # 接近上限,后台准备下一段请求
+                                    prepare_task = asyncio.create_task(prepare_func(request))
+                            if matcher is not None:
+                                chunk = matcher.feed(chunk)
+                                if not chunk:
+                                    continue
+                            full_content.append(chunk)
+                            yield chunk
+
+            # 处理流结束时仍暂存的内容
+            if matcher is not None:
+                held = matcher.finish()
+                if held:
+                    full_content.append(held)
+                    yield held
+                overlap_stats["continuations"] += 1
+                overlap_stats["overlap_chars"] += matcher.overlap
+                overlap_stats["held_chars"] += matcher.held_chars
+                overlap_stats["holdback_seconds"] += matcher.holdback_seconds
+                logger.debug(f"续写去重: 重叠 {matcher.overlap} 字符, 暂存 {matcher.held_chars} 字符, "
+                             f"暂存耗时 {matcher.holdback_seconds * 1000:.2f}ms")
+
+            # 检查是否被截断
+            if not is_truncated:
+                # 未被截断,返回最终usage
+                if total_usage:
+                    yield total_usage
                 return
 
-            else:
-                # 文本内容
-                current_content += chunk
-
-                if retry_count == 0:
-                    # 第一次请求,实时输出
-                    yield chunk
-                else:
-                    # 重试时,使用缓冲区
-                    buffer += chunk
-                    last_10_chars = full_content[-10:] if len(full_content) >= 10 else full_content
-
-                    if not buffer_yielded:
-                        # 检查缓冲区是否包含last_10_chars
-                        if last_10_chars and last_10_chars in buffer:
-                            # 找到匹配,移除并输出剩余部分
-                            buffer = buffer.replace(last_10_chars, "", 1)
-                            if buffer:
-                                yield buffer
-                            buffer = ""
-                            buffer_yielded = True
-                        elif len(buffer) > 20:
-                            # 缓冲区超过20字符还没匹配,直接输出
-                            yield buffer
-                            buffer = ""
-                            buffer_yielded = True
-                    else:
-                        # 已经处理过缓冲区,直接实时输出
-                        yield chunk
-                        buffer = ""
-
-        # 处理流结束后的缓冲区
-        if retry_count > 0 and buffer:
-            last_10_chars = full_content[-10:] if len(full_content) >= 10 else full_content
-            if not buffer_yielded and last_10_chars and last_10_chars in buffer:
-                buffer = buffer.replace(last_10_chars, "", 1)
-            if buffer:
-                yield buffer
-
-        # 更新累积内容
-        full_content += current_content
-
-        # 检查是否被截断
-        if not is_truncated:
-            # 未被截断,返回最终usage
-            if current_usage:
-                yield current_usage
-            return
-
             # 被截断,构造继续对话
-        last_10_chars = full_content[-10:] if len(full_content) >= 10 else full_content
-        continue_prompt = f'''你的回复在"{last_10_chars}"处意外中断。
+            truncated_at = time.perf_counter()
+            continuation_stats["boundaries"] += 1
+            TRUNCATION_CONTINUATIONS.inc(request.model)
+            if prepare_task is not None:
+                continuation_stats["prepared"] += 1
+            last_10_chars = full_content.tail(10)
+            continue_prompt = f'''你的回复在"{last_10_chars}"处意外中断。
 
         请直接从该处继续输出，遵循以下规则：
         1. 以"{last_10_chars}"开头，紧接新内容
@@ -486,19 +662,18 @@ async def truncation_continue_wrapper(
 
         立即继续，不要解释或重新开始。'''
 
-        # 重新构造上下文
-        new_messages = request.messages.copy()
-        new_messages.append(Message(role="assistant", content=full_content, tool_calls=None, tool_call_id=None))
-        new_messages.append(Message(role="user", content=continue_prompt, tool_calls=None, tool_call_id=None))
+            # 重新构造上下文
+            new_messages = request.messages.copy()
+            new_messages.append(Message.continuation("assistant", full_content.getvalue()))
+            new_messages.append(Message.continuation("user", continue_prompt))
 
-        request = ChatCompletionRequest(
-            messages=new_messages,
-            stream=request.stream,
-            model=request.model,
-            tools=request.tools
-        )
+            # 复制请求，保留已渲染的工具集合
+            request = request.model_copy(update={'messages': new_messages})
+    finally:
+        if prepare_task is not None:
+            prepare_task.cancel()
 
     # 达到最大重试次数,返回最终usage
 
-    if current_usage:
-        yield current_usage
+    if total_usage:
+        yield total_usage
@@ -0,0 +1,63 @@
+"""
+长回复文本累加基准：str += vs TextAccumulator(app/text.py)
+
+打印不同回复长度下每个 token 的平均累加耗时，线性实现的每 token 耗时应保持平稳。
+"str += (shared)" 模拟字符串同时被其他引用持有的情况(如截断续写中在多处保存内容)，
+此时 CPython 无法原地扩容，每次追加都要复制整串。
+
+用法(在项目根目录执行):
+    python -m benchmarks.bench_accumulate
+"""
+import time
+
+from app.text import TextAccumulator
+
+TOKEN = "abcd"
+SIZES = (1_000, 10_000, 50_000, 100_000, 200_000)
+
+
+def concat_local(n_tokens: int) -> str:
+    content = ""
+    for _ in range(n_tokens):
+        content += TOKEN
+    return content
+
+
+def concat_shared(n_tokens: int) -> str:
+    content = ""
+    refs = []
+    for _ in range(n_tokens):
+        refs.append(content)
+        content += TOKEN
+        refs.pop()
+    return content
+
+
+def accumulator(n_tokens: int) -> str:
+    content = TextAccumulator()
+    for _ in range(n_tokens):
+        content.append(TOKEN)
+    return content.getvalue()
+
+
+def per_token_ns(func, n_tokens: int, repeat: int = 3) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(n_tokens)
+        best = min(best, time.perf_counter() - start)
+    return best / n_tokens * 1e9
+
+
+def main():
+    funcs = [("str += (local)", concat_local), ("str += (shared)", concat_shared),
+             ("TextAccumulator", accumulator)]
+    print(f"{'chars':>10} " + " ".join(f"{name:>18}" for name, _ in funcs) + "   (ns/token)")
+    for size in SIZES:
+        n_tokens = size // len(TOKEN)
+        row = [per_token_ns(func, n_tokens) for _, func in funcs]
+        print(f"{size:>10} " + " ".join(f"{v:>18.0f}" for v in row))
+
+
+if __name__ == '__main__':
+    main()
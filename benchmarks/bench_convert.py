@@ -0,0 +1,89 @@
+"""
+消息转换基准: 每个请求转换全部历史消息(to_cursor_messages 中的 convert_message)的耗时
+
+对比三种实现:
+    no cache        不缓存，每次都序列化工具调用
+    blake2b key     以 blake2b(model_dump_json()) 为键缓存每条消息(旧实现)
+    convert_message 当前实现: 普通消息直接取文本，只有带工具调用的消息按 (id, 名称, 参数) 缓存
+
+每次请求使用新解析出的消息对象(与真实请求一致，不能靠对象身份命中缓存)，缓存均已预热。
+
+用法(在项目根目录执行):
+    python -m benchmarks.bench_convert
+"""
+import hashlib
+import json
+import time
+
+import main as server
+from app.cache import LRUCache
+from app.models import Message
+
+SIZES = (20, 200, 1000)
+REQUESTS = 20
+
+
+def conversation(n_messages: int) -> list[dict]:
+    """每 4 条消息为一轮: user 提问、assistant 工具调用、工具结果、assistant 回答"""
+    messages = [{'role': 'system', 'content': '你是一个编程助手。' * 20}]
+    for i in range(n_messages // 4):
+        call_id = f'call_{i:08d}'
+        arguments = json.dumps({'path': f'src/module_{i}.py', 'start': 1, 'end': 200})
+        messages += [
+            {'role': 'user', 'content': f'请检查 module_{i} 中的问题并给出修改建议。' * 10},
+            {'role': 'assistant', 'content': None, 'tool_calls': [
+                {'id': call_id, 'type': 'function', 'function': {'name': 'read_file', 'arguments': arguments}}]},
+            {'role': 'tool', 'tool_call_id': call_id, 'content': f'def handler_{i}(request):\n    pass\n' * 40},
+            {'role': 'assistant', 'content': f'module_{i} 的 handler 缺少错误处理，建议补充。' * 8},
+        ]
+    return messages
+
+
+def convert_uncached(m: Message) -> dict:
+    if m.tool_calls:
+        text = f"tool_calls: {json.dumps(m.tool_calls, ensure_ascii=False)}"
+        return {'role': m.role, 'parts': [{'type': 'text', 'text': text}]}
+    if m.tool_call_id:
+        return {'role': 'user', 'parts': [{'type': 'text', 'text': f"{m.role}: tool_call_id: {m.tool_call_id} {m.content}"}]}
+    return {'role': m.role, 'parts': [{'type': 'text', 'text': m.content if isinstance(m.content, str) else ''}]}
+
+
+blake2b_cache = LRUCache(100000)
+
+
+def convert_blake2b(m: Message) -> dict:
+    key = hashlib.blake2b(m.model_dump_json().encode('utf-8'), digest_size=16).digest()
+    message = blake2b_cache.get(key)
+    if message is None:
+        message = convert_uncached(m)
+        blake2b_cache.set(key, message)
+    return message
+
+
+def per_request_us(convert, requests: list[list[Message]]) -> float:
+    for m in requests[0]:
+        convert(m)
+    best = float('inf')
+    for _ in range(3):
+        start = time.perf_counter()
+        for messages in requests:
+            for m in messages:
+                convert(m)
+        best = min(best, time.perf_counter() - start)
+    return best / len(requests) * 1e6
+
+
+def main():
+    server.ENABLE_FUNCTION_CALLING = True
+    funcs = [("no cache", convert_uncached), ("blake2b key", convert_blake2b),
+             ("convert_message", server.convert_message)]
+    print(f"{'messages':>10} " + " ".join(f"{name:>16}" for name, _ in funcs) + "   (us/request)")
+    for size in SIZES:
+        raw = conversation(size)
+        requests = [[Message.model_validate(m) for m in raw] for _ in range(REQUESTS)]
+        row = [per_request_us(func, requests) for _, func in funcs]
+        print(f"{len(raw):>10} " + " ".join(f"{v:>16.0f}" for v in row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+端到端压测：启动本地模拟上游(benchmarks/mock_upstream.py)与服务本身，在不同并发下发送聊天请求
+
+输出每种模式(流式/非流式)与并发数下的 req/s、首 token 延迟(TTFT)与 token 间隔的分位数，
+以及压测期间服务进程的峰值 RSS。上游参数(token 数、速率、错误注入、截断)与 mock_upstream 相同。
+
+用法(在项目根目录执行):
+    python -m benchmarks.bench_load --concurrency 1,10,100,1000 --tokens 200 --token-rate 500
+    python -m benchmarks.bench_load --modes stream --tokens 9000   # 触发截断续写(需 TRUNCATION_CONTINUE=true)
+    HEDGE=true python -m benchmarks.bench_load --slow-rate 0.05 --slow-delay 5   # 对比开启对冲前后的首 token 延迟长尾
+
+服务的其余环境变量(如 STREAM_COALESCE、MAX_CONCURRENT_REQUESTS)从当前环境继承。
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+from typing import Optional
+
+from curl_cffi import AsyncSession
+
+from benchmarks import mock_upstream
+
+API_KEY = 'bench'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def read_rss(pid: int) -> int:
+    """进程当前 RSS(字节)，仅支持 Linux"""
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return 0
+
+
+def percentile(values: list[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = (len(values) - 1) * p
+    lo = int(k)
+    hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+
+async def wait_ready(url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    async with AsyncSession() as session:
+        while time.monotonic() < deadline:
+            try:
+                await session.get(url, headers={'Authorization': f'Bearer {API_KEY}'}, timeout=1)
+                return
+            except Exception:
+                await asyncio.sleep(0.2)
+    raise SystemExit(f"等待 {url} 就绪超时")
+
+
+class Result:
+    def __init__(self):
+        self.ok = 0
+        self.failed = 0
+        self.ttft: list[float] = []
+        self.gaps: list[float] = []
+        self.latency: list[float] = []
+
+
+async def one_request(session: AsyncSession, url: str, payload: dict, stream: bool, result: Result):
+    started_at = time.perf_counter()
+    headers = {'Authorization': f'Bearer {API_KEY}'}
+    try:
+        if not stream:
+            response = await session.post(url, json=payload, headers=headers)
+            if response.status_code != 200:
+                result.failed += 1
+                return
+            result.ttft.append(time.perf_counter() - started_at)
+        else:
+            async with session.stream('POST', url, json={**payload, 'stream': True}, headers=headers) as response:
+                if response.status_code != 200:
+                    await response.acontent()
+                    result.failed += 1
+                    return
+                last = None
+                async for line in response.aiter_lines():
+                    if not line.startswith(b'data: {'):
+                        continue
+                    if b'"content":""' in line or b'"content"' not in line:
+                        continue
+                    now = time.perf_counter()
+                    if last is None:
+                        result.ttft.append(now - started_at)
+                    else:
+                        result.gaps.append(now - last)
+                    last = now
+        result.ok += 1
+        result.latency.append(time.perf_counter() - started_at)
+    except Exception:
+        result.failed += 1
+
+
+async def run_level(url: str, stream: bool, concurrency: int, total: int, pid: int) -> tuple[Result, float, int]:
+    payload = {'model': 'gpt-4o', 'messages': [{'role': 'user', 'content': 'hello'}]}
+    result = Result()
+    queue = asyncio.Queue()
+    for _ in range(total):
+        queue.put_nowait(None)
+    peak_rss = read_rss(pid)
+    done = asyncio.Event()
+
+    async def sample_rss():
+        nonlocal peak_rss
+        while not done.is_set():
+            peak_rss = max(peak_rss, read_rss(pid))
+            await asyncio.sleep(0.1)
+
+    async def worker(session: AsyncSession):
+        while not queue.empty():
+            queue.get_nowait()
+            await one_request(session, url, payload, stream, result)
+
+    sampler = asyncio.create_task(sample_rss())
+    started_at = time.perf_counter()
+    async with AsyncSession(max_clients=concurrency, timeout=300) as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started_at
+    done.set()
+    await sampler
+    return result, elapsed, peak_rss
+
+
+def start_processes(args: argparse.Namespace) -> tuple[subprocess.Popen, subprocess.Popen, str, str]:
+    """启动模拟上游与服务，返回 (上游进程, 服务进程, 服务地址, 上游地址)"""
+    upstream_port = free_port()
+    app_port = free_port()
+    upstream_base = f'http://127.0.0.1:{upstream_port}'
+    upstream_cmd = [sys.executable, '-m', 'benchmarks.mock_upstream', '--port', str(upstream_port),
+                    '--tokens', str(args.tokens), '--token-rate', str(args.token_rate),
+                    '--error-rate', str(args.error_rate), '--empty-rate', str(args.empty_rate)]
+    if args.no_truncate:
+        upstream_cmd.append('--no-truncate')
+    if args.no_usage:
+        upstream_cmd.append('--no-usage')
+    if args.sse_file:
+        upstream_cmd += ['--sse-file', args.sse_file]
+    if args.recording:
+        upstream_cmd += ['--recording', args.recording, '--replay-speed', str(args.replay_speed)]
+    if args.slow_rate:
+        upstream_cmd += ['--slow-rate', str(args.slow_rate), '--slow-delay', str(args.slow_delay)]
+    if args.seed is not None:
+        upstream_cmd += ['--seed', str(args.seed)]
+    upstream = subprocess.Popen(upstream_cmd)
+
+    env = {
+        **os.environ,
+        'API_KEY': API_KEY,
+        'CURSOR_BASE_URL': upstream_base,
+        'SCRIPT_URL': f'{upstream_base}/script.js',
+        'X_IS_HUMAN_SERVER_URL': f'{upstream_base}/x-is-human',
+        'TRACING': os.environ.get('TRACING', 'false'),
+    }
+    app = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'main:app', '--port', str(app_port),
+                            '--log-level', 'warning', '--no-access-log'], env=env, stdout=subprocess.DEVNULL)
+    return upstream, app, f'http://127.0.0.1:{app_port}', upstream_base
+
+
+async def run(args: argparse.Namespace):
+    upstream, app, base, _ = start_processes(args)
+    try:
+        await wait_ready(f'{base}/v1/models')
+        url = f'{base}/v1/chat/completions'
+        print(f"{'mode':<11}{'conc':>6}{'reqs':>7}{'fail':>6}{'req/s':>9}{'ttft p50':>10}{'p90':>9}{'p99':>9}"
+              f"{'itl p50':>10}{'p99':>9}{'rss MB':>9}")
+        for mode in args.modes:
+            stream = mode == 'stream'
+            for concurrency in args.concurrency:
+                total = max(concurrency * args.rounds, args.min_requests)
+                result, elapsed, peak_rss = await run_level(url, stream, concurrency, total, app.pid)
+                ms = lambda v: f'{v * 1000:.1f}'
+                print(f"{mode:<11}{concurrency:>6}{total:>7}{result.failed:>6}{result.ok / elapsed:>9.1f}"
+                      f"{ms(percentile(result.ttft, 0.5)):>10}{ms(percentile(result.ttft, 0.9)):>9}"
+                      f"{ms(percentile(result.ttft, 0.99)):>9}{ms(percentile(result.gaps, 0.5)):>10}"
+                      f"{ms(percentile(result.gaps, 0.99)):>9}{peak_rss / 1024 / 1024:>9.1f}")
+        if args.stats:
+            async with AsyncSession() as session:
+                response = await session.get(f'{base}/v1/stats', headers={'Authorization': f'Bearer {API_KEY}'})
+                print(json.dumps(response.json(), ensure_ascii=False, indent=2))
+    finally:
+        for process in (app, upstream):
+            process.terminate()
+        for process in (app, upstream):
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description='端到端压测')
+    parser.add_argument('--concurrency', default='1,10,100,1000',
+                        type=lambda s: [int(v) for v in s.split(',')], help='并发数列表，逗号分隔')
+    parser.add_argument('--modes', default='stream,non-stream', type=lambda s: s.split(','),
+                        help='stream、non-stream，逗号分隔')
+    parser.add_argument('--rounds', type=int, default=5, help='每个并发连接发送的请求数')
+    parser.add_argument('--min-requests', type=int, default=20, help='每档最少请求数')
+    parser.add_argument('--stats', action='store_true', help='结束时输出服务的 /v1/stats')
+    mock_upstream.add_arguments(parser)
+    asyncio.run(run(parser.parse_args(argv)))
+
+
+if __name__ == '__main__':
+    main()
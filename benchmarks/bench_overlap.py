@@ -0,0 +1,129 @@
+"""
+截断续写重叠匹配(app/text.py OverlapMatcher)的用例校验与暂存延迟统计
+
+每个用例给出截断前已输出的内容、续写流的分段以及期望最终拼接出的完整文本，
+覆盖续写提示词试图处理的几种情况：重复末尾、重复代码块标记、无重叠、带前言等。
+续写流按给定分段和逐字符两种方式输入，输出必须一致。
+
+用法(在项目根目录执行):
+    python -m benchmarks.bench_overlap
+"""
+import time
+
+from app.text import OverlapMatcher, in_code_block
+
+# (名称, 已输出内容, 续写分段, 期望完整文本)
+FIXTURES = [
+    (
+        "重复末尾10个字符",
+        "def main():\n    print('hello')",
+        ["print('hel", "lo')\n    return 0\n"],
+        "def main():\n    print('hello')\n    return 0\n",
+    ),
+    (
+        "重复超过10个字符",
+        "The quick brown fox jumps over",
+        ["brown fox jumps over", " the lazy dog."],
+        "The quick brown fox jumps over the lazy dog.",
+    ),
+    (
+        "代码块内重复```语言标记",
+        "```javascript\nlet a=1;\ndocument.",
+        ["```java", "script\ndocument.createElement('div');\n```"],
+        "```javascript\nlet a=1;\ndocument.createElement('div');\n```",
+    ),
+    (
+        "代码块内重复```但无重叠",
+        "```python\nimport os\n",
+        ["```python\n", "import sys\n```"],
+        "```python\nimport os\nimport sys\n```",
+    ),
+    (
+        "代码块内直接续写",
+        "```python\nfor i in range(10):\n",
+        ["    print(i)\n```"],
+        "```python\nfor i in range(10):\n    print(i)\n```",
+    ),
+    (
+        "代码块外以```开头属于新内容",
+        "示例如下：\n",
+        ["```bash\n", "ls -la\n```"],
+        "示例如下：\n```bash\nls -la\n```",
+    ),
+    (
+        "无重叠直接续写",
+        "第一部分结束。",
+        ["第二部分开始，", "内容继续。"],
+        "第一部分结束。第二部分开始，内容继续。",
+    ),
+    (
+        "KMP回退: 部分匹配后失配",
+        "xx abcabcabd",
+        ["abcabd", " tail"],
+        "xx abcabcabd tail",
+    ),
+    (
+        "带前言后重复末尾",
+        "return result;\n}\n\nfunction next() {",
+        ["继续：\nfunction next() {\n  return 1;\n}"],
+        "return result;\n}\n\nfunction next() {\n  return 1;\n}",
+    ),
+    (
+        "单字符巧合重叠不去重",
+        "列表结束。",
+        ["。下一段"],
+        "列表结束。。下一段",
+    ),
+    (
+        "续写流在重叠判定前结束",
+        "abcdefghijklmnop",
+        ["klmno"],
+        "abcdefghijklmnop",
+    ),
+]
+
+# 前言去除只作用于已暂存的内容，逐字符到达时前言会在判定无重叠后立即输出
+CHUNKED_ONLY = {"带前言后重复末尾"}
+
+
+def run(tail: str, chunks: list[str], window: int = 64) -> tuple[str, OverlapMatcher]:
+    matcher = OverlapMatcher(tail[-window:], window, strip_fence=in_code_block(tail))
+    out = [tail]
+    for chunk in chunks:
+        out.append(matcher.feed(chunk))
+    out.append(matcher.finish())
+    return "".join(out), matcher
+
+
+def main():
+    failed = 0
+    print(f"{'用例':<28}{'分段':>6}{'逐字符':>8}{'重叠':>6}{'暂存字符':>10}")
+    for name, tail, chunks, expected in FIXTURES:
+        got, matcher = run(tail, chunks)
+        got_chars, matcher_chars = run(tail, list("".join(chunks)))
+        chars_ok = got_chars == expected or name in CHUNKED_ONLY
+        ok = got == expected and chars_ok
+        failed += not ok
+        print(f"{name:<28}{'ok' if got == expected else 'FAIL':>6}{('ok' if chars_ok else 'FAIL'):>8}"
+              f"{matcher.overlap:>6}{matcher_chars.held_chars:>10}")
+        if not ok:
+            print(f"    期望: {expected!r}\n    分段: {got!r}\n    逐字符: {got_chars!r}")
+
+    # 暂存延迟：逐字符输入时从第一段到开始输出的耗时
+    tail = "x" * 40 + "document.createElement"
+    chunks = list("document.createElement('div');" * 4)
+    n = 2000
+    start = time.perf_counter()
+    for _ in range(n):
+        run(tail, chunks)
+    elapsed = (time.perf_counter() - start) / n
+    _, matcher = run(tail, chunks)
+    print(f"\n逐字符续写 {len(chunks)} 段: 每次 {elapsed * 1e6:.1f}us, 暂存 {matcher.held_chars} 字符, "
+          f"暂存期间 {matcher.holdback_seconds * 1e6:.1f}us")
+
+    if failed:
+        raise SystemExit(f"{failed} 个用例失败")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+"""
+用录制的上游事件流(app/recording.py)测量本地处理链路的开销
+
+回放不等待录制中的时间间隔，只测 CPU 开销：字节流解析(parse_upstream_events)、
+包装器链(truncation_continue_wrapper / empty_retry_wrapper)与流式序列化(stream_chat_completion)。
+--profile 时输出 cProfile 的前若干项。
+
+录制: 服务端设置 UPSTREAM_RECORD_DIR=recordings 运行一段时间
+用法(在项目根目录执行):
+    python -m benchmarks.bench_replay recordings [--rounds 20] [--profile]
+"""
+import argparse
+import asyncio
+import cProfile
+import pstats
+import time
+
+from app.models import ChatCompletionRequest, Message
+from app.recording import Replayer
+from app.utils import empty_retry_wrapper, truncation_continue_wrapper, stream_chat_completion
+from main import parse_upstream_events
+
+
+async def replay_once(replayer: Replayer, wrappers: bool) -> tuple[int, int]:
+    """回放所有录制各一次，返回 (输出事件数, 输入字节数)"""
+    request = ChatCompletionRequest(model='gpt-4o', stream=True, messages=[
+        Message(role='user', content='hello', tool_calls=None, tool_call_id=None)])
+    events = 0
+    size = 0
+    for recording in replayer.recordings:
+        size += recording.size
+        chat_func = lambda req, **kwargs: parse_upstream_events(req, replayer.chunks(recording))
+        if wrappers:
+            retry_func = lambda req, **kwargs: empty_retry_wrapper(chat_func, req, max_retries=0, **kwargs)
+            generator = truncation_continue_wrapper(retry_func, request, max_retries=0)
+        else:
+            generator = chat_func(request)
+        async for _ in stream_chat_completion(request, generator):
+            events += 1
+    return events, size
+
+
+async def run(args: argparse.Namespace):
+    replayer = Replayer(args.path, speed=0)
+    print(f"{len(replayer.recordings)} 个录制, 共 {sum(r.size for r in replayer.recordings)} 字节")
+    for wrappers in (False, True):
+        await replay_once(replayer, wrappers)
+        start = time.perf_counter()
+        events = size = 0
+        for _ in range(args.rounds):
+            e, s = await replay_once(replayer, wrappers)
+            events += e
+            size += s
+        elapsed = time.perf_counter() - start
+        name = '解析+包装器+序列化' if wrappers else '解析+序列化'
+        print(f"{name:<12} {events / elapsed:>10.0f} 事件/s  {elapsed / events * 1e6:>7.2f}us/事件  "
+              f"{size / elapsed / 1024 / 1024:>7.1f}MB/s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='录制回放处理链路基准')
+    parser.add_argument('path', help='录制文件或目录')
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--profile', action='store_true')
+    args = parser.parse_args()
+    if not args.profile:
+        asyncio.run(run(args))
+        return
+    profiler = cProfile.Profile()
+    profiler.runcall(asyncio.run, run(args))
+    pstats.Stats(profiler).sort_stats('cumulative').print_stats(25)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+上游SSE解析微基准：逐行解析(旧实现) vs 增量字节解码器(app/sse.py)
+
+用法(在项目根目录执行):
+    python -m benchmarks.bench_sse [事件数]
+"""
+import json
+import random
+import sys
+import time
+
+from app.sse import SSEDecoder, decode_event
+
+
+def build_stream(n_events: int) -> bytes:
+    """构造与上游形态一致的事件流"""
+    events = [{"type": "start"}, {"type": "start-step"}, {"type": "text-start", "id": "0"}]
+    words = ["Hello", " world", "，", "你好", " the", " quick", " brown", " fox", "\n", "```", "python"]
+    for _ in range(n_events):
+        events.append({"type": "text-delta", "id": "0", "delta": random.choice(words)})
+    events += [{"type": "text-end", "id": "0"}, {"type": "finish-step"},
+               {"type": "finish", "messageMetadata": {
+                   "usage": {"inputTokens": 10, "outputTokens": n_events, "totalTokens": n_events + 10}}}]
+    body = b''.join(b'data: ' + json.dumps(e, ensure_ascii=False, separators=(',', ':')).encode() + b'\n\n'
+                    for e in events)
+    return body + b'data: [DONE]\n\n'
+
+
+def split_chunks(body: bytes, min_size: int = 16, max_size: int = 512) -> list[bytes]:
+    """按随机大小切块，模拟网络分包(事件会跨块)"""
+    chunks = []
+    i = 0
+    while i < len(body):
+        size = random.randint(min_size, max_size)
+        chunks.append(body[i:i + size])
+        i += size
+    return chunks
+
+
+def iter_lines(chunks: list[bytes]):
+    """等价于 aiter_lines 的按行切分"""
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            chunk = pending + chunk
+        lines = chunk.splitlines()
+        if lines and lines[-1] and chunk and lines[-1][-1] == chunk[-1]:
+            pending = lines.pop()
+        else:
+            pending = None
+        yield from lines
+    if pending is not None:
+        yield pending
+
+
+def parse_sse_line(line: str):
+    line = line.strip()
+    if line.startswith("data: "):
+        return line[6:]
+    return None
+
+
+def legacy_path(chunks: list[bytes], log) -> list:
+    out = []
+    for line in iter_lines(chunks):
+        line = line.decode("utf-8")
+        log(line)
+        data = parse_sse_line(line)
+        if not data:
+            continue
+        try:
+            event_data = json.loads(data)
+        except json.JSONDecodeError:
+            continue
+        if event_data.get('type') == 'finish':
+            out.append(event_data['messageMetadata']['usage']['outputTokens'])
+            continue
+        delta = event_data.get('delta')
+        if delta:
+            out.append(delta)
+    return out
+
+
+def decoder_path(chunks: list[bytes]) -> list:
+    out = []
+    decoder = SSEDecoder()
+    for chunk in chunks:
+        for data in decoder.feed(chunk):
+            event_data = decode_event(data)
+            if event_data is None:
+                continue
+            if event_data.get('type') == 'finish':
+                out.append(event_data['messageMetadata']['usage']['outputTokens'])
+                continue
+            delta = event_data.get('delta')
+            if delta:
+                out.append(delta)
+    return out
+
+
+def bench(name: str, func, repeat: int, n_events: int) -> float:
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    print(f"{name:<28} {best * 1e3:8.2f} ms  {best / n_events * 1e9:8.0f} ns/event")
+    return best
+
+
+def main():
+    n_events = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    random.seed(0)
+    chunks = split_chunks(build_stream(n_events))
+
+    try:
+        from loguru import logger
+        logger.remove()
+        logger.add(sys.stderr, level="INFO")
+        log = logger.debug
+    except ImportError:
+        def log(_):
+            pass
+
+    assert legacy_path(chunks, log) == decoder_path(chunks), "两种实现输出不一致"
+
+    print(f"{n_events} 个事件, {len(chunks)} 个字节块")
+    legacy = bench("legacy (per-line)", lambda: legacy_path(chunks, log), 5, n_events)
+    decoder = bench("SSEDecoder", lambda: decoder_path(chunks), 5, n_events)
+    print(f"加速比 {legacy / decoder:.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+客户端断开检查：流式请求读到一半时断开，确认取消沿包装器链传递到上游，没有泄漏连接
+
+启动本地模拟上游与服务，并发发起若干慢速流式请求，读到若干个增量后直接断开，等待片刻后检查:
+- 模拟上游没有仍在输出的事件流(上游连接已关闭)
+- 会话池没有被占用的会话，准入控制没有进行中的请求
+- 服务统计的中止流数等于断开的请求数
+任一项不满足时以非零状态退出。
+
+用法(在项目根目录执行):
+    python -m benchmarks.check_disconnect [--clients 20] [--read 3]
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import time
+from typing import Optional
+from urllib.parse import urlsplit
+
+from curl_cffi import AsyncSession
+
+from benchmarks import mock_upstream
+from benchmarks.bench_load import API_KEY, start_processes, wait_ready
+
+
+async def read_then_disconnect(url: str, payload: dict, n_deltas: int) -> bool:
+    """读到 n_deltas 个增量后直接断开 TCP 连接，返回是否读到"""
+    parsed = urlsplit(url)
+    body = json.dumps(payload).encode()
+    reader, writer = await asyncio.open_connection(parsed.hostname, parsed.port)
+    writer.write(f'POST {parsed.path} HTTP/1.1\r\nHost: {parsed.netloc}\r\n'
+                 f'Authorization: Bearer {API_KEY}\r\nContent-Type: application/json\r\n'
+                 f'Content-Length: {len(body)}\r\n\r\n'.encode() + body)
+    received = 0
+    try:
+        while received < n_deltas:
+            line = await asyncio.wait_for(reader.readline(), 60)
+            if not line:
+                break
+            if line.startswith(b'data: {') and b'"content":"' in line and b'"content":""' not in line:
+                received += 1
+    finally:
+        # 不发送剩余数据也不等待响应结束，模拟客户端异常断开
+        writer.transport.abort()
+    return received >= n_deltas
+
+
+async def get_json(url: str) -> dict:
+    async with AsyncSession() as session:
+        response = await session.get(url, headers={'Authorization': f'Bearer {API_KEY}'})
+        return response.json()
+
+
+async def run(args: argparse.Namespace) -> bool:
+    upstream, app, base, upstream_base = start_processes(args)
+    try:
+        await wait_ready(f'{base}/v1/models')
+        payload = {'model': 'gpt-4o', 'stream': True, 'messages': [{'role': 'user', 'content': 'hello'}]}
+        results = await asyncio.gather(*(read_then_disconnect(f'{base}/v1/chat/completions', payload, args.read)
+                                         for _ in range(args.clients)))
+        if not all(results):
+            print(f"{results.count(False)} 个请求未读到 {args.read} 个增量")
+            return False
+
+        # 断开后给服务与上游一点时间完成清理
+        deadline = time.monotonic() + args.settle
+        while True:
+            upstream_stats = await get_json(f'{upstream_base}/stats')
+            app_stats = await get_json(f'{base}/v1/stats')
+            checks = {
+                '上游仍在输出的事件流': (upstream_stats['active_streams'], 0),
+                '会话池占用': (app_stats['session_pool'].get('in_use', 0), 0),
+                '准入控制进行中请求': (app_stats['admission']['in_flight'], 0),
+                '中止的流式响应': (app_stats['streams']['aborted'], args.clients),
+            }
+            ok = all(actual == expected for actual, expected in checks.values())
+            if ok or time.monotonic() > deadline:
+                break
+            await asyncio.sleep(0.2)
+        for name, (actual, expected) in checks.items():
+            print(f"{'OK  ' if actual == expected else 'FAIL'} {name}: {actual} (期望 {expected})")
+        return ok
+    finally:
+        for process in (app, upstream):
+            process.terminate()
+        for process in (app, upstream):
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+
+def main(argv: Optional[list[str]] = None):
+    parser = argparse.ArgumentParser(description='客户端断开检查')
+    parser.add_argument('--clients', type=int, default=20, help='并发断开的流式请求数')
+    parser.add_argument('--read', type=int, default=3, help='断开前读取的增量数')
+    parser.add_argument('--settle', type=float, default=5.0, help='断开后等待清理的最长秒数')
+    mock_upstream.add_arguments(parser)
+    # 上游输出慢且长，保证断开时上游仍在输出
+    parser.set_defaults(tokens=2000, token_rate=20, no_truncate=True)
+    ok = asyncio.run(run(parser.parse_args(argv)))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,199 @@
+"""
+本地模拟上游：代替 cursor.com 提供 /api/chat 事件流，供压测与回归使用
+
+- GET  /script.js      反爬脚本(内容无意义)
+- POST /x-is-human     纯算服务器接口，配合 X_IS_HUMAN_SERVER_URL 使用，跳过 node 计算
+- POST /api/chat       按给定速率输出 text-delta 事件，最后输出带 usage 的 finish 事件
+- GET  /stats          已收到的请求数与仍在输出的事件流数
+
+可配置 token 速率、每个回复的 token 数、错误注入比例、首 token 延迟比例以及 4096 token 截断；
+--sse-file 指定抓取的原始事件流(data: 行)时，按其中的增量分布循环回放；
+--recording 指定录制文件或目录(app/recording.py)时，按录制的字节块与时间原样回放。
+
+用法(在项目根目录执行):
+    python -m benchmarks.mock_upstream --port 9000 --tokens 300 --token-rate 200
+
+服务端配置:
+    CURSOR_BASE_URL=http://127.0.0.1:9000
+    SCRIPT_URL=http://127.0.0.1:9000/script.js
+    X_IS_HUMAN_SERVER_URL=http://127.0.0.1:9000/x-is-human
+"""
+import argparse
+import asyncio
+import json
+import random
+from typing import Optional
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from starlette.routing import Route
+
+from app.recording import Replayer
+from app.utils import TRUNCATION_TOKEN_LIMIT
+
+DEFAULT_WORDS = ["Hello", " world", "，", "你好", " the", " quick", " brown", " fox", "\n", "```", "python", " def",
+                 " return", " 0", ";", " 数据", "处理", "。"]
+
+
+def _event(data: dict) -> bytes:
+    return b'data: ' + json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8') + b'\n\n'
+
+
+def load_deltas(path: str) -> list[str]:
+    """从原始事件流文件中取出所有 text-delta 的增量"""
+    deltas = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.startswith('data: '):
+                continue
+            try:
+                event = json.loads(line[6:])
+            except json.JSONDecodeError:
+                continue
+            if isinstance(event, dict) and event.get('delta'):
+                deltas.append(event['delta'])
+    if not deltas:
+        raise SystemExit(f"{path} 中没有 text-delta 事件")
+    return deltas
+
+
+class MockUpstream:
+    def __init__(self, tokens: int = 200, token_rate: float = 0.0, error_rate: float = 0.0,
+                 empty_rate: float = 0.0, truncate: bool = True, deltas: Optional[list[str]] = None,
+                 seed: Optional[int] = None, replayer: Optional[Replayer] = None, slow_rate: float = 0.0,
+                 slow_delay: float = 0.0, usage: bool = True):
+        """
+        Args:
+            tokens: 每个回复输出的 token(增量)数
+            token_rate: 每秒输出的 token 数，0 表示不限速
+            error_rate: 直接返回 500 的比例
+            empty_rate: 返回无内容事件流的比例(触发空回复重试)
+            truncate: token 数超过 4096 时按上游行为分段截断
+            deltas: 回放的增量序列，未提供时随机生成
+            replayer: 录制回放器，提供时忽略 token 数、速率与截断设置
+            slow_rate: 首个 token 延迟输出的比例(模拟首 token 耗时的长尾)
+            slow_delay: 延迟输出首个 token 的秒数
+            usage: finish 事件是否携带 usage(不携带时由代理本地估算)
+        """
+        self.tokens = tokens
+        self.token_rate = token_rate
+        self.error_rate = error_rate
+        self.empty_rate = empty_rate
+        self.truncate = truncate
+        self.deltas = deltas
+        self.replayer = replayer
+        self.slow_rate = slow_rate
+        self.slow_delay = slow_delay
+        self.usage = usage
+        self.random = random.Random(seed)
+        self.requests = 0
+        # 尚未结束(未读完也未被对端关闭)的事件流数
+        self.active_streams = 0
+
+    def _delta(self, i: int) -> str:
+        if self.deltas:
+            return self.deltas[i % len(self.deltas)]
+        return self.random.choice(DEFAULT_WORDS)
+
+    async def chat(self, request: Request):
+        self.requests += 1
+        body = await request.json()
+        if self.random.random() < self.error_rate:
+            return PlainTextResponse('mock upstream error', status_code=500)
+        if self.replayer is not None:
+            return StreamingResponse(self._track(self.replayer.chunks()), media_type='text/event-stream')
+
+        if self.random.random() < self.empty_rate:
+            n_tokens = 0
+        elif self.truncate:
+            # 续写请求中每条 assistant 消息对应已输出的一段
+            segment = sum(1 for m in body.get('messages', []) if m.get('role') == 'assistant')
+            remaining = max(self.tokens - segment * TRUNCATION_TOKEN_LIMIT, 1)
+            n_tokens = min(remaining, TRUNCATION_TOKEN_LIMIT)
+        else:
+            n_tokens = self.tokens
+        offset = self.random.randrange(len(self.deltas)) if self.deltas else 0
+        first_delay = self.slow_delay if self.random.random() < self.slow_rate else 0.0
+        return StreamingResponse(self._track(self._stream(n_tokens, offset, first_delay)),
+                                 media_type='text/event-stream')
+
+    async def _track(self, chunks):
+        self.active_streams += 1
+        try:
+            async for chunk in chunks:
+                yield chunk
+        finally:
+            self.active_streams -= 1
+
+    async def _stream(self, n_tokens: int, offset: int, first_delay: float = 0.0):
+        yield _event({"type": "start"}) + _event({"type": "start-step"}) + _event({"type": "text-start", "id": "0"})
+        if first_delay:
+            await asyncio.sleep(first_delay)
+        interval = 1 / self.token_rate if self.token_rate > 0 else 0
+        loop = asyncio.get_running_loop()
+        started_at = loop.time()
+        for i in range(n_tokens):
+            if interval:
+                # 按绝对时间对齐，避免 sleep 误差累积
+                delay = started_at + (i + 1) * interval - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            yield _event({"type": "text-delta", "id": "0", "delta": self._delta(offset + i)})
+        usage = {"inputTokens": 10, "outputTokens": n_tokens, "totalTokens": n_tokens + 10}
+        yield (_event({"type": "text-end", "id": "0"}) + _event({"type": "finish-step"}) +
+               _event({"type": "finish", "messageMetadata": {"usage": usage} if self.usage else {}}) +
+               b'data: [DONE]\n\n')
+
+    async def script(self, _: Request):
+        return PlainTextResponse('/* mock */', media_type='application/javascript')
+
+    async def x_is_human(self, _: Request):
+        return JSONResponse({"s": "mock"})
+
+    async def stats(self, _: Request):
+        return JSONResponse({"requests": self.requests, "active_streams": self.active_streams})
+
+    def app(self) -> Starlette:
+        return Starlette(routes=[
+            Route('/api/chat', self.chat, methods=['POST']),
+            Route('/script.js', self.script, methods=['GET']),
+            Route('/x-is-human', self.x_is_human, methods=['POST']),
+            Route('/stats', self.stats, methods=['GET']),
+        ])
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--tokens', type=int, default=200, help='每个回复的 token 数')
+    parser.add_argument('--token-rate', type=float, default=0.0, help='每秒 token 数，0 表示不限速')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 的比例')
+    parser.add_argument('--empty-rate', type=float, default=0.0, help='返回空回复的比例')
+    parser.add_argument('--no-truncate', action='store_true', help='不模拟 4096 token 截断')
+    parser.add_argument('--sse-file', help='回放的原始事件流文件')
+    parser.add_argument('--recording', help='回放的录制文件或目录')
+    parser.add_argument('--replay-speed', type=float, default=1.0, help='录制回放速度倍数，0 表示不等待')
+    parser.add_argument('--slow-rate', type=float, default=0.0, help='首个 token 延迟输出的比例')
+    parser.add_argument('--slow-delay', type=float, default=5.0, help='延迟输出首个 token 的秒数')
+    parser.add_argument('--no-usage', action='store_true', help='finish 事件不携带 usage')
+    parser.add_argument('--seed', type=int)
+
+
+def from_args(args: argparse.Namespace) -> MockUpstream:
+    return MockUpstream(args.tokens, args.token_rate, args.error_rate, args.empty_rate, not args.no_truncate,
+                        load_deltas(args.sse_file) if args.sse_file else None, args.seed,
+                        Replayer(args.recording, args.replay_speed) if args.recording else None,
+                        args.slow_rate, args.slow_delay, not args.no_usage)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='本地模拟上游')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9000)
+    add_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(from_args(args).app(), host=args.host, port=args.port, log_level='warning')
+
+
+if __name__ == '__main__':
+    main()
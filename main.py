@@ -1,28 +1,108 @@
+import asyncio
 import base64
+import functools
 import json
 import os
 import shutil
 import subprocess
 import tempfile
 import time
-from typing import Optional
+from contextlib import asynccontextmanager, aclosing
+from typing import AsyncIterator, Optional, Union
 
 from curl_cffi import AsyncSession, Response
-from fastapi import FastAPI, Depends, HTTPException
+from fastapi import FastAPI, Depends, HTTPException, Header, Request
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from loguru import logger
+from sse_starlette import EventSourceResponse
 from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, PlainTextResponse, FileResponse
 
 from app.config import SCRIPT_URL, FP, API_KEY, MODELS, SYSTEM_PROMPT_INJECT, TIMEOUT, PROXY, USER_PROMPT_INJECT, \
-    X_IS_HUMAN_SERVER_URL, ENABLE_FUNCTION_CALLING, TRUNCATION_CONTINUE, TRUNCATION_MAX_RETRIES, EMPTY_RETRY_MAX_RETRIES
+    X_IS_HUMAN_SERVER_URL, ENABLE_FUNCTION_CALLING, TRUNCATION_CONTINUE, TRUNCATION_MAX_RETRIES, EMPTY_RETRY_MAX_RETRIES, \
+    SESSION_POOL_SIZE, SESSION_POOL_IDLE_TIMEOUT, SESSION_POOL_MAX_LIFETIME, DEBUG, STREAM_COALESCE, \
+    STREAM_COALESCE_WINDOW_MS, STREAM_COALESCE_MAX_CHARS, TRUNCATION_OVERLAP_WINDOW, TRUNCATION_PREFETCH, \
+    TRUNCATION_PREFETCH_RATIO, CONVERSION_CACHE_SIZE, CONVERSION_CACHE_MAX_BYTES, MAX_CONCURRENT_REQUESTS, \
+    MAX_QUEUE_SIZE, QUEUE_TIMEOUT, TRACING, OTLP_ENDPOINT, UPSTREAM_RECORD_DIR, UPSTREAM_REPLAY, UPSTREAM_REPLAY_SPEED, \
+    CURSOR_BASE_URL, WORKERS, DRAIN_TIMEOUT, RESPONSE_CACHE, RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES, \
+    RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB, RESPONSE_CACHE_DB_SIZE, SINGLE_FLIGHT, HEDGE, HEDGE_PERCENTILE, \
+    HEDGE_MIN_DELAY, HEDGE_MAX_DELAY, HEDGE_MAX_RATE, RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET, RETRY_DEADLINE, \
+    CIRCUIT_BREAKER, CIRCUIT_WINDOW, CIRCUIT_MIN_CALLS, CIRCUIT_FAILURE_RATE, CIRCUIT_OPEN_SECONDS, \
+    CIRCUIT_HALF_OPEN_PROBES, API_KEYS_FILE, BATCH_DIR, BATCH_CONCURRENCY, MODEL_CONTEXT_BUDGETS, CONTEXT_COLLAPSE_CHARS, \
+    CONTEXT_KEEP_TURNS
+from app.admission import AdmissionController, AdmissionRejected
+from app.api_keys import ApiKeyRegistry, ApiKey
+from app.batch import BatchScheduler, BatchError, parse_multipart
+from app.cache import LRUCache
+from app.circuit import CircuitBreaker
+from app.context import ContextBudget, parse_budgets
 from app.errors import CursorWebError
+from app.hedging import HedgePolicy
+from app.lifecycle import GracefulShutdown
+from app.metrics import MetricsMiddleware, current_request, observe_stage, INTER_DELTA_SECONDS, render, \
+    set_known_models
 from app.models import ChatCompletionRequest, Message, ModelsResponse, Model, Usage, OpenAIMessageContent, ToolCall
+from app.recording import Recorder, Replayer
+from app.retry import RetryPolicy, current_retry
+from app.response_cache import ResponseCache, CacheControl, cache_key
+from app.session_pool import SessionPool
+from app.single_flight import SingleFlight
+from app.sse import aiter_sse_data, decode_event
+from app.tokens import TokenCounter, estimate_usage, token_stats, message_token_cache
+from app.tracing import TraceExporter, TracingMiddleware, span, record_span
 from app.utils import error_wrapper, to_async, generate_random_string, non_stream_chat_completion, \
-    stream_chat_completion, safe_stream_wrapper, match_tool_name, truncation_continue_wrapper, empty_retry_wrapper
+    stream_chat_completion, safe_stream_wrapper, match_tool_name, truncation_continue_wrapper, empty_retry_wrapper, \
+    error_response, coalesce_wrapper, coalesce_stats, stream_stats, overlap_stats, continuation_stats, get_tool_set, \
+    ToolSet
+
+session_pool: Optional[SessionPool] = None
+admission = AdmissionController(MAX_CONCURRENT_REQUESTS, MAX_QUEUE_SIZE, QUEUE_TIMEOUT)
+api_keys = ApiKeyRegistry(API_KEY, API_KEYS_FILE)
+set_known_models(MODELS.split(','))
+shutdown = GracefulShutdown(lambda: admission.in_flight, DRAIN_TIMEOUT)
+# 配置了 OTLP_ENDPOINT 即导出 trace，只输出 JSON 日志时才需要 TRACING=true
+trace_exporter = TraceExporter(OTLP_ENDPOINT) if TRACING or OTLP_ENDPOINT else None
+# 上游事件流录制/回放(回放时不访问网络)
+recorder = Recorder(UPSTREAM_RECORD_DIR) if UPSTREAM_RECORD_DIR else None
+replayer = Replayer(UPSTREAM_REPLAY, UPSTREAM_REPLAY_SPEED) if UPSTREAM_REPLAY else None
+retry_policy = RetryPolicy(RETRY_BASE_DELAY, RETRY_MAX_DELAY, RETRY_BUDGET, RETRY_DEADLINE)
+single_flight = SingleFlight() if SINGLE_FLIGHT else None
+breaker = CircuitBreaker(CIRCUIT_WINDOW, CIRCUIT_MIN_CALLS, CIRCUIT_FAILURE_RATE, CIRCUIT_OPEN_SECONDS,
+                         CIRCUIT_HALF_OPEN_PROBES) if CIRCUIT_BREAKER else None
+hedge_policy = HedgePolicy(HEDGE_PERCENTILE, HEDGE_MIN_DELAY, HEDGE_MAX_DELAY, HEDGE_MAX_RATE) if HEDGE else None
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL, RESPONSE_CACHE_DB,
+                               RESPONSE_CACHE_DB_SIZE) if RESPONSE_CACHE else None
+batch_scheduler: Optional[BatchScheduler] = None
+context_budget = ContextBudget(parse_budgets(MODEL_CONTEXT_BUDGETS), CONTEXT_COLLAPSE_CHARS,
+                               CONTEXT_KEEP_TURNS) if MODEL_CONTEXT_BUDGETS else None
+
+
+@asynccontextmanager
+async def lifespan(_: FastAPI):
+    global session_pool, batch_scheduler
+    session_pool = SessionPool(SESSION_POOL_SIZE, SESSION_POOL_IDLE_TIMEOUT, SESSION_POOL_MAX_LIFETIME,
+                               impersonate='chrome', timeout=TIMEOUT, proxy=PROXY)
+    await session_pool.start()
+    if BATCH_DIR:
+        # 排空期间暂停发起新的批处理请求
+        batch_scheduler = BatchScheduler(BATCH_DIR, BATCH_CONCURRENCY, run_batch_request,
+                                         paused=lambda: shutdown.draining)
+        await batch_scheduler.start()
+    shutdown.install()
+    try:
+        yield
+    finally:
+        shutdown.uninstall()
+        if batch_scheduler is not None:
+            await batch_scheduler.close()
+        await session_pool.close()
+        if trace_exporter is not None:
+            await trace_exporter.close()
+        if response_cache is not None:
+            response_cache.close()
 
-main_code = open('./jscode/main.js', 'r', encoding='utf-8').read()
-env_code = open('./jscode/env.js', 'r', encoding='utf-8').read()
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 security = HTTPBearer()
 
@@ -33,33 +113,288 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware, exporter=trace_exporter)
 
 
 @app.post("/v1/chat/completions")
 async def chat_completions(
         request: ChatCompletionRequest,
         credentials: HTTPAuthorizationCredentials = Depends(security),
+        cache_control: Optional[str] = Header(None),
 ):
     """处理聊天完成请求"""
+    timer = current_request.get()
+    if timer is not None:
+        timer.model = request.model
+        timer.stage('parse', timer.received_at)
 
-    if credentials.credentials != API_KEY:
-        raise HTTPException(401, 'api key 错误')
+    client = authenticate(credentials)
+
+    if shutdown.draining:
+        return JSONResponse(AdmissionRejected("服务正在关闭", 1).to_openai_error(), status_code=503,
+                            headers={"Retry-After": "1"})
+
+    try:
+        # 先检查该 key 自身的限额，缓存命中同样计入
+        lease = client.acquire()
+    except AdmissionRejected as e:
+        return rejected_response(e)
 
+    streaming = False
+    try:
+        directives = None
+        key = cache_key(request) if response_cache is not None or single_flight is not None else None
+        if response_cache is not None:
+            directives = CacheControl(cache_control)
+            if directives.lookup:
+                with span('response_cache'):
+                    cached = await response_cache.get(key, directives.max_age)
+                if cached is not None:
+                    # 命中缓存不占用全局并发名额，也不访问上游，但计入该 key 的用量
+                    response = await cached_completion(request, client.track_usage(cached.chunks()))
+                    if isinstance(response, EventSourceResponse):
+                        response.background.add_task(lease.release)
+                        streaming = True
+                    return with_cache_status(response, 'HIT')
+
+        if breaker is not None and breaker.rejecting:
+            # 熔断期间直接拒绝，不占用并发名额(缓存命中仍可正常返回)
+            return error_response(breaker.rejection())
+
+        current_retry.set(retry_policy.start())
+        try:
+            # 按 key 的权重公平排队等待全局并发名额
+            with span('admission'):
+                ticket = await admission.acquire(client.name, client.weight)
+        except AdmissionRejected as e:
+            return rejected_response(e)
+
+        try:
+            def open_chat():
+                generator = chat_generator(request)
+                if directives is not None and directives.store:
+                    generator = response_cache.store(key, generator)
+                return generator
+
+            def open_generator():
+                # 相同的进行中请求共享一个上游生成器
+                generator = single_flight.join(key, open_chat) if single_flight is not None else open_chat()
+                # 合并的请求各自计入所属 key 的用量
+                generator = client.track_usage(generator)
+                if request.stream and STREAM_COALESCE:
+                    generator = coalesce_wrapper(generator, STREAM_COALESCE_WINDOW_MS / 1000,
+                                                 STREAM_COALESCE_MAX_CHARS)
+                return generator
+
+            cache_status = None if directives is None else 'MISS' if directives.lookup else 'BYPASS'
+
+            # 出错重试时重新创建生成器，已出错的生成器不能复用
+            if request.stream:
+                response = await error_wrapper(lambda: safe_stream_wrapper(stream_chat_completion, request,
+                                                                           open_generator()))
+                if isinstance(response, EventSourceResponse):
+                    # 流式响应在流结束(或客户端断开)时才归还名额
+                    response.background.add_task(ticket.release)
+                    response.background.add_task(lease.release)
+                    streaming = True
+                return with_cache_status(response, cache_status)
+            else:
+                return with_cache_status(await error_wrapper(lambda: non_stream_chat_completion(request,
+                                                                                                open_generator())),
+                                         cache_status)
+        finally:
+            if not streaming:
+                ticket.release()
+    finally:
+        if not streaming:
+            lease.release()
+
+
+def rejected_response(e: AdmissionRejected) -> JSONResponse:
+    logger.warning(e.reason)
+    return JSONResponse(e.to_openai_error(), status_code=429, headers={"Retry-After": str(e.retry_after)})
+
+
+def chat_generator(request: ChatCompletionRequest):
+    """经过空回复重试、对冲与截断续写包装的 cursor_chat"""
     # 空回复重试包装器(始终启用)
-    chat_func = lambda req: empty_retry_wrapper(cursor_chat, req, max_retries=EMPTY_RETRY_MAX_RETRIES)
+    chat_func = lambda req, **kwargs: empty_retry_wrapper(hedged_chat if hedge_policy else cursor_chat, req,
+                                                          max_retries=EMPTY_RETRY_MAX_RETRIES, **kwargs)
 
     if TRUNCATION_CONTINUE:
-        chat_generator = truncation_continue_wrapper(chat_func, request, max_retries=TRUNCATION_MAX_RETRIES)
-    else:
-        chat_generator = chat_func(request)
+        return truncation_continue_wrapper(chat_func, request, max_retries=TRUNCATION_MAX_RETRIES,
+                                           overlap_window=TRUNCATION_OVERLAP_WINDOW,
+                                           prepare_func=prepare_chat if TRUNCATION_PREFETCH else None,
+                                           prepare_ratio=TRUNCATION_PREFETCH_RATIO)
+    return chat_func(request)
+
 
-    # async for c in chat_generator:
-    #     logger.debug(c)
+def hedged_chat(request: ChatCompletionRequest, **kwargs):
+    """带对冲的 cursor_chat，预先准备的参数(x-is-human)只给主请求使用"""
+    return hedge_policy.run(lambda hedge: cursor_chat(request, **({} if hedge else kwargs)))
 
+
+async def cached_completion(request: ChatCompletionRequest, chunks: AsyncIterator[Union[str, Usage, ToolCall]]):
+    """用缓存回复的输出构造响应，流式请求以 SSE 回放"""
     if request.stream:
-        return await error_wrapper(safe_stream_wrapper, stream_chat_completion, request, chat_generator)
-    else:
-        return await error_wrapper(non_stream_chat_completion, request, chat_generator)
+        return await safe_stream_wrapper(stream_chat_completion, request, chunks)
+    return await non_stream_chat_completion(request, chunks)
+
+
+def with_cache_status(response, status: Optional[str]):
+    """在响应头 X-Cache 中标明缓存状态(HIT/MISS/BYPASS)，未启用缓存时原样返回"""
+    if status is None:
+        return response
+    if isinstance(response, dict):
+        response = JSONResponse(response)
+    response.headers['X-Cache'] = status
+    return response
+
+
+async def run_batch_request(request: ChatCompletionRequest, owner: str) -> tuple[int, dict]:
+    """
+    执行批处理中的一个请求: 与 /v1/chat/completions 一样受所属 key 的限额约束、按 key 的权重公平排队、
+    计入该 key 的用量，并共用熔断与重试；被限额或排队拒绝、熔断时等待后再试，而不是记为失败
+    """
+    client = api_keys.find(owner)
+    if client is None:
+        return 401, {'error': {'message': f'API key {owner} 已被删除', 'type': 'invalid_request_error',
+                               'code': 'invalid_api_key'}}
+    current_retry.set(retry_policy.start())
+    while True:
+        try:
+            lease = client.acquire()
+            break
+        except AdmissionRejected as e:
+            await asyncio.sleep(e.retry_after)
+    try:
+        while True:
+            if breaker is not None and breaker.rejecting:
+                await asyncio.sleep(breaker.retry_after())
+                continue
+            try:
+                ticket = await admission.acquire(client.name, client.weight)
+                break
+            except AdmissionRejected as e:
+                await asyncio.sleep(e.retry_after)
+        try:
+            response = await error_wrapper(lambda: non_stream_chat_completion(
+                request, client.track_usage(chat_generator(request))))
+        finally:
+            ticket.release()
+    finally:
+        lease.release()
+    if isinstance(response, JSONResponse):
+        return response.status_code, json.loads(response.body)
+    return 200, response
+
+
+def authenticate(credentials: HTTPAuthorizationCredentials) -> ApiKey:
+    client = api_keys.authenticate(credentials.credentials)
+    if client is None:
+        raise HTTPException(401, 'api key 错误')
+    return client
+
+
+def get_batch_scheduler() -> BatchScheduler:
+    if batch_scheduler is None:
+        raise HTTPException(404, '批处理未启用(未配置 BATCH_DIR)')
+    return batch_scheduler
+
+
+@app.post("/v1/files")
+async def upload_file(raw: Request, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """上传批处理输入文件(multipart/form-data，字段 file 与 purpose=batch)"""
+    client = authenticate(credentials)
+    scheduler = get_batch_scheduler()
+    try:
+        fields = parse_multipart(raw.headers.get('content-type', ''), await raw.body())
+        filename, content = fields.get('file', (None, None))
+        purpose = fields.get('purpose', (None, b''))[1].decode()
+        if content is None:
+            raise BatchError('缺少 file 字段')
+        if purpose != 'batch':
+            raise BatchError(f'不支持的 purpose: {purpose}，仅支持 batch')
+        return await scheduler.files.create(content, filename or 'upload.jsonl', purpose, client.name)
+    except BatchError as e:
+        raise HTTPException(e.status_code, e.message)
+
+
+@app.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    client = authenticate(credentials)
+    try:
+        return get_batch_scheduler().files.get(file_id, client.name)
+    except BatchError as e:
+        raise HTTPException(e.status_code, e.message)
+
+
+@app.get("/v1/files/{file_id}/content")
+async def file_content(file_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """下载文件内容(批处理的输出与错误文件为 JSONL)"""
+    client = authenticate(credentials)
+    scheduler = get_batch_scheduler()
+    try:
+        scheduler.files.get(file_id, client.name)
+        return FileResponse(scheduler.files.path(file_id), media_type='application/jsonl')
+    except BatchError as e:
+        raise HTTPException(e.status_code, e.message)
+
+
+@app.post("/v1/batches")
+async def create_batch(body: dict, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    client = authenticate(credentials)
+    try:
+        return await get_batch_scheduler().create(body.get('input_file_id', ''), body.get('endpoint', ''),
+                                                  body.get('completion_window', '24h'), body.get('metadata'),
+                                                  client.name)
+    except BatchError as e:
+        raise HTTPException(e.status_code, e.message)
+
+
+@app.get("/v1/batches")
+async def list_batches(limit: int = 20, after: Optional[str] = None,
+                       credentials: HTTPAuthorizationCredentials = Depends(security)):
+    client = authenticate(credentials)
+    return get_batch_scheduler().list_batches(client.name, min(max(limit, 1), 100), after)
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    client = authenticate(credentials)
+    try:
+        return get_batch_scheduler().get(batch_id, client.name)
+    except BatchError as e:
+        raise HTTPException(e.status_code, e.message)
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, credentials: HTTPAuthorizationCredentials = Depends(security)):
+    client = authenticate(credentials)
+    try:
+        return await get_batch_scheduler().cancel(batch_id, client.name)
+    except BatchError as e:
+        raise HTTPException(e.status_code, e.message)
+
+
+@app.get("/healthz")
+async def healthz():
+    """存活探针"""
+    return {"status": "ok"}
+
+
+@app.get("/readyz")
+async def readyz():
+    """就绪探针: 启动完成、未在排空且上游熔断器未打开时返回 200"""
+    circuit = breaker.state if breaker is not None else None
+    if not shutdown.ready:
+        return JSONResponse({"status": "draining" if shutdown.draining else "starting",
+                             "in_flight": admission.in_flight, "circuit": circuit}, status_code=503)
+    if breaker is not None and breaker.rejecting:
+        return JSONResponse({"status": "upstream_unavailable", "in_flight": admission.in_flight,
+                             "circuit": circuit}, status_code=503)
+    return {"status": "ready", "in_flight": admission.in_flight, "circuit": circuit}
 
 
 @app.get("/v1/models")
@@ -80,13 +415,67 @@ async def list_models(credentials: HTTPAuthorizationCredentials = Depends(securi
     return ModelsResponse(object="list", data=model_list)
 
 
+@app.get("/v1/stats")
+async def stats(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """运行时统计"""
+    if credentials.credentials != API_KEY:
+        raise HTTPException(401, 'api key 错误')
+
+    return {
+        "admission": admission.stats(),
+        "session_pool": session_pool.stats(),
+        "streams": stream_stats,
+        "stream_coalesce": {
+            **coalesce_stats,
+            "events_saved": coalesce_stats["events_in"] - coalesce_stats["events_out"],
+        },
+        "truncation_overlap": overlap_stats,
+        "truncation_continuation": continuation_stats,
+        "conversion_cache": conversion_cache.stats(),
+        "response_cache": response_cache.stats() if response_cache is not None else None,
+        "single_flight": single_flight.stats() if single_flight is not None else None,
+        "hedge": hedge_policy.stats() if hedge_policy is not None else None,
+        "circuit_breaker": breaker.stats() if breaker is not None else None,
+        "api_keys": api_keys.stats(),
+        "batch": batch_scheduler.stats() if batch_scheduler is not None else None,
+        "context_budget": context_budget.stats() if context_budget is not None else None,
+        "token_accounting": {**token_stats, "message_cache": message_token_cache.stats()},
+    }
+
+
+@app.get("/metrics")
+async def metrics(credentials: HTTPAuthorizationCredentials = Depends(security)):
+    """Prometheus 指标，运行时统计以 gauge 形式一并输出"""
+    if credentials.credentials != API_KEY:
+        raise HTTPException(401, 'api key 错误')
+
+    return PlainTextResponse(render(
+        ("cursorweb_admission", admission.stats()),
+        ("cursorweb_session_pool", session_pool.stats()),
+        ("cursorweb_streams", stream_stats),
+        ("cursorweb_stream_coalesce", coalesce_stats),
+        ("cursorweb_truncation_overlap", overlap_stats),
+        ("cursorweb_truncation_continuation", continuation_stats),
+        ("cursorweb_conversion_cache", conversion_cache.stats()),
+        ("cursorweb_response_cache", response_cache.stats() if response_cache is not None else {}),
+        ("cursorweb_single_flight", single_flight.stats() if single_flight is not None else {}),
+        ("cursorweb_hedge", hedge_policy.stats() if hedge_policy is not None else {}),
+        ("cursorweb_circuit_breaker", breaker.stats() if breaker is not None else {}),
+        ("cursorweb_batch", batch_scheduler.stats() if batch_scheduler is not None else {}),
+        ("cursorweb_context_budget", context_budget.stats() if context_budget is not None else {}),
+        ("cursorweb_token_accounting", token_stats),
+    ), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
 def inject_system_prompt(list_openai_message: list[Message], inject_prompt: str):
     # 查找是否存在system角色的消息
     system_message_found = False
 
-    for message in list_openai_message:
+    for i, message in enumerate(list_openai_message):
         if message.role == "system":
             system_message_found = True
+            # 复制后再修改，不改动请求中的原始消息(续写与缓存会复用它们)
+            message = list_openai_message[i] = message.model_copy(deep=True)
             # 处理content字段，需要考虑不同的数据类型
             if message.content is None:
                 message.content = inject_prompt
@@ -153,62 +542,72 @@ def collect_developer_messages(list_openai_message: list[Message]) -> str:
     return "\n".join(collected_contents)
 
 
-def to_cursor_messages(request: ChatCompletionRequest):
-    list_openai_message: list[Message] = request.messages
-    if list_openai_message is None:
-        list_openai_message = []
+def _tool_calls_key(tool_calls: list[dict]) -> Optional[tuple]:
+    """
+    OpenAI 标准结构的工具调用以 (id, 名称, 参数) 作为缓存键，参数本身已是 JSON 字符串，不必再序列化
+    结构(含字段顺序)不同时返回 None，不缓存
+    """
+    key = []
+    for call in tool_calls:
+        function = call.get('function')
+        if tuple(call) != ('id', 'type', 'function') or call['type'] != 'function' \
+                or not isinstance(function, dict) or tuple(function) != ('name', 'arguments'):
+            return None
+        item = (call['id'], function['name'], function['arguments'])
+        if not all(isinstance(value, str) for value in item):
+            return None
+        key.append(item)
+    return tuple(key)
 
-    developer_messages = collect_developer_messages(list_openai_message)
-    inject_system_prompt(list_openai_message, developer_messages)
 
-    if ENABLE_FUNCTION_CALLING:
-        if request.tools:
-            tools = [tool.model_dump_json() for tool in request.tools]
-            inject_system_prompt(list_openai_message, "你可用的工具: " + json.dumps(tools))
-            inject_system_prompt(list_openai_message, "不允许使用tool_calls: xxxx调用工具，请使用原生的工具调用方法")
+def _converted_size(message: dict) -> int:
+    # 键中的参数字符串与文本大小相当
+    return 2 * len(message['parts'][0]['text']) + 64
 
-    if SYSTEM_PROMPT_INJECT:
-        inject_system_prompt(list_openai_message, SYSTEM_PROMPT_INJECT)
-    if USER_PROMPT_INJECT:
-        list_openai_message.append(Message(role='user', content=USER_PROMPT_INJECT, tool_calls=None, tool_call_id=None))
 
-    result: list[dict[str, str]] = []
+conversion_cache = LRUCache(CONVERSION_CACHE_SIZE, CONVERSION_CACHE_MAX_BYTES, sizeof=_converted_size)
 
-    for m in list_openai_message:
-        if not m:
-            continue
-
-        if ENABLE_FUNCTION_CALLING:
-            if m.tool_calls:
-                message = {
-                    'role': m.role,
-                    'parts': [{
-                        'type': 'text',
-                        'text': f"tool_calls: {json.dumps(m.tool_calls, ensure_ascii=False)}"
-                    }]
-                }
-                result.append(message)
-                continue
-
-            if m.tool_call_id:
-                message = {
-                    'role': 'user',
-                    'parts': [{
-                        'type': 'text',
-                        'text': f"{m.role}: tool_call_id: {m.tool_call_id} {m.content}"
-                    }]
-                }
-                result.append(message)
-                continue
 
+def convert_message(m: Message) -> dict:
+    """
+    将单条OpenAI消息转换为cursor消息
+    其他消息的转换只是取出文本，比计算任何缓存键都快；只有带工具调用的消息需要序列化，按工具调用缓存
+    返回的字典可能被多个请求共享，调用方不能修改
+    """
+    message = None
+    if ENABLE_FUNCTION_CALLING:
+        if m.tool_calls:
+            key = _tool_calls_key(m.tool_calls)
+            if key is not None:
+                key = (m.role, key)
+                message = conversion_cache.get(key)
+                if message is not None:
+                    return message
+            message = {
+                'role': m.role,
+                'parts': [{
+                    'type': 'text',
+                    'text': f"tool_calls: {json.dumps(m.tool_calls, ensure_ascii=False)}"
+                }]
+            }
+            if key is not None:
+                conversion_cache.set(key, message)
+            return message
+        elif m.tool_call_id:
+            message = {
+                'role': 'user',
+                'parts': [{
+                    'type': 'text',
+                    'text': f"{m.role}: tool_call_id: {m.tool_call_id} {m.content}"
+                }]
+            }
+
+    if message is None:
         text = ''
         if isinstance(m.content, str):
             text = m.content
-        else:
-            for content in m.content:
-                if not content.text:
-                    continue
-                text = text + content.text
+        elif m.content:
+            text = ''.join(content.text for content in m.content if content.text)
         message = {
             'role': m.role,
             'parts': [{
@@ -216,7 +615,37 @@ def to_cursor_messages(request: ChatCompletionRequest):
                 'text': text
             }]
         }
-        result.append(message)
+    return message
+
+
+def to_cursor_messages(request: ChatCompletionRequest, tool_set: Optional[ToolSet] = None):
+    """
+    Args:
+        tool_set: 调用方已取得的工具集合，未提供时按 request.tools 获取
+    """
+    # 复制列表，开发者消息的移除与系统提示词注入都不影响原请求
+    list_openai_message: list[Message] = list(request.messages or [])
+
+    developer_messages = collect_developer_messages(list_openai_message)
+    inject_system_prompt(list_openai_message, developer_messages)
+
+    if ENABLE_FUNCTION_CALLING:
+        if request.tools:
+            inject_system_prompt(list_openai_message, (tool_set or get_tool_set(request)).prompt)
+            inject_system_prompt(list_openai_message, "不允许使用tool_calls: xxxx调用工具，请使用原生的工具调用方法")
+
+    if SYSTEM_PROMPT_INJECT:
+        inject_system_prompt(list_openai_message, SYSTEM_PROMPT_INJECT)
+    result: list[dict] = [convert_message(m) for m in list_openai_message]
+    if context_budget is not None:
+        with span('context_budget') as s:
+            result, saved = context_budget.trim(request.model, list_openai_message, result)
+            if s is not None:
+                s.set(tokens_saved=saved)
+
+    if USER_PROMPT_INJECT:
+        result.append(convert_message(Message(role='user', content=USER_PROMPT_INJECT, tool_calls=None,
+                                              tool_call_id=None)))
 
     if result[0]['role'] == 'system' and not result[0]['parts'][0]['text']:
         result.pop(0)
@@ -224,34 +653,83 @@ def to_cursor_messages(request: ChatCompletionRequest):
     return result
 
 
-def parse_sse_line(line: str) -> Optional[str]:
-    """解析SSE数据行"""
-    line = line.strip()
-    if line.startswith("data: "):
-        return line[6:]  # 去掉 'data: ' 前缀
-    return None
+async def fetch_x_is_human(session: AsyncSession) -> str:
+    if X_IS_HUMAN_SERVER_URL:
+        return await get_x_is_human_server(session)
+    return await get_x_is_human(session)
+
+
+async def prepare_chat(request: ChatCompletionRequest) -> dict[str, str]:
+    """
+    预先完成下一次 cursor_chat 的准备工作，返回传给 cursor_chat 的参数
+    截断续写在当前段接近上限时调用，把 x-is-human 计算与当前段的生成重叠
+    """
+    async with session_pool.session() as session:
+        return {'x_is_human': await fetch_x_is_human(session)}
 
 
-async def cursor_chat(request: ChatCompletionRequest):
-    # 提取可用工具名列表，用于后续修正
-    available_tool_names = []
+async def cursor_chat(request: ChatCompletionRequest, x_is_human: Optional[str] = None):
+    # 可用工具集合，用于后续修正工具名
+    tool_set = None
     if ENABLE_FUNCTION_CALLING and request.tools:
-        available_tool_names = [tool.function.name for tool in request.tools]
+        tool_set = get_tool_set(request)
 
+    with span('to_cursor_messages'):
+        started_at = time.perf_counter()
+        messages = to_cursor_messages(request, tool_set=tool_set)
+        observe_stage('to_cursor_messages', started_at)
     json_data = {
         "context": [
 
         ],
         "model": request.model,
         "id": generate_random_string(16),
-        "messages": to_cursor_messages(request),
+        "messages": messages,
         "trigger": "submit-message"
     }
-    async with AsyncSession(impersonate='chrome', timeout=TIMEOUT, proxy=PROXY) as session:
-        if X_IS_HUMAN_SERVER_URL:
-            x_is_human = await get_x_is_human_server(session)
-        else:
-            x_is_human = await get_x_is_human(session)
+    tool_call = None
+    usage_reported = False
+    # 上游未返回 usage 时用于估算 completion token 数
+    completion = TokenCounter()
+    upstream = open_upstream(request, json_data, x_is_human)
+    async with (breaker.guard(upstream) if breaker is not None else upstream) as chunks:
+        async with aclosing(parse_upstream_events(request, chunks, tool_set)) as events:
+            async for item in events:
+                if isinstance(item, ToolCall):
+                    # 工具返回了直接掐断，先关闭上游连接再输出
+                    tool_call = item
+                    break
+                if isinstance(item, Usage):
+                    usage_reported = True
+                else:
+                    completion.add(item)
+                yield item
+    if tool_call is not None:
+        completion.add(tool_call.toolName)
+        completion.add(tool_call.toolInput)
+        yield tool_call
+    if not usage_reported:
+        # 与上游 usage 一样在输出结束时给出
+        yield estimate_usage(messages, completion)
+
+
+@asynccontextmanager
+async def open_upstream(request: ChatCompletionRequest, json_data: dict,
+                        x_is_human: Optional[str] = None) -> AsyncIterator[AsyncIterator[bytes]]:
+    """
+    打开上游 /api/chat 事件流，产出原始字节块的异步迭代器
+    回放模式下直接使用录制的事件流，不访问网络；录制模式下透传的同时保存
+    """
+    if replayer is not None:
+        yield replayer.chunks()
+        return
+
+    async with session_pool.session() as session:
+        if not x_is_human:
+            with span('x_is_human'):
+                started_at = time.perf_counter()
+                x_is_human = await fetch_x_is_human(session)
+                observe_stage('x_is_human', started_at)
         logger.debug(x_is_human)
         headers = {
             'User-Agent': FP.get("userAgent"),
@@ -274,11 +752,17 @@ async def cursor_chat(request: ChatCompletionRequest):
             'accept-language': 'zh-CN,zh;q=0.9,en;q=0.8',
             'priority': 'u=1, i',
         }
-        logger.debug(json_data)
-        async with session.stream("POST", 'https://cursor.com/api/chat', headers=headers, json=json_data,
+        if DEBUG:
+            # 长对话的请求体很大，不输出调试日志时不格式化
+            logger.debug(json_data)
+        started_at = time.perf_counter()
+        started_ns = time.time_ns()
+        async with session.stream("POST", f'{CURSOR_BASE_URL}/api/chat', headers=headers, json=json_data,
                                   impersonate='chrome') as response:
             response: Response
             # logger.debug(await response.atext())
+            observe_stage('upstream_connect', started_at)
+            record_span('upstream_connect', started_ns, status_code=response.status_code)
 
             if response.status_code != 200:
                 text = await response.atext()
@@ -289,53 +773,74 @@ async def cursor_chat(request: ChatCompletionRequest):
             if 'text/event-stream' not in content_type:
                 text = await response.atext()
                 raise CursorWebError(response.status_code, "响应非事件流: " + text)
-            async for line in response.aiter_lines():
-                line = line.decode("utf-8")
-                logger.debug(line)
-                data = parse_sse_line(line)
-                if not data:
-                    continue
-                if data and data.strip():
-                    try:
-                        event_data = json.loads(data)
-                        if event_data.get('type') == 'error':
-                            err_msg = event_data.get('errorText', 'errorText为空')
-                            if 'The content field in the Message object at' in err_msg:
-                                err_msg = "消息为空，很可能你的消息只包含图片，本接口不支持图片\n" + err_msg
-                            raise CursorWebError(response.status_code, err_msg)
-                        if event_data.get('type') == 'finish':
-                            usage = event_data.get('messageMetadata', {}).get('usage')
-                            if not usage:
-                                continue
-                            yield Usage(prompt_tokens=usage.get('inputTokens'),
-                                        completion_tokens=usage.get('outputTokens'),
-                                        total_tokens=usage.get('totalTokens'))
-                            return
-                        if ENABLE_FUNCTION_CALLING:
-                            if event_data.get('type') == 'tool-input-error':
-                                tool_call_id = event_data.get('toolCallId')
-                                tool_name = event_data.get('toolName')
-                                tool_input = event_data.get('input')
-                                if isinstance(tool_input, str):
-                                    tool_input_str = tool_input
-                                else:
-                                    tool_input_str = json.dumps(tool_input)
-
-                                # 修正工具名称
-                                if available_tool_names:
-                                    tool_name = match_tool_name(tool_name, available_tool_names)
-
-                                response.close()  # 工具返回了直接掐断
-                                yield ToolCall(toolId=tool_call_id, toolInput=tool_input_str, toolName=tool_name)
-                                return
-
-                        delta = event_data.get('delta')
-                        # logger.debug(delta)
-                        if not delta:
-                            continue
-                        yield delta
-                    except json.JSONDecodeError:
-                        continue
+            try:
+                if recorder is None:
+                    yield response.aiter_content()
+                    return
+                async with aclosing(recorder.record(response.aiter_content(), {'model': request.model})) as chunks:
+                    yield chunks
+            finally:
+                # curl_cffi 关闭流式响应时会等待传输读完，提前结束(工具调用、客户端断开)时先通知 curl 中止传输
+                if response.quit_now is not None:
+                    response.quit_now.set()
+
+
+async def parse_upstream_events(request: ChatCompletionRequest, chunks: AsyncIterator[bytes],
+                                tool_set: Optional[ToolSet] = None):
+    """将上游字节流解析为文本增量、Usage 与 ToolCall，与字节来源(网络或录制回放)无关"""
+    timer = current_request.get()
+    last_delta_at = None
+    async for data in aiter_sse_data(chunks):
+        if DEBUG:
+            logger.debug(data)
+        event_data = decode_event(data)
+        if event_data is None:
+            continue
+        if event_data.get('type') == 'error':
+            err_msg = event_data.get('errorText', 'errorText为空')
+            if 'The content field in the Message object at' in err_msg:
+                err_msg = "消息为空，很可能你的消息只包含图片，本接口不支持图片\n" + err_msg
+            raise CursorWebError(200, err_msg)
+        if event_data.get('type') == 'finish':
+            usage = event_data.get('messageMetadata', {}).get('usage')
+            if not usage or usage.get('inputTokens') is None or usage.get('outputTokens') is None:
+                # 由 cursor_chat 本地估算
+                continue
+            token_stats["reported"] += 1
+            yield Usage(prompt_tokens=usage['inputTokens'],
+                        completion_tokens=usage['outputTokens'],
+                        total_tokens=usage.get('totalTokens') or usage['inputTokens'] + usage['outputTokens'],
+                        cached_tokens=usage.get('cachedInputTokens') or 0,
+                        reasoning_tokens=usage.get('reasoningTokens') or 0)
+            return
+        if ENABLE_FUNCTION_CALLING:
+            if event_data.get('type') == 'tool-input-error':
+                tool_call_id = event_data.get('toolCallId')
+                tool_name = event_data.get('toolName')
+                tool_input = event_data.get('input')
+                if isinstance(tool_input, str):
+                    tool_input_str = tool_input
+                else:
+                    tool_input_str = json.dumps(tool_input)
+
+                # 修正工具名称
+                if tool_set:
+                    tool_name = match_tool_name(tool_name, tool_set)
+
+                yield ToolCall(toolId=tool_call_id, toolInput=tool_input_str, toolName=tool_name)
+                return
+
+        delta = event_data.get('delta')
+        # logger.debug(delta)
+        if not delta:
+            continue
+        now = time.perf_counter()
+        if last_delta_at is not None:
+            INTER_DELTA_SECONDS.observe(now - last_delta_at, request.model)
+        elif timer is not None:
+            timer.delta()
+        last_delta_at = now
+        yield delta
 
 
 async def get_x_is_human_server(session: AsyncSession):
@@ -397,6 +902,20 @@ async def get_x_is_human(session: AsyncSession):
                                  impersonate='chrome')
     cursor_js = response.text
 
+    # 替换代码
+    main = js_template().replace("$$cursor_jscode$$", cursor_js)
+    return await runjs(main)
+
+
+@functools.cache
+def js_template() -> str:
+    """
+    x-is-human 计算脚本模板(已替换指纹与环境代码)
+    每个进程首次需要时才读取 jscode，使用纯算服务器或回放时不会读取
+    """
+    main_code = open('./jscode/main.js', 'r', encoding='utf-8').read()
+    env_code = open('./jscode/env.js', 'r', encoding='utf-8').read()
+
     # 替换指纹
     main = (main_code.replace("$$currentScriptSrc$$", SCRIPT_URL)
             .replace("$$UNMASKED_VENDOR_WEBGL$$", FP.get("UNMASKED_VENDOR_WEBGL"))
@@ -404,9 +923,7 @@ async def get_x_is_human(session: AsyncSession):
             .replace("$$userAgent$$", FP.get("userAgent")))
 
     # 替换代码
-    main = main.replace('$$env_jscode$$', env_code)
-    main = main.replace("$$cursor_jscode$$", cursor_js)
-    return await runjs(main)
+    return main.replace('$$env_jscode$$', env_code)
 
 
 @to_async
@@ -450,10 +967,12 @@ def runjs(jscode: str) -> str:
 if __name__ == "__main__":
     import uvicorn
 
+    # 多进程时由 uvicorn 主进程监听端口并监管工作进程(异常退出自动重启)，各工作进程互不共享状态
     uvicorn.run(
         "main:app",
         host="0.0.0.0",
         port=8000,
         reload=False,
         log_level="info",
+        workers=WORKERS,
     )
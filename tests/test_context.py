@@ -0,0 +1,60 @@
+from app.context import ContextBudget
+from app.models import Message
+
+
+def convert(messages: list[Message]) -> list[dict]:
+    return [{'role': m.role, 'parts': [{'type': 'text', 'text': m.content}]} for m in messages]
+
+
+def trim(messages: list[Message], budget: int, keep_turns: int = 1) -> list[str]:
+    trimmed, _ = ContextBudget({'*': budget}, keep_turns=keep_turns).trim('gpt-4o', messages, convert(messages))
+    return [m['parts'][0]['text'] for m in trimmed]
+
+
+def test_drops_oldest_turns_and_keeps_last():
+    messages = [Message(role='system', content='system')]
+    for i in range(5):
+        messages += [Message(role='user', content=f'q{i}' * 400), Message(role='assistant', content=f'a{i}' * 400)]
+
+    texts = trim(messages, 500)
+
+    assert texts == ['system', 'q4' * 400, 'a4' * 400]
+
+
+def test_keep_turns_zero_still_keeps_current_question():
+    messages = [Message(role='system', content='system'),
+                Message(role='user', content='old' * 1000),
+                Message(role='assistant', content='answer' * 1000),
+                Message(role='user', content='question')]
+
+    assert trim(messages, 50, keep_turns=0) == ['system', 'question']
+
+
+def test_truncation_continuation_keeps_question_and_partial_answer():
+    partial = 'x' * 20000
+    messages = [Message(role='system', content='system'),
+                Message(role='user', content='old' * 1000),
+                Message(role='assistant', content='answer' * 1000),
+                Message(role='user', content='question'),
+                Message.continuation('assistant', partial),
+                Message.continuation('user', 'continue')]
+
+    assert trim(messages, 3000) == ['system', 'question', partial, 'continue']
+
+
+def test_collapses_old_tool_results_before_dropping_turns():
+    messages = [Message(role='user', content='read the file'),
+                Message(role='assistant', content=None, tool_calls=[{'id': 'call_1'}]),
+                Message(role='tool', tool_call_id='call_1', content='line\n' * 2000),
+                Message(role='assistant', content='done'),
+                Message(role='user', content='question')]
+    converted = convert(messages)
+    converted[1]['parts'][0]['text'] = 'tool_calls'
+
+    trimmed, saved = ContextBudget({'*': 200}, collapse_chars=20).trim('gpt-4o', messages, converted)
+
+    assert [m['parts'][0]['text'][:20] for m in trimmed] == ['read the file', 'tool_calls', 'line\n' * 4, 'done',
+                                                            'question']
+    assert saved > 0
+    # 共享的转换结果不能被修改
+    assert converted[2]['parts'][0]['text'] == 'line\n' * 2000
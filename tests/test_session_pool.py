@@ -0,0 +1,61 @@
+import asyncio
+
+import pytest
+
+from app.session_pool import SessionPool
+
+
+def run(coro_func):
+    async def main():
+        pool = SessionPool(4, 0, 0)
+        try:
+            await coro_func(pool)
+            return pool.stats()
+        finally:
+            await pool.close()
+
+    return asyncio.run(main())
+
+
+def test_early_closed_generator_returns_session():
+    async def scenario(pool):
+        async def stream():
+            async with pool.session():
+                for i in range(10):
+                    yield i
+
+        generator = stream()
+        await generator.__anext__()
+        await generator.aclose()
+
+    stats = run(scenario)
+
+    assert stats['idle'] == 1 and stats['discarded'] == 0
+
+
+def test_cancelled_request_returns_session():
+    async def scenario(pool):
+        async def request():
+            async with pool.session():
+                await asyncio.sleep(10)
+
+        task = asyncio.create_task(request())
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    stats = run(scenario)
+
+    assert stats['idle'] == 1 and stats['discarded'] == 0
+
+
+def test_error_discards_session():
+    async def scenario(pool):
+        with pytest.raises(ConnectionError):
+            async with pool.session():
+                raise ConnectionError('reset')
+
+    stats = run(scenario)
+
+    assert stats['idle'] == 0 and stats['discarded'] == 1
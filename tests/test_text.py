@@ -0,0 +1,66 @@
+import pytest
+
+from app.text import OverlapMatcher, TextAccumulator, in_code_block, longest_overlap
+from benchmarks.bench_overlap import CHUNKED_ONLY, FIXTURES, run
+
+
+@pytest.mark.parametrize('name, tail, chunks, expected', FIXTURES, ids=[f[0] for f in FIXTURES])
+def test_overlap_fixtures(name, tail, chunks, expected):
+    assert run(tail, chunks)[0] == expected
+    if name not in CHUNKED_ONLY:
+        assert run(tail, list(''.join(chunks)))[0] == expected
+
+
+@pytest.mark.parametrize('chunks', [['```\n', '\n完成。'], list('```\n\n完成。')])
+def test_closing_fence_is_kept(chunks):
+    tail = '```python\nprint(1)\n'
+
+    got, matcher = run(tail, chunks)
+
+    assert got == '```python\nprint(1)\n```\n\n完成。'
+    assert matcher.overlap == 0
+    assert not in_code_block(got)
+
+
+@pytest.mark.parametrize('chunks', [['```'], ['```\n']])
+def test_closing_fence_at_end_of_stream_is_kept(chunks):
+    tail = '```python\nprint(1)\n'
+
+    assert run(tail, chunks)[0] == tail + ''.join(chunks)
+
+
+@pytest.mark.parametrize('chunks', [['```\nprint(x)\n', 'y = 2\n```'], list('```\nprint(x)\ny = 2\n```')])
+def test_bare_fence_reopening_repeated_code_is_stripped(chunks):
+    tail = '```python\nx = 1\nprint(x)\n'
+
+    assert run(tail, chunks)[0] == tail + 'y = 2\n```'
+
+
+def test_fence_with_language_is_stripped_even_without_overlap():
+    assert run('```python\nimport os\n', ['```python\n', 'import sys\n```'])[0] == '```python\nimport os\nimport sys\n```'
+
+
+def test_matcher_without_tail_passes_through():
+    matcher = OverlapMatcher('', 64)
+
+    assert matcher.feed('abc') == 'abc'
+    assert matcher.finish() == ''
+
+
+@pytest.mark.parametrize('tail, head, expected', [
+    ('hello world', 'world!', 5),
+    ('abcabcabd', 'abcabd', 6),
+    ('abc', 'xyz', 0),
+    ('', 'abc', 0),
+])
+def test_longest_overlap(tail, head, expected):
+    assert longest_overlap(tail, head) == expected
+
+
+def test_text_accumulator():
+    content = TextAccumulator()
+    for chunk in ('a', 'bc', 'def'):
+        content.append(chunk)
+
+    assert content.getvalue() == 'abcdef'
+    assert content.tail(4) == 'cdef'
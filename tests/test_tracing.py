@@ -0,0 +1,48 @@
+import asyncio
+
+from app.tracing import TracingMiddleware, current_request_id, current_trace, span
+
+
+class Recorder:
+    def __init__(self):
+        self.traces = []
+
+    def export(self, trace):
+        self.traces.append(trace)
+
+
+def call(middleware: TracingMiddleware, headers=()) -> tuple[list[dict], dict]:
+    seen = {}
+    messages = []
+
+    async def app(scope, receive, send):
+        with span('upstream') as s:
+            seen.update(span=s, trace=current_trace.get(), request_id=current_request_id())
+        await send({'type': 'http.response.start', 'status': 200, 'headers': []})
+        await send({'type': 'http.response.body', 'body': b''})
+
+    async def send(message):
+        messages.append(message)
+
+    middleware.app = app
+    scope = {'type': 'http', 'path': '/v1/chat/completions', 'method': 'POST', 'headers': list(headers)}
+    asyncio.run(middleware(scope, None, send))
+    return messages, seen
+
+
+def test_without_exporter_only_sets_request_id():
+    messages, seen = call(TracingMiddleware(None), [(b'x-request-id', b'req-1')])
+
+    assert seen == {'span': None, 'trace': None, 'request_id': 'req-1'}
+    assert (b'x-request-id', b'req-1') in messages[0]['headers']
+
+
+def test_with_exporter_records_spans():
+    exporter = Recorder()
+    messages, seen = call(TracingMiddleware(None, exporter=exporter))
+
+    [trace] = exporter.traces
+    assert seen['trace'] is trace and seen['request_id'] == trace.request_id
+    assert [s.name for s in trace.spans] == ['upstream']
+    assert trace.root.attributes['http.status_code'] == 200
+    assert (b'x-request-id', trace.request_id.encode()) in messages[0]['headers']